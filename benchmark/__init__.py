@@ -0,0 +1 @@
+"""CPU benchmarks for the Triton Python models of this repository."""
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+CPU benchmark suite for the Triton Python models.
+
+Runs preprocessing, postprocessing, tokenize, usage_counter and nv-embed-v2
+in-process with the fake `triton_python_backend_utils` and a tiny local
+tokenizer, and reports the latency of `execute`, the request throughput and
+the memory allocated per call. Needs neither a GPU nor a Triton server, so it
+can catch regressions of the CPU hot paths on any machine.
+
+Usage:
+    python3 -m benchmark.bench_models [--models preprocessing ...]
+                                      [--batch-size 8] [--calls 50]
+                                      [--json results.json]
+"""
+import argparse
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from benchmark.harness import (CORPUS, LLAMA_REPOSITORY, NV_EMBED_REPOSITORY,
+                               ModelHarness, format_results,
+                               make_request, make_tiny_tokenizer, measure,
+                               string_tensor)
+
+
+def make_prompts(rng, count, min_sentences=1, max_sentences=8):
+    return [
+        " ".join(
+            rng.choice(CORPUS,
+                       size=rng.integers(min_sentences, max_sentences + 1)))
+        for _ in range(count)
+    ]
+
+
+def bench_preprocessing(tokenizer_dir, args):
+    harness = ModelHarness(
+        os.path.join(LLAMA_REPOSITORY, "preprocessing"),
+        substitutions={
+            "tokenizer_dir": tokenizer_dir,
+            "triton_max_batch_size": args.batch_size,
+            "preprocessing_instance_count": 1,
+            "enable_batch_tokenization": True,
+            "word_list_cache_size": 128,
+            "sparse_embedding_bias": False,
+        })
+    rng = np.random.default_rng(0)
+    prompts = make_prompts(rng, args.batch_size * args.calls)
+
+    def batches(stop_words):
+        requests = []
+        for prompt in prompts:
+            inputs = {
+                "QUERY": string_tensor([prompt]),
+                "REQUEST_OUTPUT_LEN": np.array([[128]], np.int32),
+            }
+            if stop_words:
+                inputs["STOP_WORDS_DICT"] = string_tensor(
+                    ["<|eot_id|>", "\n\n"])
+                inputs["BAD_WORDS_DICT"] = string_tensor(["fox"])
+            requests.append(make_request(inputs))
+        return [
+            requests[i:i + args.batch_size]
+            for i in range(0, len(requests), args.batch_size)
+        ]
+
+    with harness:
+        return [
+            measure("preprocessing", harness, lambda: batches(False)),
+            measure("preprocessing/stop_words", harness,
+                    lambda: batches(True)),
+        ]
+
+
+def bench_postprocessing(tokenizer_dir, args):
+    harness = ModelHarness(
+        os.path.join(LLAMA_REPOSITORY, "postprocessing"),
+        substitutions={
+            "tokenizer_dir": tokenizer_dir,
+            "triton_max_batch_size": args.batch_size,
+            "postprocessing_instance_count": 1,
+            "skip_special_tokens": True,
+            "enable_incremental_detokenization": True,
+            "incremental_detokenizer_max_states": 4096,
+        })
+    with harness:
+        tokenizer = harness.model.tokenizer
+        rng = np.random.default_rng(0)
+        sequences = [
+            tokenizer.encode(prompt, add_special_tokens=False)
+            for prompt in make_prompts(rng, args.batch_size, 4, 8)
+        ]
+
+        def full_batches():
+            # Non-streaming: the whole output of every request at once
+            requests = []
+            for _ in range(args.calls):
+                requests.append([
+                    make_request({
+                        "TOKENS_BATCH":
+                        np.array([[ids]], np.int32),
+                        "SEQUENCE_LENGTH":
+                        np.array([[len(ids)]], np.int32),
+                    }) for ids in sequences
+                ])
+            return requests
+
+        def streaming_batches():
+            # Streaming: one token per call for each of `batch_size` streams
+            length = min(len(ids) for ids in sequences)
+            requests = []
+            for step in range(length):
+                requests.append([
+                    make_request(
+                        {
+                            "TOKENS_BATCH":
+                            np.array([[[ids[step]]]], np.int32),
+                            "SEQUENCE_LENGTH":
+                            np.array([[1]], np.int32),
+                            "IS_FINAL":
+                            np.array([[step == length - 1]], np.bool_),
+                            "STREAM_ID":
+                            np.array([[stream]], np.uint64),
+                        },
+                        request_id=f"stream-{stream}")
+                    for stream, ids in enumerate(sequences)
+                ])
+            return requests
+
+        return [
+            measure("postprocessing", harness, full_batches),
+            measure("postprocessing/streaming", harness, streaming_batches),
+        ]
+
+
+def bench_tokenize(tokenizer_dir, args):
+    harness = ModelHarness(os.path.join(LLAMA_REPOSITORY, "tokenize"),
+                           parameters={"tokenizer_dir": tokenizer_dir})
+    with harness:
+        tokenizer = harness.model.tokenizer
+        rng = np.random.default_rng(0)
+        sequences = [
+            np.array(tokenizer.encode(prompt), np.int32)
+            for prompt in make_prompts(rng, args.batch_size)
+        ]
+
+        def batches():
+            return [[make_request({"tokens": ids}) for ids in sequences]
+                    for _ in range(args.calls)]
+
+        return [measure("tokenize", harness, batches)]
+
+
+def bench_usage_counter(tokenizer_dir, args):
+    harness = ModelHarness(os.path.join(LLAMA_REPOSITORY, "usage_counter"),
+                           substitutions={
+                               "tokenizer_dir": tokenizer_dir,
+                               "triton_max_batch_size": args.batch_size,
+                               "usageprocessing_instance_count": 1,
+                           })
+    rng = np.random.default_rng(0)
+    prompts = make_prompts(rng, args.batch_size * 2)
+
+    def batches():
+        return [[
+            make_request({"prompt": string_tensor(prompts[i:i + 2])})
+            for i in range(0, len(prompts), 2)
+        ] for _ in range(args.calls)]
+
+    with harness:
+        return [measure("usage_counter", harness, batches)]
+
+
+class FakeNVEmbedModel:
+    """
+    Replaces the NV-Embed-v2 weights: the forward pass returns random
+    unit-scale embeddings of the right shape, so only the Python work around
+    the model is measured.
+    """
+
+    hidden_size = 4096
+    padding_side = "right"
+    is_mask_instruction = True
+    device = "cpu"
+
+    def __init__(self):
+        import torch
+        self.generator = torch.Generator().manual_seed(0)
+
+    @classmethod
+    def from_pretrained(cls, *args, **kwargs):
+        return cls()
+
+    def __call__(self, input_ids, attention_mask, pool_mask, return_dict=True):
+        import torch
+        return {
+            "sentence_embeddings":
+            torch.randn(len(input_ids),
+                        1,
+                        self.hidden_size,
+                        generator=self.generator)
+        }
+
+
+def patch_nv_embed(module):
+    module.AutoModel = FakeNVEmbedModel
+
+
+def bench_nv_embed(tokenizer_dir, args):
+    harness = ModelHarness(os.path.join(NV_EMBED_REPOSITORY, "nv-embed-v2"),
+                           parameters={
+                               "model_path": tokenizer_dir,
+                               # The same passages are sent on every call
+                               "embedding_cache_memory_mb": "0",
+                           },
+                           patch=patch_nv_embed)
+    rng = np.random.default_rng(0)
+    passages = make_prompts(rng, args.batch_size, 4, 8)
+
+    def batches():
+        return [[
+            make_request({
+                "input_text": string_tensor([passage]),
+                "input_type": string_tensor(["passage"]),
+            }) for passage in passages
+        ] for _ in range(args.calls)]
+
+    with harness:
+        return [measure("nv-embed-v2", harness, batches)]
+
+
+BENCHMARKS = {
+    "preprocessing": bench_preprocessing,
+    "postprocessing": bench_postprocessing,
+    "tokenize": bench_tokenize,
+    "usage_counter": bench_usage_counter,
+    "nv-embed-v2": bench_nv_embed,
+}
+
+
+def main(args):
+    results = []
+    with tempfile.TemporaryDirectory(prefix="tiny-tokenizer-") as tmp_dir:
+        tokenizer_dir = args.tokenizer_dir or make_tiny_tokenizer(tmp_dir)
+        for name in args.models:
+            results.extend(BENCHMARKS[name](tokenizer_dir, args))
+    print(format_results(results))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([result.as_dict() for result in results], f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--models",
+                        nargs="+",
+                        choices=list(BENCHMARKS),
+                        default=list(BENCHMARKS),
+                        help="models to benchmark")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=8,
+                        help="requests per execute call")
+    parser.add_argument("--calls",
+                        type=int,
+                        default=50,
+                        help="execute calls timed per benchmark")
+    parser.add_argument("--tokenizer-dir",
+                        help="tokenizer to use instead of the tiny one")
+    parser.add_argument("--json", help="also write the results to this file")
+    main(parser.parse_args())
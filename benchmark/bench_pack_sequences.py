@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the sequence packing done by the preprocessing model.
+
+Compares `pack_sequences` from the preprocessing model against the previous
+per-row `np.pad` + `np.stack` implementation for batch sizes 1-16 and prompt
+lengths up to 8k tokens.
+
+Usage:
+    python3 -m benchmark.bench_pack_sequences [--repeat 200]
+"""
+import argparse
+import os
+import timeit
+
+import numpy as np
+
+from benchmark.harness import LLAMA_REPOSITORY, load_model_module
+
+BATCH_SIZES = [1, 2, 4, 8, 16]
+PROMPT_LENGTHS = [128, 512, 2048, 8192]
+PAD_ID = 128009
+
+
+def legacy_pack(start_ids, pad_id):
+    """The packing code `_create_request` used before `pack_sequences`."""
+    start_lengths = np.array([[len(ids)] for ids in start_ids]).astype(int)
+
+    max_len = 0
+    for seq in start_ids:
+        max_len = max(max_len, seq.shape[0])
+    start_ids = np.stack([
+        np.pad(seq, (0, max_len - seq.shape[0]),
+               'constant',
+               constant_values=(0, pad_id)) for seq in start_ids
+    ])
+    return start_ids.astype(np.int32), start_lengths.astype(np.int32)
+
+
+def make_batch(rng, batch_size, max_length):
+    """Random prompts with lengths between max_length / 2 and max_length."""
+    lengths = rng.integers(max_length // 2, max_length + 1, size=batch_size)
+    return [
+        rng.integers(0, 128000, size=length).astype(int) for length in lengths
+    ]
+
+
+def main(repeat):
+    model = load_model_module(os.path.join(LLAMA_REPOSITORY, "preprocessing"))
+    rng = np.random.default_rng(0)
+
+    print(f"{'batch':>5} {'max_len':>8} {'legacy (us)':>12} "
+          f"{'packed (us)':>12} {'speedup':>8}")
+    for batch_size in BATCH_SIZES:
+        for max_length in PROMPT_LENGTHS:
+            start_ids = make_batch(rng, batch_size, max_length)
+
+            expected = legacy_pack(start_ids, PAD_ID)
+            actual = model.pack_sequences(start_ids, PAD_ID)
+            assert np.array_equal(expected[0], actual[0])
+            assert np.array_equal(expected[1], actual[1])
+
+            legacy = min(
+                timeit.repeat(lambda: legacy_pack(start_ids, PAD_ID),
+                              number=repeat,
+                              repeat=3)) / repeat
+            packed = min(
+                timeit.repeat(
+                    lambda: model.pack_sequences(start_ids, PAD_ID),
+                    number=repeat,
+                    repeat=3)) / repeat
+            print(f"{batch_size:>5} {max_length:>8} {legacy * 1e6:>12.1f} "
+                  f"{packed * 1e6:>12.1f} {legacy / packed:>7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=200,
+                        help="number of calls timed per measurement")
+    args = parser.parse_args()
+    main(args.repeat)
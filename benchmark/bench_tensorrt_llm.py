@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Load test of the request bookkeeping of the tensorrt_llm Python model.
+
+Runs `tensorrt_llm/1/model.py` in-process on top of the fake executor of
+`benchmark.fake_trtllm`, which emits synthetic tokens at a fixed rate for
+every active request, and streams thousands of concurrent requests through
+it. Since the engine costs next to nothing, what is measured is the Python
+layer: the time `execute` takes to convert and enqueue requests, the delay
+between the executor producing a response and the model sending it, the time
+threads wait for the model lock and the CPU time spent per token.
+
+Usage:
+    python3 -m benchmark.bench_tensorrt_llm [--streams 2000]
+                                            [--tokens-per-second 50]
+                                            [--output-len 64] [--fused]
+                                            [--json results.json]
+"""
+import argparse
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from benchmark.fake_trtllm import install_fake_trtllm
+from benchmark.harness import (CORPUS, LLAMA_REPOSITORY, ModelHarness,
+                               make_request, make_tiny_tokenizer,
+                               string_tensor)
+
+THREAD_NAME = re.compile(r"\((\w+)\)$")
+
+
+class TimedLock:
+    """
+    A `threading.Lock` that adds up the time each thread spent waiting to
+    acquire it, by thread target name.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.wait_seconds = defaultdict(float)
+        self.acquisitions = defaultdict(int)
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        name = threading.current_thread().name
+        match = THREAD_NAME.search(name)
+        name = match.group(1) if match else name
+        self.wait_seconds[name] += time.perf_counter() - start
+        self.acquisitions[name] += 1
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _percentile_ms(values, percentile):
+    return float(np.percentile(values, percentile)) * 1000 if values else 0.0
+
+
+def make_harness(args, tokenizer_dir):
+    substitutions = {
+        "triton_backend": "python",
+        "triton_max_batch_size": args.batch_size,
+        "decoupled_mode": True,
+        "max_beam_width": 1,
+        "engine_dir": "",
+        "batching_strategy": "inflight_fused_batching",
+        "exclude_input_in_output": True,
+        "logits_datatype": "TYPE_FP32",
+        "cancellation_check_period_ms": args.cancellation_check_period_ms,
+        "stats_check_period_ms": 100,
+        "tokenizer_dir": tokenizer_dir or "",
+        "tensorrt_llm_instance_count": args.instances,
+        "shared_executor": args.instances > 1,
+        "shared_executor_address": args.shared_executor_address,
+        "collect_kv_cache_reuse_stats": args.collect_stats,
+        "collect_queue_time_stats": args.collect_stats,
+    }
+    if not args.fused:
+        return ModelHarness(os.path.join(LLAMA_REPOSITORY, "tensorrt_llm"),
+                            substitutions=substitutions)
+    return ModelHarness(os.path.join(LLAMA_REPOSITORY,
+                                     "llama-3.1-8b-instruct-fused"),
+                        substitutions={
+                            **substitutions,
+                            "add_special_tokens": True,
+                            "skip_special_tokens": True,
+                            "incremental_detokenizer_max_states":
+                            args.streams,
+                        })
+
+
+def make_stream_request(args, stream):
+    if args.fused:
+        inputs = {
+            "text_input": string_tensor([CORPUS[stream % len(CORPUS)]]),
+            "max_tokens": np.array([[args.output_len]], np.int32),
+            "stream": np.array([[args.streaming]], np.bool_),
+        }
+    else:
+        input_ids = np.arange(stream, stream + args.input_len,
+                              dtype=np.int32) % args.vocab_size
+        inputs = {
+            "input_ids": input_ids.reshape(1, -1),
+            "input_lengths": np.array([[args.input_len]], np.int32),
+            "request_output_len": np.array([[args.output_len]], np.int32),
+            "streaming": np.array([[args.streaming]], np.bool_),
+        }
+    return make_request(inputs, request_id=f"stream-{stream}")
+
+
+def run(args, tmp_dir):
+    """Runs the load test, with the tiny tokenizer and socket in `tmp_dir`."""
+    trtllm = install_fake_trtllm(tokens_per_second=args.tokens_per_second,
+                                 vocab_size=args.vocab_size,
+                                 max_active_requests=args.max_active_requests)
+    tokenizer_dir = (args.tokenizer_dir or make_tiny_tokenizer(
+        os.path.join(tmp_dir, "tokenizer")) if args.fused else None)
+    args.shared_executor_address = os.path.join(tmp_dir, "executor.sock")
+    # The first instance owns the executor the others connect to
+    harnesses = [
+        make_harness(args, tokenizer_dir).initialize()
+        for _ in range(args.instances)
+    ]
+    models = [harness.model for harness in harnesses]
+    executor = models[0].executor
+    if args.instances > 1:
+        executor = executor.executor
+    locks = []
+    for model in models:
+        model.lock = TimedLock()
+        locks.append(model.lock)
+    assert isinstance(executor, trtllm.FakeExecutor)
+
+    requests = [make_stream_request(args, i) for i in range(args.streams)]
+    senders = [request.get_response_sender() for request in requests]
+    interval = (args.batch_size /
+                args.arrival_rate if args.arrival_rate else 0.0)
+    execute_seconds = []
+    generation_seconds = args.output_len / args.tokens_per_second
+    cancel_at = None
+
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    try:
+        for i in range(0, len(requests), args.batch_size):
+            model = models[i // args.batch_size % len(models)]
+            call_start = time.perf_counter()
+            model.execute(requests[i:i + args.batch_size])
+            execute_seconds.append(time.perf_counter() - call_start)
+            if interval:
+                time.sleep(max(0.0, start + (i // args.batch_size + 1) *
+                               interval - time.perf_counter()))
+        if args.cancel_fraction:
+            # Cancel a share of the streams half-way through their generation
+            cancel_at = time.perf_counter() + generation_seconds / 2
+            time.sleep(max(0.0, cancel_at - time.perf_counter()))
+            for sender in senders[::max(1, round(1 / args.cancel_fraction))]:
+                sender.cancelled = True
+        deadline = time.perf_counter() + generation_seconds * 3 + args.timeout
+        while (not all(sender.complete for sender in senders)
+               and time.perf_counter() < deadline):
+            time.sleep(0.01)
+        wall_seconds = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+    finally:
+        for harness in reversed(harnesses):
+            harness.finalize()
+
+    # Request ids are allocated in enqueue order, one per stream
+    lags = []
+    for req_id, sender in zip(executor.requests, senders):
+        lags.extend(
+            sent - produced
+            for produced, sent in zip(executor.produced_at.get(req_id, []),
+                                      sender.sent_at))
+    responses = sum(len(sender.responses) for sender in senders)
+    model_cpu_seconds = max(0.0, cpu_seconds - executor.busy_seconds)
+    last_send = max((sender.sent_at[-1] for sender in senders
+                     if sender.sent_at),
+                    default=start)
+    lock_wait_seconds = defaultdict(float)
+    lock_acquisitions = defaultdict(int)
+    for lock in locks:
+        for name, seconds in lock.wait_seconds.items():
+            lock_wait_seconds[name] += seconds
+        for name, acquisitions in lock.acquisitions.items():
+            lock_acquisitions[name] += acquisitions
+    return {
+        "streams": args.streams,
+        "instances": args.instances,
+        "completed_streams": sum(sender.complete for sender in senders),
+        "streaming": args.streaming,
+        "fused": args.fused,
+        "responses": responses,
+        "wall_seconds": wall_seconds,
+        "target_responses_per_second":
+        min(args.streams, args.max_active_requests or args.streams) *
+        args.tokens_per_second if args.streaming else 0.0,
+        "delivered_responses_per_second":
+        responses / (last_send - start) if last_send > start else 0.0,
+        "execute_p50_ms": _percentile_ms(execute_seconds, 50),
+        "execute_p99_ms": _percentile_ms(execute_seconds, 99),
+        "send_lag_p50_ms": _percentile_ms(lags, 50),
+        "send_lag_p90_ms": _percentile_ms(lags, 90),
+        "send_lag_p99_ms": _percentile_ms(lags, 99),
+        "send_lag_max_ms": max(lags) * 1000 if lags else 0.0,
+        "lock_wait_ms": {
+            name: seconds * 1000
+            for name, seconds in sorted(lock_wait_seconds.items())
+        },
+        "lock_acquisitions": dict(sorted(lock_acquisitions.items())),
+        "process_cpu_seconds": cpu_seconds,
+        "fake_executor_seconds": executor.busy_seconds,
+        "model_cpu_us_per_response":
+        model_cpu_seconds / responses * 1e6 if responses else 0.0,
+    }
+
+
+def format_result(result):
+    lines = []
+    for key, value in result.items():
+        if isinstance(value, dict):
+            value = ", ".join(f"{name}={item:.1f}" if isinstance(
+                item, float) else f"{name}={item}"
+                              for name, item in value.items())
+        elif isinstance(value, float):
+            value = f"{value:.3f}"
+        lines.append(f"{key:<32} {value}")
+    return "\n".join(lines)
+
+
+def main(args):
+    with tempfile.TemporaryDirectory(prefix="bench-tensorrt-llm-") as tmp_dir:
+        result = run(args, tmp_dir)
+    print(format_result(result))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--streams",
+                        type=int,
+                        default=2000,
+                        help="concurrent requests")
+    parser.add_argument("--tokens-per-second",
+                        type=float,
+                        default=50.0,
+                        help="tokens the fake executor generates per second "
+                        "for every active request")
+    parser.add_argument("--input-len",
+                        type=int,
+                        default=128,
+                        help="prompt tokens per request")
+    parser.add_argument("--output-len",
+                        type=int,
+                        default=64,
+                        help="tokens generated per request")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=16,
+                        help="requests per execute call")
+    parser.add_argument("--arrival-rate",
+                        type=float,
+                        default=0.0,
+                        help="requests per second, all at once if 0")
+    parser.add_argument("--max-active-requests",
+                        type=int,
+                        help="requests the fake executor generates for at "
+                        "once, unlimited by default")
+    parser.add_argument("--cancel-fraction",
+                        type=float,
+                        default=0.0,
+                        help="share of the streams cancelled half-way")
+    parser.add_argument("--cancellation-check-period-ms",
+                        type=int,
+                        default=100)
+    parser.add_argument("--no-streaming",
+                        dest="streaming",
+                        action="store_false",
+                        help="one response per request instead of per token")
+    parser.add_argument("--instances",
+                        type=int,
+                        default=1,
+                        help="model instances sharing the executor, the "
+                        "requests are spread over them")
+    parser.add_argument("--fused",
+                        action="store_true",
+                        help="run the fused pre/post processing model")
+    parser.add_argument("--collect-stats",
+                        action="store_true",
+                        help="collect the KV cache reuse and queue time "
+                        "metrics from the perf metrics of every request")
+    parser.add_argument("--tokenizer-dir",
+                        help="tokenizer of the fused model instead of the "
+                        "tiny one")
+    parser.add_argument("--vocab-size",
+                        type=int,
+                        default=512,
+                        help="token ids the fake executor generates")
+    parser.add_argument("--timeout",
+                        type=float,
+                        default=30.0,
+                        help="seconds to wait for stragglers")
+    parser.add_argument("--json", help="also write the results to this file")
+    main(parser.parse_args())
@@ -0,0 +1,456 @@
+"""
+In-process stand-in for the TensorRT-LLM executor bindings.
+
+`install_fake_trtllm` registers this module as `tensorrt_llm.bindings.executor`
+(with the few other `tensorrt_llm` modules `tensorrt_llm/1/model.py` imports),
+so the model loads on a machine without TensorRT-LLM or a GPU. The config
+classes only keep their arguments. `FakeExecutor` replaces the engine with a
+thread that emits one synthetic token per active request at a fixed rate,
+which lets the request bookkeeping of the Python model be load-tested.
+"""
+import datetime
+import enum
+import functools
+import itertools
+import sys
+import threading
+import time
+import types
+from collections import deque
+
+_TOKENS_PER_BLOCK = 64
+
+
+class _Config:
+    """Keeps the keyword arguments of a config, unset attributes are None."""
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return None
+
+
+class SchedulerConfig(_Config):
+    pass
+
+
+class KvCacheConfig(_Config):
+    pass
+
+
+class ParallelConfig(_Config):
+    pass
+
+
+class OrchestratorConfig(_Config):
+    pass
+
+
+class PeftCacheConfig(_Config):
+    pass
+
+
+class DecodingConfig(_Config):
+    pass
+
+
+class EagleConfig(_Config):
+    pass
+
+
+class ExtendedRuntimePerfKnobConfig(_Config):
+    pass
+
+
+class ExecutorConfig(_Config):
+    pass
+
+
+class ExternalDraftTokensConfig(_Config):
+    pass
+
+
+class PromptTuningConfig(_Config):
+    pass
+
+
+class LoraConfig(_Config):
+    pass
+
+
+class KvCacheRetentionConfig(_Config):
+
+    class TokenRangeRetentionConfig(_Config):
+        pass
+
+
+class GuidedDecodingConfig(_Config):
+
+    class GuidedDecodingBackend(enum.Enum):
+        XGRAMMAR = 0
+
+
+class GuidedDecodingParams(_Config):
+
+    class GuideType(enum.Enum):
+        JSON = 0
+        JSON_SCHEMA = 1
+        REGEX = 2
+        EBNF_GRAMMAR = 3
+
+
+class SamplingConfig(_Config):
+
+    def __init__(self, beam_width=1, num_return_sequences=None, **kwargs):
+        super().__init__(beam_width=beam_width,
+                         num_return_sequences=num_return_sequences,
+                         **kwargs)
+
+
+class OutputConfig(_Config):
+
+    def __init__(self, exclude_input_from_output=False, **kwargs):
+        super().__init__(exclude_input_from_output=exclude_input_from_output,
+                         **kwargs)
+
+
+class Request(_Config):
+
+    def __init__(self,
+                 input_token_ids,
+                 max_new_tokens,
+                 streaming=False,
+                 sampling_config=None,
+                 output_config=None,
+                 **kwargs):
+        super().__init__(input_token_ids=input_token_ids,
+                         max_new_tokens=max_new_tokens,
+                         streaming=bool(streaming),
+                         sampling_config=sampling_config or SamplingConfig(),
+                         output_config=output_config or OutputConfig(),
+                         **kwargs)
+
+
+class CapacitySchedulerPolicy(enum.Enum):
+    MAX_UTILIZATION = 0
+    GUARANTEED_NO_EVICT = 1
+
+
+class BatchingType(enum.Enum):
+    STATIC = 0
+    INFLIGHT = 1
+
+
+class CommunicationMode(enum.Enum):
+    LEADER = 0
+    ORCHESTRATOR = 1
+
+
+class ModelType(enum.Enum):
+    DECODER_ONLY = 0
+    ENCODER_ONLY = 1
+    ENCODER_DECODER = 2
+
+
+class DecodingMode:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"DecodingMode.{self.name}"
+
+
+for _mode in ("Auto", "TopK", "TopP", "TopKTopP", "BeamSearch", "Medusa",
+              "ExplicitDraftTokens", "Lookahead", "Eagle"):
+    setattr(DecodingMode, _mode,
+            staticmethod(functools.partial(DecodingMode, _mode)))
+
+
+class Result:
+
+    def __init__(self, output_token_ids, is_final, sequence_index=0):
+        self.output_token_ids = output_token_ids
+        self.is_final = is_final
+        self.is_sequence_final = is_final
+        self.sequence_index = sequence_index
+        self.cum_log_probs = None
+        self.log_probs = None
+        self.context_logits = None
+        self.generation_logits = None
+        self.request_perf_metrics = None
+
+
+class Response:
+
+    def __init__(self, request_id, result=None, error_msg=None):
+        self.request_id = request_id
+        self.result = result
+        self.error_msg = error_msg
+
+    def has_error(self):
+        return self.error_msg is not None
+
+
+class _Stats:
+    """
+    Keeps the keyword arguments of stats, other attributes are missing like
+    in the bindings.
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class IterationStats(_Stats):
+    pass
+
+
+class KvCacheStats(_Stats):
+    pass
+
+
+class InflightBatchingStats(_Stats):
+    pass
+
+
+class _ActiveRequest:
+    __slots__ = ("request", "generated", "tokens", "produced_at",
+                 "perf_metrics")
+
+    def __init__(self, request, perf_metrics=None):
+        self.request = request
+        self.generated = 0
+        self.tokens = []
+        self.produced_at = []
+        self.perf_metrics = perf_metrics
+
+
+def _perf_metrics(request, arrival_time, first_scheduled_time):
+    """
+    The perf metrics of a request that set `return_perf_metrics`: the
+    times it was enqueued and scheduled, and one new KV cache block per
+    `_TOKENS_PER_BLOCK` prompt tokens.
+    """
+    num_blocks = len(request.input_token_ids) // _TOKENS_PER_BLOCK + 1
+    return _Config(
+        timing_metrics=_Config(
+            arrival_time=datetime.timedelta(seconds=arrival_time),
+            first_scheduled_time=datetime.timedelta(
+                seconds=first_scheduled_time)),
+        kv_cache_metrics=_Config(num_new_allocated_blocks=num_blocks,
+                                 num_reused_blocks=0,
+                                 num_total_allocated_blocks=num_blocks))
+
+
+class FakeExecutor:
+    """
+    Generates `tokens_per_second` tokens per second for every active request,
+    one engine iteration every `1 / tokens_per_second` seconds, until its
+    `max_new_tokens`. Streaming requests get a response per token, the others
+    one final response with all their tokens. The responses of requests that
+    set `return_perf_metrics` carry their perf metrics.
+
+    `requests` and `produced_at` keep every enqueued request and the time
+    each of its responses was produced, by request id, so the benchmarks can
+    compute the delay until the model sends them. `busy_seconds` is the time
+    spent generating, to tell the cost of the fake from the model's.
+    """
+
+    def __init__(self,
+                 model_path=None,
+                 model_type=None,
+                 executor_config=None,
+                 tokens_per_second=50.0,
+                 vocab_size=32000,
+                 max_active_requests=None):
+        self.executor_config = executor_config
+        self.iteration_seconds = 1.0 / tokens_per_second
+        self.vocab_size = vocab_size
+        self.max_active_requests = max_active_requests
+        self.request_ids = itertools.count(1)
+        self.pending = deque()
+        self.active = {}
+        self.cancelled = set()
+        self.responses = deque()
+        self.stats = deque(maxlen=1000)
+        self.requests = {}
+        self.produced_at = {}
+        self.busy_seconds = 0.0
+        self.iterations = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._engine_loop,
+                                       name="fake-executor",
+                                       daemon=True)
+        self.thread.start()
+
+    def can_enqueue_requests(self):
+        return self.running
+
+    def enqueue_requests(self, requests):
+        request_ids = []
+        with self.condition:
+            for request in requests:
+                request_id = next(self.request_ids)
+                self.pending.append(
+                    (request_id, request, time.perf_counter()))
+                self.requests[request_id] = request
+                request_ids.append(request_id)
+        return request_ids
+
+    def enqueue_request(self, request):
+        return self.enqueue_requests([request])[0]
+
+    def cancel_request(self, request_id):
+        with self.condition:
+            self.cancelled.add(request_id)
+
+    def await_responses(self, timeout=None):
+        with self.condition:
+            if not self.responses:
+                self.condition.wait(
+                    timeout.total_seconds() if timeout is not None else None)
+            responses = list(self.responses)
+            self.responses.clear()
+        return responses
+
+    def get_latest_iteration_stats(self):
+        with self.condition:
+            stats = list(self.stats)
+            self.stats.clear()
+        return stats
+
+    def shutdown(self):
+        self.running = False
+        self.thread.join()
+
+    def _engine_loop(self):
+        next_iteration = time.perf_counter()
+        while self.running:
+            next_iteration += self.iteration_seconds
+            start = time.perf_counter()
+            self._iteration()
+            self.busy_seconds += time.perf_counter() - start
+            delay = next_iteration - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # The engine can't keep up, don't try to catch up
+                next_iteration = time.perf_counter()
+
+    def _iteration(self):
+        with self.condition:
+            while self.pending and (self.max_active_requests is None
+                                    or len(self.active)
+                                    < self.max_active_requests):
+                request_id, request, arrival_time = self.pending.popleft()
+                self.active[request_id] = _ActiveRequest(
+                    request,
+                    _perf_metrics(request, arrival_time, time.perf_counter())
+                    if request.output_config.return_perf_metrics else None)
+                self.produced_at[request_id] = []
+            cancelled = self.cancelled
+            self.cancelled = set()
+
+        now = time.perf_counter()
+        responses = []
+        finished = []
+        for request_id, active in self.active.items():
+            request = active.request
+            token = (request_id + active.generated) % self.vocab_size
+            active.generated += 1
+            is_final = (active.generated >= request.max_new_tokens
+                        or request_id in cancelled)
+            result = None
+            if request.streaming:
+                result = Result([[token]], is_final)
+            else:
+                active.tokens.append(token)
+                if is_final:
+                    result = Result([active.tokens], True)
+            if result is not None:
+                result.request_perf_metrics = active.perf_metrics
+                responses.append(Response(request_id, result))
+            if request.streaming or is_final:
+                self.produced_at[request_id].append(now)
+            if is_final:
+                finished.append(request_id)
+        for request_id in finished:
+            del self.active[request_id]
+
+        self.iterations += 1
+        stats = IterationStats(
+            timestamp=datetime.datetime.now().strftime(
+                "%m-%d-%Y %H:%M:%S.%f"),
+            iter=self.iterations,
+            num_active_requests=len(self.active),
+            max_num_active_requests=self.max_active_requests or 0,
+            cpu_mem_usage=0,
+            gpu_mem_usage=0,
+            pinned_mem_usage=0,
+            kv_cache_stats=KvCacheStats(max_num_blocks=0,
+                                        free_num_blocks=0,
+                                        used_num_blocks=0,
+                                        tokens_per_block=0),
+            static_batching_stats=None,
+            inflight_batching_stats=InflightBatchingStats(
+                num_scheduled_requests=len(self.active),
+                num_context_requests=0,
+                num_ctx_tokens=0,
+                num_gen_requests=len(self.active),
+                micro_batch_id=0,
+                num_paused_requests=0))
+        with self.condition:
+            self.responses.extend(responses)
+            self.stats.append(stats)
+            if responses:
+                self.condition.notify_all()
+
+
+Executor = FakeExecutor
+
+
+def _xgrammar_tokenizer_info(tokenizer):
+    raise NotImplementedError(
+        "Guided decoding is not supported by the fake executor")
+
+
+def install_fake_trtllm(executor_factory=None, **executor_options):
+    """
+    Registers the fake `tensorrt_llm` modules. `trtllm.Executor` becomes
+    `executor_factory`, by default `FakeExecutor` with `executor_options`.
+    Returns this module.
+    """
+    module = sys.modules[__name__]
+    module.Executor = executor_factory or functools.partial(
+        FakeExecutor, **executor_options)
+
+    logger = types.ModuleType("tensorrt_llm.logger")
+    for level in ("debug", "info", "warning", "error"):
+        setattr(logger, level, lambda *args, **kwargs: None)
+    tokenizer = types.ModuleType("tensorrt_llm.llmapi.tokenizer")
+    tokenizer._xgrammar_tokenizer_info = _xgrammar_tokenizer_info
+    llmapi = types.ModuleType("tensorrt_llm.llmapi")
+    llmapi.tokenizer = tokenizer
+    bindings = types.ModuleType("tensorrt_llm.bindings")
+    bindings.executor = module
+    package = types.ModuleType("tensorrt_llm")
+    package.__path__ = []
+    package.bindings = bindings
+    package.llmapi = llmapi
+    package.logger = logger
+
+    sys.modules.update({
+        "tensorrt_llm": package,
+        "tensorrt_llm.bindings": bindings,
+        "tensorrt_llm.bindings.executor": module,
+        "tensorrt_llm.llmapi": llmapi,
+        "tensorrt_llm.llmapi.tokenizer": tokenizer,
+        "tensorrt_llm.logger": logger,
+    })
+    return module
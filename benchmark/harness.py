@@ -0,0 +1,377 @@
+"""
+Runs the Triton Python models of this repository in-process.
+
+`ModelHarness` loads a model directory the way the Python backend does: the
+config.pbtxt is filled like `src/fill_template.py` does, converted to the JSON
+model config handed to `initialize`, and `1/model.py` is imported with the
+fake `triton_python_backend_utils` from `benchmark.pb_utils`. `measure` times
+`execute` over a list of request batches and traces its allocations.
+"""
+import importlib.util
+import json
+import os
+import re
+import statistics
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from string import Template
+
+import numpy as np
+
+from benchmark import pb_utils
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+LLAMA_REPOSITORY = os.path.join(ROOT_DIR, "meta-llama-3.1-8B-Instruct",
+                                "raw-repository")
+NV_EMBED_REPOSITORY = os.path.join(ROOT_DIR, "nv-embed-v2", "repository")
+
+# Fields of the model config that are lists in the JSON model config even
+# when the config.pbtxt only has one of them.
+REPEATED_FIELDS = {
+    "input", "output", "parameters", "instance_group", "step", "input_map",
+    "output_map"
+}
+
+PBTXT_TOKEN = re.compile(r'\s*(?:#[^\n]*|("(?:[^"\\]|\\.)*")|([{}\[\]:,])|'
+                         r'([^\s{}\[\]:,"#]+))')
+
+
+def install_pb_utils():
+    """Makes `import triton_python_backend_utils` return the fake module."""
+    sys.modules["triton_python_backend_utils"] = pb_utils
+    return pb_utils
+
+
+def _tokenize_pbtxt(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = PBTXT_TOKEN.match(text, pos)
+        if match is None or match.end() == pos:
+            raise ValueError(f"Invalid config.pbtxt near: {text[pos:pos + 40]}")
+        pos = match.end()
+        string, punctuation, word = match.groups()
+        if string is not None:
+            tokens.append(("value", json.loads(string)))
+        elif punctuation is not None:
+            tokens.append(("punctuation", punctuation))
+        elif word is not None:
+            tokens.append(("word", word))
+    return tokens
+
+
+def _parse_word(word):
+    if word in ("true", "True"):
+        return True
+    if word in ("false", "False"):
+        return False
+    for pytype in (int, float):
+        try:
+            return pytype(word)
+        except ValueError:
+            pass
+    return word
+
+
+def parse_pbtxt(text):
+    """Parses a filled config.pbtxt into the JSON model config of Triton."""
+    tokens = _tokenize_pbtxt(text)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        pos += 1
+        return tokens[pos - 1]
+
+    def parse_value():
+        kind, token = take()
+        if (kind, token) == ("punctuation", "{"):
+            return parse_message("}")
+        if (kind, token) == ("punctuation", "["):
+            values = []
+            while peek() != ("punctuation", "]"):
+                values.append(parse_value())
+                if peek() == ("punctuation", ","):
+                    take()
+            take()
+            return values
+        return _parse_word(token) if kind == "word" else token
+
+    def parse_message(end):
+        message = {}
+        while peek() is not None and peek() != ("punctuation", end):
+            _, name = take()
+            if peek() == ("punctuation", ":"):
+                take()
+            value = parse_value()
+            if peek() == ("punctuation", ","):
+                take()
+            if name in REPEATED_FIELDS:
+                message.setdefault(name, []).extend(
+                    value if isinstance(value, list) else [value])
+            else:
+                message[name] = value
+        if end is not None:
+            take()
+        return message
+
+    model_config = parse_message(None)
+    model_config["parameters"] = {
+        parameter["key"]: parameter["value"]
+        for parameter in model_config.get("parameters", [])
+    }
+    return model_config
+
+
+def load_model_config(model_dir, substitutions=None, parameters=None):
+    """
+    Returns the JSON model config of `model_dir`. `substitutions` fill the
+    `${...}` placeholders like `src/fill_template.py`; `parameters` override
+    the string value of parameters afterwards.
+    """
+    with open(os.path.join(model_dir, "config.pbtxt")) as f:
+        template = Template(f.read())
+    text = template.safe_substitute({
+        "max_queue_size": 0,
+        "max_queue_delay_microseconds": 0,
+        **(substitutions or {})
+    })
+    model_config = parse_pbtxt(text)
+    model_config.setdefault("name", os.path.basename(model_dir))
+    for key, value in (parameters or {}).items():
+        model_config["parameters"][key] = {"string_value": str(value)}
+    return model_config
+
+
+def load_model_module(model_dir, version="1"):
+    """Imports `<model_dir>/<version>/model.py` as a new module."""
+    install_pb_utils()
+    model_path = os.path.join(model_dir, version, "model.py")
+    module_name = "benchmark_model_" + re.sub(
+        r"\W", "_", os.path.relpath(model_dir, ROOT_DIR))
+    spec = importlib.util.spec_from_file_location(module_name, model_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class ModelHarness:
+    """Drives `initialize`, `execute` and `finalize` of one model directory.
+
+    `patch` is called with the imported module before `initialize`, to
+    replace what can't run on a CPU-only machine, e.g. model weights.
+    """
+
+    def __init__(self,
+                 model_dir,
+                 substitutions=None,
+                 parameters=None,
+                 patch=None):
+        self.model_dir = model_dir
+        self.model_config = load_model_config(model_dir, substitutions,
+                                              parameters)
+        self.module = load_model_module(model_dir)
+        if patch is not None:
+            patch(self.module)
+        self.model = None
+
+    def initialize(self):
+        self.model = self.module.TritonPythonModel()
+        self.model.initialize({
+            "model_config": json.dumps(self.model_config),
+            "model_instance_kind": "CPU",
+            "model_instance_device_id": "0",
+            "model_repository": os.path.dirname(self.model_dir),
+            "model_version": "1",
+            "model_name": self.model_config["name"],
+        })
+        return self
+
+    def execute(self, requests):
+        return self.model.execute(requests)
+
+    def finalize(self):
+        if hasattr(self.model, "finalize"):
+            self.model.finalize()
+
+    def __enter__(self):
+        return self.initialize()
+
+    def __exit__(self, *exc_info):
+        self.finalize()
+
+
+def make_request(inputs, request_id="", parameters=None):
+    """
+    Builds a request from a dict of input name to NumPy array and a dict of
+    request parameters.
+    """
+    return pb_utils.InferenceRequest(
+        [pb_utils.Tensor(name, array) for name, array in inputs.items()],
+        request_id, parameters)
+
+
+def string_tensor(texts, batched=True):
+    """Encodes `texts` as a TYPE_STRING array, [1, len(texts)] if batched."""
+    array = np.array([text.encode("utf8") for text in texts], dtype=object)
+    return array.reshape(1, -1) if batched else array
+
+
+def wait_for_responses(request, timeout=10.0):
+    """
+    Waits until a decoupled model sent the final flag of `request` and
+    returns its responses.
+    """
+    sender = request.get_response_sender()
+    deadline = time.monotonic() + timeout
+    while not sender.complete:
+        if time.monotonic() > deadline:
+            raise TimeoutError(
+                f"Request did not complete within {timeout} seconds")
+        time.sleep(0.005)
+    return sender.responses
+
+
+# Short English and multilingual passages the tiny tokenizer is trained on
+# and the benchmarks build their prompts from.
+CORPUS = [
+    "The quick brown fox jumps over the lazy dog near the river bank.",
+    "Triton Inference Server runs models from many frameworks on CPUs and GPUs.",
+    "Tokenizers split text into tokens and detokenizers join them back into text.",
+    "Large language models generate one token at a time until a stop condition.",
+    "Embedding models map passages to vectors used for semantic search.",
+    "Dynamic batching groups requests together to make better use of hardware.",
+    "Please summarize the following document in three short sentences.",
+    "What is the capital of France? The capital of France is Paris.",
+    "Streaming responses send every new token to the client as soon as possible.",
+    "日本語のテキストもトークン化できます。",
+    "Los modelos de lenguaje también hablan español y otros idiomas.",
+    "Emoji such as 🚀 and 🎉 span several bytes in UTF-8.",
+]
+
+
+def make_tiny_tokenizer(output_dir, vocab_size=512):
+    """
+    Trains a byte-level BPE tokenizer on `CORPUS` and saves it with the
+    Llama 3 special tokens to `output_dir`, which the caller removes. Needs
+    no download and loads in milliseconds, while exercising the same fast
+    tokenizer code paths as the real ones.
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from tokenizers import processors, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    special_tokens = ["<|begin_of_text|>", "<|eot_id|>", "<|pad|>"]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(
+        CORPUS * 4,
+        trainers.BpeTrainer(
+            vocab_size=vocab_size,
+            special_tokens=special_tokens,
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+    bos_id = tokenizer.token_to_id("<|begin_of_text|>")
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="<|begin_of_text|> $A",
+        pair="<|begin_of_text|> $A $B",
+        special_tokens=[("<|begin_of_text|>", bos_id)])
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer,
+                            bos_token="<|begin_of_text|>",
+                            eos_token="<|eot_id|>",
+                            pad_token="<|pad|>").save_pretrained(output_dir)
+    return output_dir
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    calls: int
+    requests: int
+    seconds: float
+    p50_ms: float
+    p90_ms: float
+    p99_ms: float
+    requests_per_second: float
+    peak_kib_per_call: float
+    retained_kib: float
+
+    def as_dict(self):
+        return asdict(self)
+
+
+def _percentile(values, percentile):
+    return float(np.percentile(values, percentile)) if values else 0.0
+
+
+def measure(name, harness, batches, warmup=1):
+    """
+    Executes every batch of requests `warmup` times untimed, once timed and
+    once under tracemalloc, and returns the latency of the `execute` calls,
+    the request throughput, the mean peak of memory allocated during a call
+    and the memory still allocated after the traced pass.
+
+    `batches` is a callable returning a fresh list of request lists, since
+    requests carry the responses sent for them.
+    """
+    for _ in range(warmup):
+        for requests in batches():
+            harness.execute(requests)
+
+    latencies = []
+    num_requests = 0
+    timed_batches = batches()
+    start = time.perf_counter()
+    for requests in timed_batches:
+        call_start = time.perf_counter()
+        harness.execute(requests)
+        latencies.append((time.perf_counter() - call_start) * 1000)
+        num_requests += len(requests)
+    seconds = time.perf_counter() - start
+
+    traced_batches = batches()
+    peaks = []
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        for requests in traced_batches:
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            harness.execute(requests)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return BenchmarkResult(
+        name=name,
+        calls=len(latencies),
+        requests=num_requests,
+        seconds=seconds,
+        p50_ms=_percentile(latencies, 50),
+        p90_ms=_percentile(latencies, 90),
+        p99_ms=_percentile(latencies, 99),
+        requests_per_second=num_requests / seconds if seconds else 0.0,
+        peak_kib_per_call=statistics.fmean(peaks) / 1024 if peaks else 0.0,
+        retained_kib=(retained - baseline) / 1024)
+
+
+def format_results(results):
+    lines = [
+        f"{'benchmark':<32} {'calls':>6} {'p50 ms':>8} {'p90 ms':>8} "
+        f"{'p99 ms':>8} {'req/s':>10} {'peak KiB':>9} {'kept KiB':>9}"
+    ]
+    for result in results:
+        lines.append(
+            f"{result.name:<32} {result.calls:>6} {result.p50_ms:>8.3f} "
+            f"{result.p90_ms:>8.3f} {result.p99_ms:>8.3f} "
+            f"{result.requests_per_second:>10.1f} "
+            f"{result.peak_kib_per_call:>9.1f} {result.retained_kib:>9.1f}")
+    return "\n".join(lines)
@@ -0,0 +1,238 @@
+"""
+In-process stand-in for `triton_python_backend_utils`.
+
+Implements the part of the Python backend API the models of this repository
+use, so their `initialize`, `execute` and `finalize` can run without a Triton
+server. `benchmark.harness.install_pb_utils` registers this module under the
+name the models import.
+"""
+import json
+import time
+
+import numpy as np
+
+TRITONSERVER_RESPONSE_COMPLETE_FINAL = 1
+
+TRITON_STRING_TO_NUMPY = {
+    "TYPE_BOOL": np.bool_,
+    "TYPE_UINT8": np.uint8,
+    "TYPE_UINT16": np.uint16,
+    "TYPE_UINT32": np.uint32,
+    "TYPE_UINT64": np.uint64,
+    "TYPE_INT8": np.int8,
+    "TYPE_INT16": np.int16,
+    "TYPE_INT32": np.int32,
+    "TYPE_INT64": np.int64,
+    "TYPE_FP16": np.float16,
+    "TYPE_FP32": np.float32,
+    "TYPE_FP64": np.float64,
+    "TYPE_STRING": np.object_,
+}
+
+
+class TritonModelException(Exception):
+    pass
+
+
+class TritonError:
+
+    def __init__(self, message, code=None):
+        self._message = str(message)
+        self._code = code
+
+    def message(self):
+        return self._message
+
+    def code(self):
+        return self._code
+
+
+class Tensor:
+    """A named CPU tensor backed by a NumPy array."""
+
+    def __init__(self, name, array):
+        self._name = name
+        self._array = array
+
+    def name(self):
+        return self._name
+
+    def as_numpy(self):
+        return self._array
+
+    def is_cpu(self):
+        return True
+
+    def to_dlpack(self):
+        return self._array.__dlpack__()
+
+    @classmethod
+    def from_dlpack(cls, name, tensor):
+        return cls(name, np.from_dlpack(tensor))
+
+
+class InferenceResponse:
+
+    def __init__(self, output_tensors=None, error=None):
+        self._output_tensors = list(output_tensors or [])
+        self._error = error
+
+    def output_tensors(self):
+        return self._output_tensors
+
+    def has_error(self):
+        return self._error is not None
+
+    def error(self):
+        return self._error
+
+
+class InferenceResponseSender:
+    """
+    Collects the responses a decoupled model sends for one request, and the
+    `time.perf_counter` at which each was sent.
+    """
+
+    def __init__(self):
+        self.responses = []
+        self.sent_at = []
+        self.complete = False
+        self.cancelled = False
+
+    def send(self, response=None, flags=0):
+        if self.complete:
+            raise TritonModelException(
+                "Unable to send a response after the final flag")
+        if response is not None:
+            self.responses.append(response)
+            self.sent_at.append(time.perf_counter())
+        if flags & TRITONSERVER_RESPONSE_COMPLETE_FINAL:
+            self.complete = True
+
+    def is_cancelled(self):
+        return self.cancelled
+
+
+class InferenceRequest:
+    """A request as the backend hands it to `execute`."""
+
+    def __init__(self, inputs, request_id="", parameters=None):
+        self._inputs = list(inputs)
+        self._request_id = request_id
+        self._parameters = json.dumps(parameters or {})
+        self._response_sender = InferenceResponseSender()
+
+    def inputs(self):
+        return self._inputs
+
+    def request_id(self):
+        return self._request_id
+
+    def parameters(self):
+        return self._parameters
+
+    def get_response_sender(self):
+        return self._response_sender
+
+    def is_cancelled(self):
+        return self._response_sender.cancelled
+
+
+class Metric:
+
+    def __init__(self, labels, buckets=None):
+        self.labels = labels
+        self.buckets = buckets
+        self._value = 0
+        self.observations = []
+
+    def increment(self, value):
+        self._value += value
+
+    def set(self, value):
+        self._value = value
+
+    def observe(self, value):
+        self.observations.append(value)
+
+    def value(self):
+        return self._value
+
+
+class MetricFamily:
+    COUNTER = "counter"
+    GAUGE = "gauge"
+    HISTOGRAM = "histogram"
+
+    def __init__(self, name, description, kind):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.metrics = []
+
+    def Metric(self, labels=None, buckets=None):
+        metric = Metric(labels or {}, buckets)
+        self.metrics.append(metric)
+        return metric
+
+
+class Logger:
+    """Drops log messages, the benchmarks only report their own results."""
+
+    @staticmethod
+    def log(message, level=None):
+        pass
+
+    @staticmethod
+    def log_info(message):
+        pass
+
+    @staticmethod
+    def log_warn(message):
+        pass
+
+    @staticmethod
+    def log_error(message):
+        pass
+
+    @staticmethod
+    def log_verbose(message):
+        pass
+
+
+def get_input_tensor_by_name(inference_request, name):
+    for input_tensor in inference_request.inputs():
+        if input_tensor.name() == name:
+            return input_tensor
+    return None
+
+
+def get_output_tensor_by_name(inference_response, name):
+    for output_tensor in inference_response.output_tensors():
+        if output_tensor.name() == name:
+            return output_tensor
+    return None
+
+
+def get_input_config_by_name(model_config, name):
+    for input_config in model_config.get("input", []):
+        if input_config["name"] == name:
+            return input_config
+    return None
+
+
+def get_output_config_by_name(model_config, name):
+    for output_config in model_config.get("output", []):
+        if output_config["name"] == name:
+            return output_config
+    return None
+
+
+def triton_string_to_numpy(triton_type_string):
+    return TRITON_STRING_TO_NUMPY[triton_type_string]
+
+
+def using_decoupled_model_transaction_policy(model_config):
+    return bool(
+        model_config.get("model_transaction_policy",
+                         {}).get("decoupled", False))
@@ -0,0 +1,8 @@
+import pytest
+
+from benchmark.harness import make_tiny_tokenizer
+
+
+@pytest.fixture(scope="session")
+def tokenizer_dir(tmp_path_factory):
+    return make_tiny_tokenizer(str(tmp_path_factory.mktemp("tokenizer")))
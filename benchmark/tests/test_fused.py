@@ -0,0 +1,177 @@
+"""
+Checks that the fused model answers like the preprocessing, tensorrt_llm and
+postprocessing models of the ensemble, on `fake_trtllm.FakeExecutor`.
+"""
+import os
+
+import numpy as np
+import pytest
+
+from benchmark.fake_trtllm import install_fake_trtllm
+from benchmark.harness import (CORPUS, LLAMA_REPOSITORY, ModelHarness,
+                               make_request, string_tensor,
+                               wait_for_responses)
+
+OUTPUT_LEN = 12
+
+TENSORRT_LLM_SUBSTITUTIONS = {
+    "triton_backend": "python",
+    "triton_max_batch_size": 8,
+    "decoupled_mode": True,
+    "max_beam_width": 1,
+    "engine_dir": "",
+    "batching_strategy": "inflight_fused_batching",
+    "exclude_input_in_output": True,
+    "logits_datatype": "TYPE_FP32",
+    "tensorrt_llm_instance_count": 1,
+}
+
+
+@pytest.fixture(scope="module", autouse=True)
+def fake_trtllm():
+    return install_fake_trtllm(tokens_per_second=1000, vocab_size=500)
+
+
+def output(response, name):
+    for tensor in response.output_tensors():
+        if tensor.name() == name:
+            return tensor.as_numpy()
+    return None
+
+
+def run_ensemble(tokenizer_dir, text, stop_words, bias_words, bias_weights):
+    """
+    Runs `text` through the models of the ensemble, mapping their tensors the
+    way llama-3.1-8b-instruct/config.pbtxt does. Returns the executor request
+    and the streamed text.
+    """
+    with ModelHarness(os.path.join(LLAMA_REPOSITORY, "preprocessing"),
+                      substitutions={
+                          "tokenizer_dir": tokenizer_dir,
+                          "triton_max_batch_size": 8,
+                          "preprocessing_instance_count": 1,
+                          "add_special_tokens": True,
+                          "sparse_embedding_bias": False,
+                      }) as preprocessing:
+        preprocessed, = preprocessing.execute([
+            make_request({
+                "QUERY": string_tensor([text]),
+                "REQUEST_OUTPUT_LEN": np.array([[OUTPUT_LEN]], np.int32),
+                "STOP_WORDS_DICT": string_tensor(stop_words),
+                "EMBEDDING_BIAS_WORDS": string_tensor(bias_words),
+                "EMBEDDING_BIAS_WEIGHTS": np.array([bias_weights],
+                                                   np.float32),
+            })
+        ])
+    inputs = {
+        name: output(preprocessed, preprocessed_name)
+        for name, preprocessed_name in (
+            ("input_ids", "INPUT_ID"),
+            ("input_lengths", "REQUEST_INPUT_LEN"),
+            ("request_output_len", "REQUEST_OUTPUT_LEN"),
+            ("end_id", "OUT_END_ID"),
+            ("pad_id", "OUT_PAD_ID"),
+            ("stop_words_list", "STOP_WORDS_IDS"),
+            ("embedding_bias", "EMBEDDING_BIAS"),
+        )
+    }
+    inputs["streaming"] = np.array([[True]], np.bool_)
+
+    with ModelHarness(os.path.join(LLAMA_REPOSITORY, "tensorrt_llm"),
+                      substitutions=TENSORRT_LLM_SUBSTITUTIONS) as tensorrt_llm:
+        request = make_request(inputs)
+        tensorrt_llm.execute([request])
+        responses = wait_for_responses(request)
+        executor_request, = tensorrt_llm.model.executor.requests.values()
+
+    with ModelHarness(os.path.join(LLAMA_REPOSITORY, "postprocessing"),
+                      substitutions={
+                          "tokenizer_dir": tokenizer_dir,
+                          "triton_max_batch_size": 8,
+                          "postprocessing_instance_count": 1,
+                          "skip_special_tokens": True,
+                          "enable_incremental_detokenization": True,
+                          "incremental_detokenizer_max_states": 16,
+                      }) as postprocessing:
+        texts = []
+        for response in responses:
+            postprocessed, = postprocessing.execute([
+                make_request({
+                    "TOKENS_BATCH": output(response, "output_ids"),
+                    "SEQUENCE_LENGTH": output(response, "sequence_length"),
+                    "IS_FINAL": output(response, "is_final"),
+                    "STREAM_ID": output(response, "stream_id"),
+                })
+            ])
+            texts.append(output(postprocessed, "OUTPUT").item(0))
+    return executor_request, b"".join(texts)
+
+
+def make_fused_harness(tokenizer_dir):
+    return ModelHarness(os.path.join(LLAMA_REPOSITORY,
+                                     "llama-3.1-8b-instruct-fused"),
+                        substitutions={
+                            **TENSORRT_LLM_SUBSTITUTIONS,
+                            "tokenizer_dir": tokenizer_dir,
+                            "add_special_tokens": True,
+                            "skip_special_tokens": True,
+                            "incremental_detokenizer_max_states": 16,
+                        })
+
+
+def fused_request(text, stop_words=(), bias_words=(), bias_weights=()):
+    inputs = {
+        "text_input": string_tensor([text]),
+        "max_tokens": np.array([[OUTPUT_LEN]], np.int32),
+        "stream": np.array([[True]], np.bool_),
+    }
+    if stop_words:
+        inputs["stop_words"] = string_tensor(stop_words)
+    if bias_words:
+        inputs["embedding_bias_words"] = string_tensor(bias_words)
+        inputs["embedding_bias_weights"] = np.array([bias_weights],
+                                                    np.float32)
+    return make_request(inputs)
+
+
+def test_fused_matches_ensemble(tokenizer_dir):
+    text = CORPUS[0]
+    stop_words = ["lazy dog", "\n\n"]
+    bias_words = ["fox", "river"]
+    bias_weights = [2.0, -1.5]
+    ensemble_request, ensemble_text = run_ensemble(tokenizer_dir, text,
+                                                   stop_words, bias_words,
+                                                   bias_weights)
+
+    with make_fused_harness(tokenizer_dir) as fused:
+        request = fused_request(text, stop_words, bias_words, bias_weights)
+        fused.execute([request])
+        responses = wait_for_responses(request)
+        fused_request_, = fused.model.executor.requests.values()
+    fused_text = b"".join(
+        output(response, "text_output").item(0) for response in responses)
+
+    assert np.array_equal(fused_request_.input_token_ids,
+                          ensemble_request.input_token_ids)
+    assert fused_request_.stop_words == ensemble_request.stop_words
+    assert np.array_equal(fused_request_.embedding_bias.numpy(),
+                          ensemble_request.embedding_bias.numpy())
+    assert fused_text == ensemble_text
+    assert len(fused_text) > 0
+
+
+def test_fused_fails_only_the_request_that_cannot_be_tokenized(
+        tokenizer_dir):
+    with make_fused_harness(tokenizer_dir) as fused:
+        bad = make_request({
+            "text_input": np.array([[b"\xff\xfe"]], dtype=object),
+            "max_tokens": np.array([[OUTPUT_LEN]], np.int32),
+            "stream": np.array([[True]], np.bool_),
+        })
+        good = fused_request(CORPUS[1])
+        fused.execute([bad, good])
+        bad_responses = wait_for_responses(bad)
+        good_responses = wait_for_responses(good)
+    assert len(bad_responses) == 1 and bad_responses[0].has_error()
+    assert not any(response.has_error() for response in good_responses)
+    assert len(good_responses) == OUTPUT_LEN
@@ -0,0 +1,83 @@
+"""
+Checks the chunking of the nv-embed-v2 model, with the weights replaced by
+`bench_models.FakeNVEmbedModel`.
+"""
+import os
+
+import numpy as np
+import pytest
+
+from benchmark import pb_utils
+from benchmark.bench_models import patch_nv_embed
+from benchmark.harness import (CORPUS, NV_EMBED_REPOSITORY, ModelHarness,
+                               make_request, string_tensor)
+
+
+def make_harness(tokenizer_dir, **parameters):
+    return ModelHarness(os.path.join(NV_EMBED_REPOSITORY, "nv-embed-v2"),
+                        parameters={
+                            "model_path": tokenizer_dir,
+                            "embedding_cache_memory_mb": "0",
+                            "embedding_cache_disk_entries": "0",
+                            **parameters,
+                        },
+                        patch=patch_nv_embed)
+
+
+def test_windows_repeat_only_the_instruction(tokenizer_dir):
+    with make_harness(tokenizer_dir,
+                      chunk_threshold_tokens="16",
+                      chunk_tokens="8",
+                      chunk_overlap_tokens="0") as nv_embed:
+        model = nv_embed.model
+        tokenizer = model.tokenizer
+        prefix = model.instructions["query"]
+        text = " ".join(CORPUS[:3])
+        input_ids = tokenizer(prefix + text + tokenizer.eos_token)["input_ids"]
+        windows = model.split_tokens(input_ids, prefix)
+
+    assert len(windows) > 1
+    texts = []
+    for window in windows:
+        decoded = tokenizer.decode(window, skip_special_tokens=True)
+        # The space ending the prefix is tokenized with the text
+        assert decoded.startswith(prefix.rstrip())
+        texts.append(decoded[len(prefix.rstrip()):])
+    assert "".join(texts) == " " + text
+
+
+def test_windows_must_fit_in_max_length(tokenizer_dir):
+    with pytest.raises(ValueError, match="chunk_tokens"):
+        make_harness(tokenizer_dir,
+                     max_length="64",
+                     chunk_threshold_tokens="32",
+                     chunk_tokens="60",
+                     chunk_overlap_tokens="0").initialize()
+
+
+def embed(nv_embed, texts):
+    responses = nv_embed.execute([
+        make_request({
+            "input_text": string_tensor([text]),
+            "input_type": string_tensor(["passage"]),
+        }) for text in texts
+    ])
+    return [
+        pb_utils.get_output_tensor_by_name(response, "embeddings").as_numpy()
+        for response in responses
+    ]
+
+
+def test_embedding_cache_hits(tokenizer_dir):
+    with make_harness(tokenizer_dir,
+                      embedding_cache_memory_mb="16") as nv_embed:
+        first = embed(nv_embed, CORPUS[:2])
+        # The fake model returns new random embeddings for what it encodes
+        second = embed(nv_embed, [CORPUS[1], CORPUS[2], CORPUS[0]])
+        metrics = nv_embed.model.embedding_cache_metrics
+
+    assert np.array_equal(second[0], first[1])
+    assert np.array_equal(second[2], first[0])
+    assert not np.array_equal(second[1], first[0])
+    assert metrics["memory_hits"].value() == 2
+    assert metrics["misses"].value() == 3
@@ -0,0 +1,81 @@
+"""Checks of the postprocessing model run through `ModelHarness`."""
+import os
+
+import numpy as np
+import pytest
+
+from benchmark.harness import (CORPUS, LLAMA_REPOSITORY, ModelHarness,
+                               make_request)
+
+
+@pytest.fixture
+def postprocessing(tokenizer_dir):
+    harness = ModelHarness(
+        os.path.join(LLAMA_REPOSITORY, "postprocessing"),
+        substitutions={
+            "tokenizer_dir": tokenizer_dir,
+            "triton_max_batch_size": 8,
+            "postprocessing_instance_count": 1,
+            "skip_special_tokens": True,
+            "enable_incremental_detokenization": True,
+            "incremental_detokenizer_max_states": 16,
+        })
+    with harness:
+        yield harness
+
+
+def stream_request(token_id, is_final, stream_id, request_id="1"):
+    return make_request(
+        {
+            "TOKENS_BATCH": np.array([[[token_id]]], np.int32),
+            "SEQUENCE_LENGTH": np.array([[1]], np.int32),
+            "IS_FINAL": np.array([[is_final]], np.bool_),
+            "STREAM_ID": np.array([[stream_id]], np.uint64),
+        },
+        request_id=request_id)
+
+
+def output_text(response):
+    return b"".join(
+        response.output_tensors()[0].as_numpy().reshape(-1)).decode("utf8")
+
+
+def test_interleaved_streams_sharing_a_request_id(postprocessing):
+    tokenizer = postprocessing.model.tokenizer
+    sequences = [
+        tokenizer.encode(text, add_special_tokens=False)
+        for text in CORPUS[:2]
+    ]
+    length = min(len(ids) for ids in sequences)
+    texts = ["", ""]
+    for step in range(length):
+        # Both streams in one execute call, with the same client request id
+        responses = postprocessing.execute([
+            stream_request(ids[step], step == length - 1, stream_id)
+            for stream_id, ids in enumerate(sequences)
+        ])
+        for stream_id, response in enumerate(responses):
+            texts[stream_id] += output_text(response)
+    assert texts == [
+        tokenizer.decode(ids[:length], skip_special_tokens=True)
+        for ids in sequences
+    ]
+    assert len(postprocessing.model.detokenizer) == 0
+
+
+@pytest.mark.parametrize("text", CORPUS[-3:])
+def test_incremental_decode_matches_one_shot(postprocessing, text):
+    tokenizer = postprocessing.model.tokenizer
+    ids = tokenizer.encode(text, add_special_tokens=False)
+    streamed = "".join(
+        output_text(
+            postprocessing.execute(
+                [stream_request(token_id, step == len(ids) - 1, 7)])[0])
+        for step, token_id in enumerate(ids))
+    one_shot, = postprocessing.execute([
+        make_request({
+            "TOKENS_BATCH": np.array([[ids]], np.int32),
+            "SEQUENCE_LENGTH": np.array([[len(ids)]], np.int32),
+        })
+    ])
+    assert streamed == output_text(one_shot) == text
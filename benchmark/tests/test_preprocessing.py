@@ -0,0 +1,82 @@
+"""Checks of the preprocessing model run through `ModelHarness`."""
+import os
+
+import numpy as np
+import pytest
+
+from benchmark import pb_utils
+from benchmark.harness import (CORPUS, LLAMA_REPOSITORY, ModelHarness,
+                               load_model_module, make_request, string_tensor)
+
+PREPROCESSING_DIR = os.path.join(LLAMA_REPOSITORY, "preprocessing")
+
+
+@pytest.fixture(scope="module")
+def module():
+    return load_model_module(PREPROCESSING_DIR)
+
+
+@pytest.fixture
+def preprocessing(tokenizer_dir):
+    harness = ModelHarness(PREPROCESSING_DIR,
+                           substitutions={
+                               "tokenizer_dir": tokenizer_dir,
+                               "triton_max_batch_size": 8,
+                               "preprocessing_instance_count": 1,
+                               "enable_batch_tokenization": True,
+                               "word_list_cache_size": 128,
+                               "sparse_embedding_bias": False,
+                           })
+    with harness:
+        yield harness
+
+
+def output(response, name):
+    return pb_utils.get_output_tensor_by_name(response, name).as_numpy()
+
+
+def test_pack_sequences_matches_the_sequences(module):
+    sequences = [np.arange(5), np.array([], np.int64), np.arange(10, 13)]
+    packed, lengths = module.pack_sequences(sequences, -1)
+    assert packed.shape == (3, 5) and packed.dtype == np.int32
+    assert lengths.tolist() == [[5], [0], [3]]
+    for row, sequence in zip(packed, sequences):
+        assert row[:len(sequence)].tolist() == sequence.tolist()
+        assert (row[len(sequence):] == -1).all()
+
+
+def test_pack_segments_matches_pack_sequences(module):
+    batch_segments = [[np.arange(3), np.arange(7, 9)], [],
+                      [np.array([4]), np.array([], np.int64),
+                       np.arange(2)]]
+    packed, lengths = module.pack_segments(batch_segments, 0)
+    expected, expected_lengths = module.pack_sequences([
+        np.concatenate(segments) if segments else np.array([], np.int64)
+        for segments in batch_segments
+    ], 0)
+    assert np.array_equal(packed, expected)
+    assert np.array_equal(lengths, expected_lengths)
+
+
+def test_batched_requests_match_single_requests(preprocessing):
+
+    def request(text):
+        return make_request({
+            "QUERY": string_tensor([text]),
+            "REQUEST_OUTPUT_LEN": np.array([[16]], np.int32),
+            "STOP_WORDS_DICT": string_tensor(["<|eot_id|>", "\n\n"]),
+            "BAD_WORDS_DICT": string_tensor(["fox"]),
+        })
+
+    texts = CORPUS[:4]
+    batched = preprocessing.execute([request(text) for text in texts])
+    for text, batched_response in zip(texts, batched):
+        single_response, = preprocessing.execute([request(text)])
+        length = output(single_response, "REQUEST_INPUT_LEN").item()
+        assert output(batched_response, "REQUEST_INPUT_LEN").item() == length
+        assert np.array_equal(
+            output(batched_response, "INPUT_ID")[:, :length],
+            output(single_response, "INPUT_ID")[:, :length])
+        for name in ("STOP_WORDS_IDS", "BAD_WORDS_IDS"):
+            assert np.array_equal(output(batched_response, name),
+                                  output(single_response, name))
@@ -0,0 +1,291 @@
+"""
+Checks the request bookkeeping of the tensorrt_llm model on
+`fake_trtllm.FakeExecutor`.
+"""
+import datetime
+import json
+import os
+import time
+from functools import partial
+
+import numpy as np
+import pytest
+
+from benchmark import pb_utils
+from benchmark.fake_trtllm import install_fake_trtllm
+from benchmark.harness import (LLAMA_REPOSITORY, ModelHarness, make_request,
+                               wait_for_responses)
+
+OUTPUT_LEN = 4
+
+KV_CACHE_OUTPUTS = ("kv_cache_alloc_new_blocks", "kv_cache_reused_blocks",
+                    "kv_cache_alloc_total_blocks")
+
+
+@pytest.fixture(scope="module", autouse=True)
+def fake_trtllm():
+    return install_fake_trtllm(tokens_per_second=1000)
+
+
+def make_harness(parameters=None, **substitutions):
+    return ModelHarness(os.path.join(LLAMA_REPOSITORY, "tensorrt_llm"),
+                        parameters=parameters,
+                        substitutions={
+                            "triton_backend": "python",
+                            "triton_max_batch_size": 8,
+                            "decoupled_mode": True,
+                            "max_beam_width": 1,
+                            "engine_dir": "",
+                            "batching_strategy": "inflight_fused_batching",
+                            "exclude_input_in_output": True,
+                            "logits_datatype": "TYPE_FP32",
+                            "tensorrt_llm_instance_count": 1,
+                            **substitutions,
+                        })
+
+
+def generate_request(parameters=None, **inputs):
+    return make_request(
+        {
+            "input_ids": np.array([[1, 2, 3, 4]], np.int32),
+            "input_lengths": np.array([[4]], np.int32),
+            "request_output_len": np.array([[OUTPUT_LEN]], np.int32),
+            "streaming": np.array([[True]], np.bool_),
+            **inputs,
+        },
+        parameters=parameters)
+
+
+def output_names(response):
+    return {tensor.name() for tensor in response.output_tensors()}
+
+
+def test_kv_cache_reuse_stats_only_for_requests_that_ask():
+    with make_harness(collect_kv_cache_reuse_stats=True,
+                      collect_queue_time_stats=True) as tensorrt_llm:
+        plain = generate_request()
+        asking = generate_request(return_kv_cache_reuse_stats=np.array(
+            [[True]], np.bool_))
+        tensorrt_llm.execute([plain, asking])
+        plain_responses = wait_for_responses(plain)
+        asking_responses = wait_for_responses(asking)
+
+    assert len(plain_responses) == len(asking_responses) == OUTPUT_LEN
+    for response in plain_responses:
+        assert output_names(response).isdisjoint(KV_CACHE_OUTPUTS)
+    for response in asking_responses:
+        assert output_names(response).issuperset(KV_CACHE_OUTPUTS)
+        assert pb_utils.get_output_tensor_by_name(
+            response, "kv_cache_alloc_new_blocks").as_numpy().item() == 1
+
+
+def test_queue_time_stats_leave_the_responses_unchanged():
+    with make_harness(collect_queue_time_stats=True) as tensorrt_llm:
+        request = generate_request()
+        tensorrt_llm.execute([request])
+        responses = wait_for_responses(request)
+        queue_times = tensorrt_llm.model.latency_metrics[
+            "queue_time"].observations
+
+    assert len(queue_times) == 1 and queue_times[0] >= 0
+    for response in responses:
+        assert output_names(response) == {
+            "output_ids", "sequence_length", "is_final", "stream_id"
+        }
+
+
+def test_admission_control_limits_active_requests_per_tenant():
+    tenant_limits = json.dumps({"agent": {"max_active_requests": 1}})
+    with make_harness({"tenant_limits": tenant_limits}) as tensorrt_llm:
+        requests = [
+            generate_request(parameters={"tenant": "agent"})
+            for _ in range(3)
+        ]
+        other = generate_request(input_ids=np.array([[5, 6, 7, 8]], np.int32))
+        tensorrt_llm.execute(requests + [other])
+        assert tensorrt_llm.model.admission.request_counts()["agent"] == (2,
+                                                                          1)
+        for request in requests + [other]:
+            assert len(wait_for_responses(request)) == OUTPUT_LEN
+        executor = tensorrt_llm.model.executor
+
+    spans = {
+        request_id: (times[0], times[-1])
+        for request_id, times in executor.produced_at.items()
+    }
+    agent_spans = sorted(
+        span for request_id, span in spans.items()
+        if list(executor.requests[request_id].input_token_ids) != [5, 6, 7, 8])
+    assert len(agent_spans) == 3
+    # One request of the tenant at a time
+    for (_, end), (start, _) in zip(agent_spans, agent_spans[1:]):
+        assert start > end
+
+
+def test_requests_past_their_deadline_end_with_an_error():
+    with make_harness() as tensorrt_llm:
+        request = generate_request(
+            request_output_len=np.array([[100000]], np.int32),
+            deadline_ms=np.array([[20]], np.int32))
+        tensorrt_llm.execute([request])
+        responses = wait_for_responses(request)
+        dropped = tensorrt_llm.model.deadline_drop_metrics[
+            "deadline"].value()
+
+    assert responses[-1].has_error()
+    assert "deadline_ms" in responses[-1].error().message()
+    assert all(not response.has_error() for response in responses[:-1])
+    assert dropped == 1
+
+
+def test_responses_before_the_enqueue_returns_are_kept(
+        fake_trtllm, monkeypatch):
+
+    class SlowEnqueueExecutor(fake_trtllm.FakeExecutor):
+        """Returns from enqueuing after the requests generated, like a
+        shared executor client whose round trip is slow."""
+
+        def enqueue_requests(self, requests):
+            request_ids = super().enqueue_requests(requests)
+            time.sleep(OUTPUT_LEN * 4 * self.iteration_seconds)
+            return request_ids
+
+    monkeypatch.setattr(fake_trtllm, "Executor",
+                        partial(SlowEnqueueExecutor, tokens_per_second=1000))
+    with make_harness() as tensorrt_llm:
+        request = generate_request()
+        tensorrt_llm.execute([request])
+        responses = wait_for_responses(request)
+        assert not tensorrt_llm.model.early_responses
+
+    assert len(responses) == OUTPUT_LEN
+    assert [
+        pb_utils.get_output_tensor_by_name(response,
+                                           "is_final").as_numpy().item()
+        for response in responses
+    ] == [False] * (OUTPUT_LEN - 1) + [True]
+
+
+def test_stat_gauges_found_in_later_stats(fake_trtllm, monkeypatch):
+
+    class LateKvCacheStatsExecutor(fake_trtllm.FakeExecutor):
+        """Reports KV cache stats from its second iteration stats on."""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.stats_calls = 0
+            self.last_timestamp = None
+
+        def get_latest_iteration_stats(self):
+            stats = super().get_latest_iteration_stats()
+            if stats:
+                self.stats_calls += 1
+                stats[-1].kv_cache_stats = (None if self.stats_calls == 1 else
+                                            fake_trtllm.KvCacheStats(
+                                                max_num_blocks=8,
+                                                free_num_blocks=1,
+                                                used_num_blocks=7,
+                                                tokens_per_block=64))
+                self.last_timestamp = stats[-1].timestamp
+            return stats
+
+    monkeypatch.setattr(fake_trtllm, "Executor",
+                        partial(LateKvCacheStatsExecutor,
+                                tokens_per_second=1000))
+    with make_harness(stats_check_period_ms=5) as tensorrt_llm:
+        model = tensorrt_llm.model
+        deadline = time.monotonic() + 5
+        while (model.executor.stats_calls < 3
+               and time.monotonic() < deadline):
+            time.sleep(0.005)
+        assert model.executor.stats_calls >= 3
+        used_num_blocks = model.all_metrics["used_num_blocks"].value()
+        timestamp = model.all_metrics["timestamp"].value()
+        last_timestamp = model.executor.last_timestamp
+
+    assert used_num_blocks == 7
+    assert timestamp == int(
+        datetime.datetime.strptime(last_timestamp,
+                                   "%m-%d-%Y %H:%M:%S.%f").timestamp())
+
+
+@pytest.fixture
+def shared_executor_address(tmp_path):
+    return str(tmp_path / "executor" / "tensorrt_llm.sock")
+
+
+def test_shared_executor_instances_answer_all_requests(
+        shared_executor_address):
+    harnesses = [
+        make_harness(tensorrt_llm_instance_count=2,
+                     shared_executor=True,
+                     shared_executor_address=shared_executor_address)
+        for _ in range(2)
+    ]
+    for harness in harnesses:
+        harness.initialize()
+    try:
+        requests = [generate_request() for _ in range(8)]
+        for i, request in enumerate(requests):
+            harnesses[i % 2].execute([request])
+        for request in requests:
+            responses = wait_for_responses(request)
+            assert len(responses) == OUTPUT_LEN
+            assert not any(response.has_error() for response in responses)
+    finally:
+        for harness in reversed(harnesses):
+            harness.finalize()
+
+
+def test_shared_executor_listener_removed_when_executor_fails(
+        fake_trtllm, shared_executor_address):
+    module = make_harness().module
+
+    def create_executor():
+        raise RuntimeError("no engine")
+
+    with pytest.raises(RuntimeError, match="no engine"):
+        module.connect_shared_executor(shared_executor_address,
+                                       create_executor)
+    assert not os.path.exists(shared_executor_address)
+
+    # The next instance owns the executor instead of failing to connect
+    server = module.connect_shared_executor(shared_executor_address,
+                                            fake_trtllm.FakeExecutor)
+    assert isinstance(server, module.SharedExecutorServer)
+    server.shutdown()
+
+
+def test_shared_executor_handshake_and_pickling_errors(
+        fake_trtllm, shared_executor_address):
+    module = make_harness().module
+    server = module.connect_shared_executor(shared_executor_address,
+                                            fake_trtllm.FakeExecutor)
+    try:
+        client = module.connect_shared_executor(shared_executor_address,
+                                                fake_trtllm.FakeExecutor)
+        with pytest.raises(pb_utils.TritonModelException,
+                           match="could not be pickled"):
+            client.enqueue_requests([lambda: None])
+        assert client.can_enqueue_requests()
+        client.shutdown()
+
+        key_path = f"{shared_executor_address}.key"
+        with open(key_path, "rb") as f:
+            key = f.read()
+        with open(key_path, "wb") as f:
+            f.write(os.urandom(32))
+        with pytest.raises(pb_utils.TritonModelException,
+                           match="Failed the handshake"):
+            module.connect_shared_executor(shared_executor_address,
+                                           fake_trtllm.FakeExecutor)
+
+        # The server keeps accepting clients after a failed handshake
+        with open(key_path, "wb") as f:
+            f.write(key)
+        client = module.connect_shared_executor(shared_executor_address,
+                                                fake_trtllm.FakeExecutor)
+        assert isinstance(client, module.SharedExecutorClient)
+        client.shutdown()
+    finally:
+        server.shutdown()
@@ -0,0 +1 @@
+../../tensorrt_llm/1/model.py
\ No newline at end of file
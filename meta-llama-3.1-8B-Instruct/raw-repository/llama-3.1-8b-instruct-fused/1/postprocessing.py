@@ -0,0 +1 @@
+../../postprocessing/1/model.py
\ No newline at end of file
@@ -28,6 +28,7 @@ import base64
 import io
 import json
 import os
+from functools import lru_cache
 from typing import List
 
 import numpy as np
@@ -37,6 +38,272 @@ from PIL import Image
 from transformers import AutoProcessor, AutoTokenizer, T5Tokenizer
 
 
+def pack_sequences(sequences, pad_id, dtype=np.int32):
+    """
+    Packs token id sequences into a single right padded array.
+
+    Args:
+        sequences (List[np.ndarray]): 1D token id arrays, one per batch item.
+        pad_id (int): Id used to fill the positions after each sequence.
+        dtype: Data type of the packed array.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The [batch, max_len] packed ids and the
+        [batch, 1] int32 length of each sequence.
+    """
+    lengths = np.fromiter((len(seq) for seq in sequences),
+                          dtype=np.int32,
+                          count=len(sequences))
+    packed = np.full((len(sequences), lengths.max(initial=0)),
+                     pad_id,
+                     dtype=dtype)
+    for row, seq, length in zip(packed, sequences, lengths):
+        row[:length] = seq
+    return packed, lengths.reshape(-1, 1)
+
+
+def pack_segments(batch_segments, pad_id, dtype=np.int32):
+    """
+    Same as `pack_sequences`, but every batch item is given as a list of 1D
+    segments that are written back to back, so prompts assembled from several
+    parts don't need to be concatenated first.
+
+    Args:
+        batch_segments (List[List[np.ndarray]]): The segments of each batch item.
+        pad_id (int): Id used to fill the positions after each sequence.
+        dtype: Data type of the packed array.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The [batch, max_len] packed ids and the
+        [batch, 1] int32 length of each sequence.
+    """
+    lengths = np.fromiter((sum(len(segment) for segment in segments)
+                           for segments in batch_segments),
+                          dtype=np.int32,
+                          count=len(batch_segments))
+    packed = np.full((len(batch_segments), lengths.max(initial=0)),
+                     pad_id,
+                     dtype=dtype)
+    for row, segments in zip(packed, batch_segments):
+        offset = 0
+        for segment in segments:
+            row[offset:offset + len(segment)] = segment
+            offset += len(segment)
+    return packed, lengths.reshape(-1, 1)
+
+
+class PromptEncoder:
+    """
+    Tokenizes prompts with the tokenizer of the model. Chat prompts resend the
+    same system prompt on every turn: with a cache of `cache_size` prefixes,
+    the text up to and including the first `delimiter` is tokenized once and
+    its ids reused, so the engine gets the same prefix ids and can reuse their
+    KV cache blocks. Also used by the fused mode of the tensorrt_llm model.
+    """
+
+    def __init__(self, tokenizer, add_special_tokens, cache_size, delimiter):
+        self.tokenizer = tokenizer
+        self.add_special_tokens = add_special_tokens
+        self.delimiter = delimiter
+        self.prefix_ids = lru_cache(maxsize=cache_size)(self._prefix_ids)
+        self.enabled = cache_size > 0 and self._can_cache()
+
+    def encode(self, texts):
+        """
+        Tokenizes `texts` in one call to the tokenizer. With the prompt cache,
+        the part of a text up to and including the first `delimiter` comes
+        from the cache and only the rest is tokenized, without special tokens.
+
+        Returns:
+            List[List[int] | np.ndarray]: The token ids of every text.
+        """
+        if not self.enabled:
+            return self.tokenizer(texts,
+                                  add_special_tokens=self.add_special_tokens,
+                                  return_attention_mask=False,
+                                  return_token_type_ids=False)['input_ids']
+
+        prefixes = []
+        rests = []
+        for text in texts:
+            end = text.find(self.delimiter)
+            if end == -1:
+                prefixes.append(None)
+                rests.append(text)
+            else:
+                end += len(self.delimiter)
+                prefixes.append(text[:end])
+                rests.append(text[end:])
+
+        encoded = [None] * len(texts)
+        for has_prefix in (False, True):
+            indices = [
+                idx for idx, prefix in enumerate(prefixes)
+                if (prefix is not None) == has_prefix
+            ]
+            if not indices:
+                continue
+            rest_ids = self.tokenizer(
+                [rests[idx] for idx in indices],
+                add_special_tokens=not has_prefix and self.add_special_tokens,
+                return_attention_mask=False,
+                return_token_type_ids=False)['input_ids']
+            for idx, ids in zip(indices, rest_ids):
+                encoded[idx] = np.concatenate(
+                    (self.prefix_ids(prefixes[idx]),
+                     ids)) if has_prefix else ids
+        return encoded
+
+    def _prefix_ids(self, prefix):
+        ids = np.array(self.tokenizer.encode(
+            prefix, add_special_tokens=self.add_special_tokens),
+                       dtype=int)
+        # Shared by every prompt starting with `prefix`
+        ids.setflags(write=False)
+        return ids
+
+    def _can_cache(self):
+        """
+        Prompts are split right after the delimiter, which only gives the ids
+        of the whole prompt when the delimiter is a token of its own and the
+        tokenizer adds its special tokens in front only.
+        """
+        if isinstance(self.tokenizer, T5Tokenizer):
+            return False
+        if self.delimiter not in self.tokenizer.get_added_vocab():
+            print(
+                f"[TensorRT-LLM][WARNING] 'prompt_cache_delimiter' {self.delimiter!r} is not a special token of the tokenizer. The prompt cache is disabled."
+            )
+            return False
+        prefix = f"You are a helpful assistant.{self.delimiter}"
+        rest = "\n\nHello there!"
+        expected = self.tokenizer.encode(
+            prefix + rest, add_special_tokens=self.add_special_tokens)
+        if self._prefix_ids(prefix).tolist() + self.tokenizer.encode(
+                rest, add_special_tokens=False) != expected:
+            print(
+                f"[TensorRT-LLM][WARNING] Tokenizing prompts split after 'prompt_cache_delimiter' changes their ids. The prompt cache is disabled."
+            )
+            return False
+        return True
+
+
+class WordListEncoder:
+    """
+    Tokenizes stop/bad word lists and embedding bias words. Both repeat
+    across requests, so the [2, N] row of each word list and the ids of each
+    bias word are kept in LRU caches of `cache_size`. Also used by the fused
+    mode of the tensorrt_llm model.
+    """
+
+    def __init__(self, tokenizer, cache_size):
+        self.tokenizer = tokenizer
+        self.word_list_row = lru_cache(maxsize=cache_size)(self._word_list_row)
+        self.embedding_bias_word_ids = lru_cache(maxsize=cache_size)(
+            self._embedding_bias_word_ids)
+
+    def to_word_list_format(self, word_lists: List[List[str | bytes]],
+                            batch_size):
+        '''
+        word_lists format:
+            len(word_lists) == batch_size
+            word_lists[i] means the words associated to batch item i. A "word" may actually be any string. Like "lorem" or "lorem ipsum".
+        '''
+        if word_lists is None:
+            # Return an empty array of shape (1,2,0)
+            return np.empty([batch_size, 2, 0], dtype="int32")
+
+        rows = [
+            self.word_list_row(tuple(word_list)) for word_list in word_lists
+        ]
+        pad_to = max(1, max(row.shape[1] for row in rows))
+
+        # Flat ids are padded with 0 and offsets with -1
+        word_list_ids = np.zeros([len(rows), 2, pad_to], dtype="int32")
+        word_list_ids[:, 1, :] = -1
+        for item, row in zip(word_list_ids, rows):
+            item[:, :row.shape[1]] = row
+        return word_list_ids
+
+    def sparse_embedding_bias(self, embedding_bias_words,
+                              embedding_bias_weights, batch_size, dtype):
+        '''
+        Returns the embedding bias of each batch item as [batch, N] token ids,
+        padded with -1, and the matching [batch, N] values, padded with 0.
+        Ids may repeat, their values have to be summed when densifying.
+        '''
+        if embedding_bias_words is None or embedding_bias_weights is None:
+            return (np.empty([batch_size, 0], dtype=np.int32),
+                    np.empty([batch_size, 0], dtype=dtype))
+
+        batch_ids = []
+        batch_values = []
+        for words, weights in zip(embedding_bias_words,
+                                  embedding_bias_weights):
+            ids, values = self.embedding_bias_ids_and_values(words, weights)
+            batch_ids.append(ids)
+            batch_values.append(values)
+
+        embedding_bias_ids, _ = pack_sequences(batch_ids, -1)
+        embedding_bias_values, _ = pack_sequences(batch_values,
+                                                  0,
+                                                  dtype=dtype)
+        return embedding_bias_ids, embedding_bias_values
+
+    def embedding_bias_ids_and_values(self, words, weights):
+        '''
+        Maps the bias words of one batch item to their token ids, each id
+        carrying the weight of the word it was tokenized from.
+        '''
+        assert len(words) == len(
+            weights
+        ), "Embedding bias words must have same dimension as embedding bias weights"
+
+        word_ids = [self.embedding_bias_word_ids(word) for word in words]
+        if len(word_ids) == 0:
+            return np.empty([0], dtype=np.int32), np.empty([0],
+                                                           dtype=weights.dtype)
+        ids = np.concatenate(word_ids)
+        values = np.repeat(weights, [len(x) for x in word_ids])
+        return ids, values
+
+    def _word_list_row(self, word_list):
+        '''
+        Tokenizes the words of one batch item into its [2, N] row: the flat ids
+        of all words followed by the end offset of each word, padded with -1.
+        The row is shared through the word list cache and must not be modified.
+        '''
+        flat_ids = []
+        offsets = []
+        for word in word_list:
+            if isinstance(word, bytes):
+                word = word.decode()
+
+            ids = self.tokenizer.encode(word, add_special_tokens=False)
+            if len(ids) == 0:
+                continue
+
+            flat_ids += ids
+            offsets.append(len(flat_ids))
+
+        row = np.full([2, len(flat_ids)], -1, dtype="int32")
+        row[0] = flat_ids
+        row[1, :len(offsets)] = offsets
+        row.flags.writeable = False
+        return row
+
+    def _embedding_bias_word_ids(self, word):
+        '''
+        Tokenizes one embedding bias word. The result is shared through the
+        embedding bias word cache and must not be modified.
+        '''
+        if isinstance(word, bytes):
+            word = word.decode()
+        ids = np.array(self.tokenizer.encode(word), dtype=np.int32)
+        ids.flags.writeable = False
+        return ids
+
+
 class TritonPythonModel:
     """Your Python model must use the same class name. Every Python model
     that is created must have "TritonPythonModel" as the class name.
@@ -104,6 +371,40 @@ class TritonPythonModel:
             )
             self.add_special_tokens = True
 
+        sparse_embedding_bias = model_config['parameters'].get(
+            'sparse_embedding_bias')
+        self.sparse_embedding_bias = False
+        if sparse_embedding_bias is not None:
+            sparse_embedding_bias_str = sparse_embedding_bias[
+                'string_value'].lower()
+            if sparse_embedding_bias_str in [
+                    'true', 'false', '1', '0', 't', 'f', 'y', 'n', 'yes', 'no'
+            ]:
+                self.sparse_embedding_bias = sparse_embedding_bias_str in [
+                    'true', '1', 't', 'y', 'yes'
+                ]
+            elif sparse_embedding_bias_str != "${sparse_embedding_bias}":
+                print(
+                    f"[TensorRT-LLM][WARNING] Don't setup 'sparse_embedding_bias' correctly (set value is {sparse_embedding_bias['string_value']}). Set it as False by default."
+                )
+
+        enable_batch_tokenization = model_config['parameters'].get(
+            'enable_batch_tokenization')
+        self.batch_tokenization = False
+        if enable_batch_tokenization is not None:
+            enable_batch_tokenization_str = enable_batch_tokenization[
+                'string_value'].lower()
+            if enable_batch_tokenization_str in [
+                    'true', 'false', '1', '0', 't', 'f', 'y', 'n', 'yes', 'no'
+            ]:
+                self.batch_tokenization = enable_batch_tokenization_str in [
+                    'true', '1', 't', 'y', 'yes'
+                ]
+            elif enable_batch_tokenization_str != "${enable_batch_tokenization}":
+                print(
+                    f"[TensorRT-LLM][WARNING] Don't setup 'enable_batch_tokenization' correctly (set value is {enable_batch_tokenization['string_value']}). Set it as False by default."
+                )
+
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir,
                                                        legacy=False,
                                                        padding_side='left',
@@ -115,12 +416,65 @@ class TritonPythonModel:
         if not self.tokenizer.pad_token:
             self.tokenizer.pad_token = self.tokenizer.eos_token
 
+        # Batch tokenization relies on the Rust tokenizer encoding a list of
+        # strings in parallel, slow tokenizers would only loop in Python.
+        if self.batch_tokenization and not self.tokenizer.is_fast:
+            print(
+                f"[TensorRT-LLM][WARNING] 'enable_batch_tokenization' requires a fast tokenizer. Falling back to per-query tokenization."
+            )
+            self.batch_tokenization = False
+
         self.tokenizer_end_id = self.tokenizer.encode(
             self.tokenizer.eos_token, add_special_tokens=False)[0]
         self.tokenizer_pad_id = self.tokenizer.encode(
             self.tokenizer.pad_token, add_special_tokens=False)[0]
         self.vocab_size = self.tokenizer.vocab_size
 
+        # Size of the stop/bad word list and embedding bias word caches
+        word_list_cache_size = model_config['parameters'].get(
+            'word_list_cache_size')
+        self.word_list_cache_size = 128
+        if word_list_cache_size is not None:
+            word_list_cache_size_str = word_list_cache_size['string_value']
+            if word_list_cache_size_str.isdigit():
+                self.word_list_cache_size = int(word_list_cache_size_str)
+            elif word_list_cache_size_str != "${word_list_cache_size}":
+                print(
+                    f"[TensorRT-LLM][WARNING] 'word_list_cache_size' parameter is not set correctly (value is {word_list_cache_size_str}). Will be set to {self.word_list_cache_size}"
+                )
+        self.word_list_encoder = WordListEncoder(self.tokenizer,
+                                                 self.word_list_cache_size)
+
+        # Prompt prefixes up to `prompt_cache_delimiter` are tokenized once,
+        # see `PromptEncoder`
+        prompt_cache_size = model_config['parameters'].get(
+            'prompt_cache_size')
+        self.prompt_cache_size = 0
+        if prompt_cache_size is not None:
+            prompt_cache_size_str = prompt_cache_size['string_value']
+            if prompt_cache_size_str.isdigit():
+                self.prompt_cache_size = int(prompt_cache_size_str)
+            elif prompt_cache_size_str != "${prompt_cache_size}":
+                print(
+                    f"[TensorRT-LLM][WARNING] 'prompt_cache_size' parameter is not set correctly (value is {prompt_cache_size_str}). Will be set to {self.prompt_cache_size}"
+                )
+        prompt_cache_delimiter = model_config['parameters'].get(
+            'prompt_cache_delimiter')
+        self.prompt_cache_delimiter = "<|eot_id|>"
+        if prompt_cache_delimiter is not None and prompt_cache_delimiter[
+                'string_value'] not in ["", "${prompt_cache_delimiter}"]:
+            self.prompt_cache_delimiter = prompt_cache_delimiter[
+                'string_value']
+        self.prompt_encoder = PromptEncoder(self.tokenizer,
+                                            self.add_special_tokens,
+                                            self.prompt_cache_size,
+                                            self.prompt_cache_delimiter)
+        self.prompt_cache = self.prompt_encoder.enabled
+
+        # `len(self.tokenizer.vocab)` rebuilds the vocab dict on every call
+        self.embedding_bias_vocab_size = len(self.tokenizer.vocab)
+        self._create_metrics(args['model_name'], args['model_version'])
+
         self.is_multimodal = False
         self.model_type = None
         self.vision_preprocessor = None
@@ -158,7 +512,8 @@ class TritonPythonModel:
             "INPUT_ID", "DECODER_INPUT_ID", "REQUEST_INPUT_LEN",
             "REQUEST_DECODER_INPUT_LEN", "BAD_WORDS_IDS", "STOP_WORDS_IDS",
             "OUT_END_ID", "OUT_PAD_ID", "OUT_PROMPT_TABLE_EXTRA_IDS",
-            "PIXEL_VALUES", "IMAGE_SIZES"
+            "PIXEL_VALUES", "IMAGE_SIZES", "EMBEDDING_BIAS_IDS",
+            "EMBEDDING_BIAS_VALUES"
         ]
         input_names = ["EMBEDDING_BIAS_WORDS", "EMBEDDING_BIAS_WEIGHTS"]
         for input_name in input_names:
@@ -177,6 +532,97 @@ class TritonPythonModel:
                     pb_utils.get_output_config_by_name(
                         model_config, output_name)['data_type']))
 
+    def _create_metrics(self, model, version):
+        common_labels = {"model": model, "version": version}
+        self.word_list_cache_metric_family = pb_utils.MetricFamily(
+            name="nv_llm_word_list_cache_lookups",
+            description="Stop/bad word list cache lookups in preprocessing",
+            kind=pb_utils.MetricFamily.COUNTER,
+        )
+        self.word_list_cache_size_metric_family = pb_utils.MetricFamily(
+            name="nv_llm_word_list_cache_size",
+            description="Stop/bad word list cache size in preprocessing",
+            kind=pb_utils.MetricFamily.GAUGE,
+        )
+        self.word_list_cache_metrics = {
+            "hits":
+            self.word_list_cache_metric_family.Metric(labels={
+                "cache_result": "hit",
+                **common_labels
+            }),
+            "misses":
+            self.word_list_cache_metric_family.Metric(labels={
+                "cache_result": "miss",
+                **common_labels
+            }),
+            "currsize":
+            self.word_list_cache_size_metric_family.Metric(labels={
+                "cache_size_type": "current",
+                **common_labels
+            }),
+            "maxsize":
+            self.word_list_cache_size_metric_family.Metric(labels={
+                "cache_size_type": "max",
+                **common_labels
+            }),
+        }
+        self.word_list_cache_metrics["maxsize"].set(self.word_list_cache_size)
+        self._word_list_cache_info = self.word_list_encoder.word_list_row.cache_info()
+
+        self.prompt_cache_metric_family = pb_utils.MetricFamily(
+            name="nv_llm_prompt_cache_lookups",
+            description="Prompt prefix cache lookups in preprocessing",
+            kind=pb_utils.MetricFamily.COUNTER,
+        )
+        self.prompt_cache_size_metric_family = pb_utils.MetricFamily(
+            name="nv_llm_prompt_cache_size",
+            description="Prompt prefix cache size in preprocessing",
+            kind=pb_utils.MetricFamily.GAUGE,
+        )
+        self.prompt_cache_metrics = {
+            "hits":
+            self.prompt_cache_metric_family.Metric(labels={
+                "cache_result": "hit",
+                **common_labels
+            }),
+            "misses":
+            self.prompt_cache_metric_family.Metric(labels={
+                "cache_result": "miss",
+                **common_labels
+            }),
+            "currsize":
+            self.prompt_cache_size_metric_family.Metric(labels={
+                "cache_size_type": "current",
+                **common_labels
+            }),
+            "maxsize":
+            self.prompt_cache_size_metric_family.Metric(labels={
+                "cache_size_type": "max",
+                **common_labels
+            }),
+        }
+        self.prompt_cache_metrics["maxsize"].set(
+            self.prompt_cache_size if self.prompt_cache else 0)
+        self._prompt_cache_info = self.prompt_encoder.prefix_ids.cache_info()
+
+    def _update_word_list_cache_metrics(self):
+        cache_info = self.word_list_encoder.word_list_row.cache_info()
+        self.word_list_cache_metrics["hits"].increment(
+            cache_info.hits - self._word_list_cache_info.hits)
+        self.word_list_cache_metrics["misses"].increment(
+            cache_info.misses - self._word_list_cache_info.misses)
+        self.word_list_cache_metrics["currsize"].set(cache_info.currsize)
+        self._word_list_cache_info = cache_info
+
+    def _update_prompt_cache_metrics(self):
+        cache_info = self.prompt_encoder.prefix_ids.cache_info()
+        self.prompt_cache_metrics["hits"].increment(
+            cache_info.hits - self._prompt_cache_info.hits)
+        self.prompt_cache_metrics["misses"].increment(
+            cache_info.misses - self._prompt_cache_info.misses)
+        self.prompt_cache_metrics["currsize"].set(cache_info.currsize)
+        self._prompt_cache_info = cache_info
+
     def _setup_ptable_shape(self, llm_model_config):
         max_prompt_embedding_table_size = llm_model_config['build_config'][
             'max_prompt_embedding_table_size']
@@ -211,12 +657,22 @@ class TritonPythonModel:
 
         responses = []
 
+        queries = [
+            pb_utils.get_input_tensor_by_name(request, 'QUERY').as_numpy()
+            for request in requests
+        ]
+
+        # Tokenize the queries of all requests with a single tokenizer call
+        # and hand each request its own slice of the result.
+        batch_start_ids = None
+        if self._can_batch_tokenize():
+            batch_start_ids = self._batch_encode(queries)
+
         # Every Python backend must iterate over everyone of the requests
         # and create a pb_utils.InferenceResponse for each of them.
         for idx, request in enumerate(requests):
             # Get input tensors
-            query = pb_utils.get_input_tensor_by_name(request,
-                                                      'QUERY').as_numpy()
+            query = queries[idx]
             batch_size = query.shape[0]
 
             decoder_query = pb_utils.get_input_tensor_by_name(
@@ -317,7 +773,10 @@ class TritonPythonModel:
             # Preprocessing input data.
             # For the LLaVA_OneVision model, num_visual_features is not a fixed value
             input_id, request_input_len = self._create_request(
-                query, visual_tokens)
+                query,
+                visual_tokens,
+                start_ids=batch_start_ids[idx]
+                if batch_start_ids is not None else None)
             if decoder_query is not None:
                 decoder_input_id, request_decoder_input_len = self._create_request(
                     decoder_query)
@@ -326,12 +785,22 @@ class TritonPythonModel:
                 request_decoder_input_len = 1 * np.ones(
                     (batch_size, 1), np.int32)
 
-            bad_words = self._to_word_list_format(bad_words_dict, batch_size)
-            stop_words = self._to_word_list_format(stop_words_dict, batch_size)
-
-            embedding_bias = self._get_embedding_bias(
-                embedding_bias_words, embedding_bias_weights,
-                self.embedding_bias_weights_dtype, batch_size)
+            bad_words = self.word_list_encoder.to_word_list_format(
+                bad_words_dict, batch_size)
+            stop_words = self.word_list_encoder.to_word_list_format(
+                stop_words_dict, batch_size)
+
+            if self.sparse_embedding_bias:
+                # tensorrt_llm densifies the bias from its ids and values
+                embedding_bias_ids, embedding_bias_values = self.word_list_encoder.sparse_embedding_bias(
+                    embedding_bias_words, embedding_bias_weights, batch_size,
+                    self.embedding_bias_weights_dtype)
+                embedding_bias = np.empty(
+                    [batch_size, 0], dtype=self.embedding_bias_weights_dtype)
+            else:
+                embedding_bias = self._get_embedding_bias(
+                    embedding_bias_words, embedding_bias_weights,
+                    self.embedding_bias_weights_dtype, batch_size)
 
             if prompt_table_extra_id is not None:
                 prompt_table_extra_ids = np.zeros_like(input_id)
@@ -343,10 +812,11 @@ class TritonPythonModel:
             # Create output tensors. You need pb_utils.Tensor
             # objects to create pb_utils.InferenceResponse.
             input_id_tensor = pb_utils.Tensor(
-                'INPUT_ID', input_id.astype(self.input_id_dtype))
+                'INPUT_ID', input_id.astype(self.input_id_dtype, copy=False))
             request_input_len_tensor = pb_utils.Tensor(
                 'REQUEST_INPUT_LEN',
-                request_input_len.astype(self.request_input_len_dtype))
+                request_input_len.astype(self.request_input_len_dtype,
+                                         copy=False))
             decoder_input_id_tensor = pb_utils.Tensor(
                 'DECODER_INPUT_ID',
                 decoder_input_id.astype(self.decoder_input_id_dtype))
@@ -366,30 +836,38 @@ class TritonPythonModel:
             pad_id_tensor = pb_utils.Tensor('OUT_PAD_ID',
                                             np.array(pad_id, dtype=np.int32))
 
+            output_tensors = [
+                input_id_tensor, decoder_input_id_tensor, bad_words_ids_tensor,
+                stop_words_ids_tensor, request_input_len_tensor,
+                request_decoder_input_len_tensor, request_output_len_tensor,
+                embedding_bias_tensor, end_id_tensor, pad_id_tensor
+            ]
             if prompt_table_extra_id is not None:
-                prompt_table_extra_ids_tensor = pb_utils.Tensor(
-                    'OUT_PROMPT_TABLE_EXTRA_IDS',
-                    np.array(prompt_table_extra_ids,
-                             dtype=self.out_prompt_table_extra_ids_dtype))
-                inference_response = pb_utils.InferenceResponse(output_tensors=[
-                    input_id_tensor, decoder_input_id_tensor,
-                    bad_words_ids_tensor, stop_words_ids_tensor,
-                    request_input_len_tensor, request_decoder_input_len_tensor,
-                    request_output_len_tensor, embedding_bias_tensor,
-                    end_id_tensor, pad_id_tensor, prompt_table_extra_ids_tensor
-                ] + vision_processed_tensors)
-            else:
-                inference_response = pb_utils.InferenceResponse(
-                    output_tensors=[
-                        input_id_tensor, decoder_input_id_tensor,
-                        bad_words_ids_tensor, stop_words_ids_tensor,
-                        request_input_len_tensor,
-                        request_decoder_input_len_tensor,
-                        request_output_len_tensor, embedding_bias_tensor,
-                        end_id_tensor, pad_id_tensor
-                    ] + vision_processed_tensors)
+                output_tensors.append(
+                    pb_utils.Tensor(
+                        'OUT_PROMPT_TABLE_EXTRA_IDS',
+                        np.array(prompt_table_extra_ids,
+                                 dtype=self.out_prompt_table_extra_ids_dtype)))
+            if self.sparse_embedding_bias:
+                output_tensors.append(
+                    pb_utils.Tensor(
+                        'EMBEDDING_BIAS_IDS',
+                        embedding_bias_ids.astype(
+                            self.embedding_bias_ids_dtype, copy=False)))
+                output_tensors.append(
+                    pb_utils.Tensor(
+                        'EMBEDDING_BIAS_VALUES',
+                        embedding_bias_values.astype(
+                            self.embedding_bias_values_dtype, copy=False)))
+
+            inference_response = pb_utils.InferenceResponse(
+                output_tensors=output_tensors + vision_processed_tensors)
             responses.append(inference_response)
 
+        self._update_word_list_cache_metrics()
+        if self.prompt_cache:
+            self._update_prompt_cache_metrics()
+
         # You should return a list of pb_utils.InferenceResponse. Length
         # of this list must match the length of `requests` list.
         return responses
@@ -411,7 +889,7 @@ class TritonPythonModel:
             concatenated_ids (np.ndarray): A batch of concatenated token IDs, where image placeholders are indicated by `image_token_index`.
 
         Returns:
-            List[List[np.ndarray]]: A list containing lists of token ID arrays for each prompt segment, per batch sample.
+            List[List[np.ndarray]]: A list containing lists of 1D token ID arrays for each prompt segment, per batch sample.
         """
         batch_splits = []
         for batch in concatenated_ids:
@@ -420,10 +898,10 @@ class TritonPythonModel:
             splits = []
             for idx in zero_indices:
                 if start_idx != idx:
-                    splits.append(batch[start_idx:idx].reshape(1, -1))
+                    splits.append(batch[start_idx:idx])
                 start_idx = idx + 1
             if start_idx < len(batch):
-                splits.append(batch[start_idx:].reshape(1, -1))
+                splits.append(batch[start_idx:])
 
             splits = [split for split in splits if split.size > 0]
             batch_splits.append(splits)
@@ -439,49 +917,29 @@ class TritonPythonModel:
             batch_split_prompts (List[List[np.ndarray]]): Tokenized prompt segments for each batch sample.
 
         Returns:
-            np.ndarray: An array of input IDs with image placeholders replaced by fake prompt IDs.
+            Tuple[np.ndarray, np.ndarray]: The padded input IDs with image placeholders replaced by fake prompt IDs, and the length of each sample.
         """
 
         num_visual_features = self.ptable_shape[1]
-        input_ids_list = []
+        batch_segments = []
 
         for batch_idx in range(batch_size):
             splits = batch_split_prompts[batch_idx]
-            sample_input_ids = [splits[0]]
+            sample_segments = [splits[0]]
             sample_fake_prompt_counter = self.vocab_size
 
             for split_idx in range(len(splits) - 1):
-                fake_prompt_id = np.arange(
-                    sample_fake_prompt_counter,
-                    sample_fake_prompt_counter + num_visual_features)
+                sample_segments.append(
+                    np.arange(sample_fake_prompt_counter,
+                              sample_fake_prompt_counter +
+                              num_visual_features))
                 sample_fake_prompt_counter += num_visual_features
-                fake_prompt_id = np.expand_dims(fake_prompt_id, axis=0)
-                sample_input_ids.append(fake_prompt_id)
-                sample_input_ids.append(splits[split_idx + 1])
+                sample_segments.append(splits[split_idx + 1])
 
-            sample_input_ids = np.concatenate(sample_input_ids, axis=1)
-            input_ids_list.append(sample_input_ids)
+            batch_segments.append(sample_segments)
 
         # Pad the input_ids to the same length for bs > 1
-        max_seq_len = max(
-            [sample_input_ids.shape[1] for sample_input_ids in input_ids_list])
-        input_ids_padded = []
-        for sample_input_ids in input_ids_list:
-            seq_len = sample_input_ids.shape[1]
-            pad_width = max_seq_len - seq_len
-            if pad_width > 0:
-                sample_input_ids_padded = np.pad(
-                    sample_input_ids, ((0, 0), (0, pad_width)),
-                    'constant',
-                    constant_values=self.tokenizer_pad_id)
-            else:
-                sample_input_ids_padded = sample_input_ids
-            input_ids_padded.append(sample_input_ids_padded)
-
-        input_ids = np.stack(input_ids_padded)
-        input_ids = input_ids.reshape(batch_size, -1).astype(np.int32)
-
-        return input_ids
+        return pack_segments(batch_segments, self.tokenizer_pad_id)
 
     def _process_multi_image_inputs(self, query, image_token_index=-200):
         """
@@ -517,28 +975,72 @@ class TritonPythonModel:
 
         return start_ids
 
-    def _create_request(self, query, visual_tokens=None):
+    def _can_batch_tokenize(self):
         """
-            query : batch string (2D numpy array)
+        Returns True when the queries of a whole `execute` call can be tokenized
+        at once. T5 prompts need a BOS id prepended and multi-image prompts are
+        split on `<image>` before tokenization, so both keep the per-query path.
         """
+        if not self.batch_tokenization:
+            return False
         if isinstance(self.tokenizer, T5Tokenizer):
+            return False
+        if self.is_multimodal and self.max_num_images and self.max_num_images > 1:
+            return False
+        return True
+
+    def _batch_encode(self, queries):
+        """
+        Tokenizes the queries of several requests in one call to the fast tokenizer.
+
+        Args:
+            queries (List[np.ndarray]): The QUERY tensor of each request.
+
+        Returns:
+            List[List[np.ndarray]]: The token ids of every query, grouped per request.
+        """
+        texts = [s[0].decode() for query in queries for s in query]
+        encoded = self.prompt_encoder.encode(texts)
+
+        batch_start_ids = []
+        offset = 0
+        for query in queries:
+            batch_start_ids.append([
+                np.array(ids, dtype=int)
+                for ids in encoded[offset:offset + query.shape[0]]
+            ])
+            offset += query.shape[0]
+        return batch_start_ids
+
+    def _create_request(self, query, visual_tokens=None, start_ids=None):
+        """
+            query : batch string (2D numpy array)
+            start_ids : token ids of `query` if it was already tokenized
+        """
+        if start_ids is not None:
+            # Already tokenized by `_batch_encode`
+            pass
+        elif isinstance(self.tokenizer, T5Tokenizer):
             start_ids = [
                 np.array([self.tokenizer_bos_id] + self.tokenizer.encode(
                     s[0].decode(), add_special_tokens=self.add_special_tokens)
                          ).astype(int) for s in query
             ]
+        elif self.is_multimodal and self.max_num_images and self.max_num_images > 1:
+            start_ids = self._process_multi_image_inputs(query)
+        elif self.prompt_cache:
+            start_ids = [
+                np.array(ids, dtype=int)
+                for ids in self.prompt_encoder.encode([s[0].decode() for s in query])
+            ]
         else:
-            if self.is_multimodal and self.max_num_images and self.max_num_images > 1:
-                start_ids = self._process_multi_image_inputs(query)
-
-            else:
-                start_ids = [
-                    np.array(
-                        self.tokenizer.encode(s[0].decode(),
-                                              add_special_tokens=self.
-                                              add_special_tokens)).astype(int)
-                    for s in query
-                ]
+            start_ids = [
+                np.array(
+                    self.tokenizer.encode(s[0].decode(),
+                                          add_special_tokens=self.
+                                          add_special_tokens)).astype(int)
+                for s in query
+            ]
 
         if self.is_multimodal:
             if 'blip2' in self.model_type or 'mllama' == self.model_type:
@@ -575,91 +1077,28 @@ class TritonPythonModel:
                 ]
                 batch_split_prompts = self._split_prompt_by_images(
                     concatenated_ids)
-                start_ids = self._setup_fake_prompts(query.shape[0],
-                                                     batch_split_prompts)
+                return self._setup_fake_prompts(query.shape[0],
+                                                batch_split_prompts)
             elif self.model_type == 'llava_onevision':
-                fake_prompt_ids = []
                 extra_id = np.array(
                     self.tokenizer.encode(
                         '\n',
                         add_special_tokens=self.add_special_tokens,
                         padding=True))
-                for tokens in visual_tokens:
-                    prompt_id = np.arange(self.vocab_size,
-                                          self.vocab_size + tokens)
-                    fake_prompt_ids.append(prompt_id)
-                start_ids = [
-                    np.concatenate((pre_prompt_id, prompt_id, extra_id, ids,
-                                    post_prompt_id),
-                                   axis=0)
-                    for prompt_id, ids in zip(fake_prompt_ids, start_ids)
-                ]
+                return pack_segments([
+                    (pre_prompt_id,
+                     np.arange(self.vocab_size, self.vocab_size + tokens),
+                     extra_id, ids, post_prompt_id)
+                    for tokens, ids in zip(visual_tokens, start_ids)
+                ], self.tokenizer_pad_id)
             else:
                 fake_prompt_id = np.arange(
                     self.vocab_size, self.vocab_size + self.ptable_shape[1])
-                start_ids = [
-                    np.concatenate(
-                        (pre_prompt_id, fake_prompt_id, ids, post_prompt_id),
-                        axis=0) for ids in start_ids
-                ]
-
-        start_lengths = np.array([[len(ids)] for ids in start_ids]).astype(int)
-
-        max_len = 0
-        for seq in start_ids:
-            max_len = max(max_len, seq.shape[0])
-        start_ids = np.stack([
-            np.pad(seq, (0, max_len - seq.shape[0]),
-                   'constant',
-                   constant_values=(0, self.tokenizer_pad_id))
-            for seq in start_ids
-        ])
-
-        return start_ids, start_lengths
+                return pack_segments(
+                    [(pre_prompt_id, fake_prompt_id, ids, post_prompt_id)
+                     for ids in start_ids], self.tokenizer_pad_id)
 
-    def _to_word_list_format(self, word_lists: List[List[str | bytes]],
-                             batch_size):
-        '''
-        word_lists format:
-            len(word_lists) == batch_size
-            word_lists[i] means the words associated to batch item i. A "word" may actually be any string. Like "lorem" or "lorem ipsum".
-        '''
-        assert self.tokenizer != None, "need to set tokenizer"
-
-        if word_lists is None:
-            # Return an empty array of shape (1,2,0)
-            return np.empty([batch_size, 2, 0], dtype="int32")
-
-        flat_ids = []
-        offsets = []
-        for word_list in word_lists:
-            item_flat_ids = []
-            item_offsets = []
-
-            for word in word_list:
-                if isinstance(word, bytes):
-                    word = word.decode()
-
-                ids = self.tokenizer.encode(word, add_special_tokens=False)
-                if len(ids) == 0:
-                    continue
-
-                item_flat_ids += ids
-                item_offsets.append(len(ids))
-
-            flat_ids.append(np.array(item_flat_ids))
-            offsets.append(np.cumsum(np.array(item_offsets)))
-
-        pad_to = max(1, max(len(ids) for ids in flat_ids))
-
-        for i, (ids, offs) in enumerate(zip(flat_ids, offsets)):
-            flat_ids[i] = np.pad(ids, (0, pad_to - len(ids)),
-                                 constant_values=0)
-            offsets[i] = np.pad(offs, (0, pad_to - len(offs)),
-                                constant_values=-1)
-
-        return np.array([flat_ids, offsets], dtype="int32").transpose(
-            (1, 0, 2))
+        return pack_sequences(start_ids, self.tokenizer_pad_id)
 
     def _get_embedding_bias(self, embedding_bias_words, embedding_bias_weights,
                             bias_dtype, batch_size):
@@ -670,31 +1109,18 @@ class TritonPythonModel:
             return np.empty([batch_size, 0],
                             dtype=self.embedding_bias_weights_dtype)
 
-        batch_embedding_bias = []
-        for words, weights in zip(embedding_bias_words,
-                                  embedding_bias_weights):
-
-            vocab_size = len(self.tokenizer.vocab)
-            embedding_bias = [0.] * vocab_size
-
-            assert len(words) == len(
-                weights
-            ), "Embedding bias words must have same dimension as embedding bias weights"
-
-            for word, weight in zip(words, weights):
-                if isinstance(word, bytes):
-                    word = word.decode()
-                ids = self.tokenizer.encode(word)
-
-                if len(ids) == 0:
-                    continue
-
-                for id in ids:
-                    embedding_bias[id] += weight
-
-            batch_embedding_bias.append(np.array(embedding_bias))
-
-        return np.array(batch_embedding_bias, dtype=bias_dtype)
+        batch_embedding_bias = np.zeros(
+            [len(embedding_bias_words), self.embedding_bias_vocab_size],
+            dtype=bias_dtype)
+        for embedding_bias, words, weights in zip(batch_embedding_bias,
+                                                  embedding_bias_words,
+                                                  embedding_bias_weights):
+            ids, values = self.word_list_encoder.embedding_bias_ids_and_values(
+                words, weights)
+            # Unbuffered add, the same id may appear in several words
+            np.add.at(embedding_bias, ids, values)
+
+        return batch_embedding_bias
 
 
 class VisionPreProcessor:
@@ -1,12 +1,21 @@
 import datetime
+import heapq
+import importlib.util
 import json
 import os
-import sys
+import socket
+import stat
+import tempfile
 import time
+from collections import OrderedDict, defaultdict, deque
 from dataclasses import dataclass
-from random import randint
-from threading import Lock, Thread
-from typing import Any, List
+from functools import lru_cache, partial
+from itertools import count
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from operator import attrgetter
+from threading import Condition, Lock, RLock, Thread
+from typing import Any, List, Optional
 
 import numpy as np
 import torch
@@ -21,37 +30,43 @@ METRIC_TOTAL_OUTPUT_TOKENS = "total_output_tokens"
 METRIC_TOTAL_INPUT_TOKENS = "total_input_tokens"
 import tensorrt_llm.logger as logger
 
-# From https://github.com/pytorch/pytorch/blob/39425feac799905402abe4d15667fa47c344f2d7/torch/testing/_internal/common_utils.py#L1761
-# Dict of NumPy dtype -> torch dtype (when the correspondence exists)
-numpy_to_torch_dtype_dict = {
-    np.bool_: torch.bool,
-    np.uint8: torch.uint8,
-    np.uint16: torch.uint16,
-    np.uint32: torch.uint32,
-    np.uint64: torch.uint64,
-    np.int8: torch.int8,
-    np.int16: torch.int16,
-    np.int32: torch.int32,
-    np.int64: torch.int64,
-    np.float16: torch.float16,
-    np.float32: torch.float32,
-    np.float64: torch.float64,
-    np.complex64: torch.complex64,
-    np.complex128: torch.complex128
+# Bounds of the wait of the awaiter loop for executor responses, the longer
+# one is reached while the executor stays idle.
+AWAITER_MIN_TIMEOUT_MS = 1
+AWAITER_MAX_TIMEOUT_MS = 64
+
+# Default buckets in milliseconds of the latency histograms, by the name of
+# the histogram. Each can be replaced by the `<name>_buckets_ms` parameter.
+DEFAULT_LATENCY_BUCKETS_MS = {
+    "time_to_first_token":
+    [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000],
+    "inter_token_latency": [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000],
+    "e2e_latency":
+    [50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 60000, 120000],
+    "queue_time": [1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000, 10000],
+    "enqueue_time": [0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000],
 }
 
-# Dict of torch dtype -> NumPy dtype
-torch_to_numpy_dtype_dict = {
-    value: key
-    for (key, value) in numpy_to_torch_dtype_dict.items()
+# Attributes of the iteration stats holding the stats the gauges are read
+# from, None for the iteration stats themselves
+STAT_GROUPS = (None, "kv_cache_stats", "static_batching_stats",
+               "inflight_batching_stats")
+
+# Tenant of the requests without a `tenant` parameter, whose limits also
+# apply to the tenants without limits of their own
+DEFAULT_TENANT = "default"
+
+# Errors the requests dropped by `DeadlineTracker` are answered with, by the
+# limit they exceeded
+DEADLINE_ERRORS = {
+    "deadline":
+    "Request exceeded its deadline_ms",
+    "queue_time":
+    "Request waited longer than max_queue_time_ms for its first response",
 }
-torch_to_numpy_dtype_dict.update({
-    torch.bfloat16: np.float32,
-    torch.complex32: np.complex64
-})
 
 
-@dataclass
+@dataclass(slots=True)
 class RequestData:
     triton_req_id: int
     triton_user_id: str
@@ -61,6 +76,700 @@ class RequestData:
     num_input_tokens: int
     num_output_tokens: int
     response_sender: Any
+    arrival_time: float = 0.0
+    first_response_time: Optional[float] = None
+    last_response_time: Optional[float] = None
+    tenant: Optional[str] = None
+    expired_error: Optional[str] = None
+    # Whether the request asked for its KV cache reuse stats, the executor
+    # may also return perf metrics the server collects for itself
+    return_kv_cache_reuse_stats: bool = False
+
+
+@dataclass(slots=True)
+class TritonRequestData:
+    triton_user_id: str
+    # Executor requests the Triton request was split into, and how many of
+    # them are not finished yet
+    req_ids: tuple
+    num_active: int
+
+
+class CancellationTracker:
+    """
+    Response senders of the in-flight Triton requests, keyed by Triton
+    request id, checked for cancellation by `cancellation_loop`.
+
+    Has its own lock, held only to copy or update the senders: the senders
+    are checked outside of it, once per Triton request however many executor
+    requests it was split into.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.response_senders = {}
+
+    def __len__(self):
+        return len(self.response_senders)
+
+    def add(self, triton_req_id, response_sender):
+        with self.lock:
+            self.response_senders[triton_req_id] = response_sender
+
+    def remove(self, triton_req_id):
+        with self.lock:
+            self.response_senders.pop(triton_req_id, None)
+
+    def pop_cancelled(self):
+        """Returns the ids of the newly cancelled Triton requests."""
+        with self.lock:
+            response_senders = list(self.response_senders.items())
+        cancelled = [
+            triton_req_id for triton_req_id, response_sender in response_senders
+            if response_sender.is_cancelled()
+        ]
+        if cancelled:
+            with self.lock:
+                for triton_req_id in cancelled:
+                    self.response_senders.pop(triton_req_id, None)
+        return cancelled
+
+
+class DeadlineTracker:
+    """
+    Deadlines of the in-flight Triton requests, for the limits of
+    `DEADLINE_ERRORS`, in a heap checked by `cancellation_loop`. The deadlines
+    of finished requests stay in the heap until they pass.
+
+    Has its own lock, like `CancellationTracker`.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.heap = []
+        self.deadlines = {}
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def add(self, triton_req_id, reason, deadline):
+        with self.lock:
+            self.deadlines[(triton_req_id, reason)] = deadline
+            heapq.heappush(self.heap, (deadline, triton_req_id, reason))
+
+    def remove(self, triton_req_id):
+        with self.lock:
+            for reason in DEADLINE_ERRORS:
+                self.deadlines.pop((triton_req_id, reason), None)
+
+    def pop_expired(self, now):
+        """Returns the Triton request ids and limits that expired by `now`."""
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, triton_req_id, reason = heapq.heappop(self.heap)
+                if self.deadlines.get((triton_req_id, reason)) == deadline:
+                    del self.deadlines[(triton_req_id, reason)]
+                    expired.append((triton_req_id, reason))
+        return expired
+
+
+# Messages between a `SharedExecutorServer` and its clients
+SHARED_EXECUTOR_ENQUEUE = "enqueue"
+SHARED_EXECUTOR_ENQUEUED = "enqueued"
+SHARED_EXECUTOR_ENQUEUE_FAILED = "enqueue_failed"
+SHARED_EXECUTOR_CANCEL = "cancel"
+SHARED_EXECUTOR_RESPONSES = "responses"
+
+
+class ResponseQueue:
+    """Executor responses handed over by another thread."""
+
+    def __init__(self):
+        self.condition = Condition()
+        self.responses = []
+
+    def put(self, responses):
+        with self.condition:
+            self.responses.extend(responses)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """Waits up to `timeout`, a `datetime.timedelta`, for responses."""
+        with self.condition:
+            if not self.responses:
+                self.condition.wait(
+                    timeout.total_seconds() if timeout is not None else None)
+            responses = self.responses
+            self.responses = []
+        return responses
+
+
+class SharedConnection:
+    """A connection several threads send messages on."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = Lock()
+
+    def send(self, message):
+        with self.lock:
+            self.connection.send(message)
+
+    def recv(self):
+        return self.connection.recv()
+
+    def close(self):
+        # Shutting the socket down wakes up the threads receiving from it on
+        # both ends, closing it alone does not
+        try:
+            with socket.socket(
+                    fileno=os.dup(self.connection.fileno())) as sock:
+                sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+
+class SharedExecutorServer:
+    """
+    Shares the executor of the model instance that owns it with the other
+    instances of the model, which connect to it through a
+    `SharedExecutorClient`. The requests they enqueue are run by this
+    executor and their responses routed back to them, so every instance
+    converts its requests and responses in its own process while a single
+    executor runs the engine.
+
+    The owning instance uses the server as its executor: a router thread
+    awaits all responses and queues those of its own requests locally.
+
+    Only the executor is shared. Each instance still applies the tenant
+    limits, deadlines and admission control to the requests it received,
+    and reports its own request metrics; iteration stats are reported by
+    the owning instance alone.
+    """
+
+    def __init__(self, executor, listener):
+        self.executor = executor
+        self.listener = listener
+        self.lock = Lock()
+        # Connection each executor request was enqueued from, None for the
+        # owning instance
+        self.owners = {}
+        self.connections = set()
+        self.local_responses = ResponseQueue()
+        self.running = True
+        self.router_thread = Thread(target=self.router_loop)
+        self.accept_thread = Thread(target=self.accept_loop, daemon=True)
+        self.router_thread.start()
+        self.accept_thread.start()
+
+    def can_enqueue_requests(self):
+        return self.executor.can_enqueue_requests()
+
+    def enqueue_requests(self, requests):
+        return self._enqueue(requests, None)
+
+    def cancel_request(self, req_id):
+        self.executor.cancel_request(req_id)
+
+    def await_responses(self, timeout=None):
+        return self.local_responses.get(timeout)
+
+    def get_latest_iteration_stats(self):
+        return self.executor.get_latest_iteration_stats()
+
+    def shutdown(self):
+        self.running = False
+        self.listener.close()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.close()
+        self.router_thread.join()
+        self.executor.shutdown()
+
+    def _enqueue(self, requests, connection):
+        # Registered under the lock, so the router can't get a response
+        # before knowing where it goes
+        with self.lock:
+            req_ids = self.executor.enqueue_requests(requests)
+            for req_id in req_ids:
+                self.owners[req_id] = connection
+        return req_ids
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                connection = SharedConnection(self.listener.accept())
+            except (AuthenticationError, EOFError, ConnectionError) as e:
+                pb_utils.Logger.log_error(
+                    f"Rejected a shared executor client that failed the "
+                    f"handshake: {e}")
+                continue
+            except OSError:
+                break
+            with self.lock:
+                self.connections.add(connection)
+            Thread(target=self.serve, args=(connection, ), daemon=True).start()
+
+    def serve(self, connection):
+        """Handles the messages of a client until it disconnects."""
+        try:
+            while True:
+                message = connection.recv()
+                if message[0] == SHARED_EXECUTOR_ENQUEUE:
+                    _, seq, requests = message
+                    try:
+                        req_ids = self._enqueue(requests, connection)
+                    except Exception as e:
+                        connection.send(
+                            (SHARED_EXECUTOR_ENQUEUE_FAILED, seq, str(e)))
+                    else:
+                        connection.send(
+                            (SHARED_EXECUTOR_ENQUEUED, seq, req_ids))
+                elif message[0] == SHARED_EXECUTOR_CANCEL:
+                    self.executor.cancel_request(message[1])
+        except (EOFError, OSError):
+            pass
+        except Exception as e:
+            # E.g. a message that could not be unpickled, the client fails
+            # its requests once disconnected
+            pb_utils.Logger.log_error(
+                f"Disconnecting a shared executor client after failing to "
+                f"receive its messages: {e}")
+        connection.close()
+        # Nobody is left to send the responses of the client to
+        with self.lock:
+            self.connections.discard(connection)
+            req_ids = [
+                req_id for req_id, owner in self.owners.items()
+                if owner is connection
+            ]
+        if self.running:
+            for req_id in req_ids:
+                self.executor.cancel_request(req_id)
+
+    def router_loop(self):
+        """Hands the executor responses to the instances that own them."""
+        while self.running:
+            responses = self.executor.await_responses(
+                timeout=datetime.timedelta(milliseconds=AWAITER_MAX_TIMEOUT_MS))
+            if not responses:
+                continue
+            routed = defaultdict(list)
+            with self.lock:
+                for response in responses:
+                    req_id = response.request_id
+                    owner = self.owners.get(req_id, self)
+                    if response.has_error() or response.result.is_final:
+                        self.owners.pop(req_id, None)
+                    routed[owner].append(response)
+            for owner, owned in routed.items():
+                if owner is None:
+                    self.local_responses.put(owned)
+                elif owner is not self:
+                    try:
+                        owner.send((SHARED_EXECUTOR_RESPONSES, owned))
+                    except Exception as e:
+                        self.drop_connection(owner, e)
+
+    def drop_connection(self, connection, error):
+        """
+        Disconnects a client responses could not be sent to, e.g. because
+        they could not be pickled, and keeps routing those of the others.
+        `serve` then cancels the requests of the client.
+        """
+        with self.lock:
+            connected = connection in self.connections
+            self.connections.discard(connection)
+        # A client that went away is not worth an error
+        if connected and self.running and not isinstance(error, OSError):
+            pb_utils.Logger.log_error(
+                f"Disconnecting a shared executor client after failing to "
+                f"send it responses: {error}")
+        connection.close()
+
+
+class SharedExecutorClient:
+    """
+    Stands in for the executor in the model instances that use the executor
+    of another instance through its `SharedExecutorServer`. Iteration stats
+    are only reported by the owning instance.
+    """
+
+    def __init__(self, connection):
+        self.connection = SharedConnection(connection)
+        self.responses = ResponseQueue()
+        self.condition = Condition()
+        self.enqueued = {}
+        # Executor requests not finished yet, failed if the connection is lost
+        self.active = set()
+        self.seqs = count(1)
+        self.connected = True
+        self.reader_thread = Thread(target=self.reader_loop, daemon=True)
+        self.reader_thread.start()
+
+    def can_enqueue_requests(self):
+        return self.connected
+
+    def enqueue_requests(self, requests):
+        seq = next(self.seqs)
+        try:
+            self.connection.send((SHARED_EXECUTOR_ENQUEUE, seq, requests))
+        except OSError:
+            self.connected = False
+        except Exception as e:
+            # The message is pickled before anything is sent
+            raise pb_utils.TritonModelException(
+                f"Failed to send the requests to the shared executor, they "
+                f"could not be pickled: {e}") from e
+        with self.condition:
+            self.condition.wait_for(
+                lambda: seq in self.enqueued or not self.connected)
+            if seq not in self.enqueued:
+                raise pb_utils.TritonModelException(
+                    "Lost the connection to the shared executor")
+            req_ids = self.enqueued.pop(seq)
+        if isinstance(req_ids, Exception):
+            raise req_ids
+        return req_ids
+
+    def cancel_request(self, req_id):
+        try:
+            self.connection.send((SHARED_EXECUTOR_CANCEL, req_id))
+        except OSError:
+            pass
+
+    def await_responses(self, timeout=None):
+        return self.responses.get(timeout)
+
+    def get_latest_iteration_stats(self):
+        return []
+
+    def shutdown(self):
+        self.connected = False
+        self.connection.close()
+        self.reader_thread.join()
+
+    def reader_loop(self):
+        try:
+            while True:
+                message = self.connection.recv()
+                if message[0] == SHARED_EXECUTOR_RESPONSES:
+                    responses = message[1]
+                    with self.condition:
+                        for response in responses:
+                            if response.has_error(
+                            ) or response.result.is_final:
+                                self.active.discard(response.request_id)
+                    self.responses.put(responses)
+                elif message[0] == SHARED_EXECUTOR_ENQUEUED:
+                    with self.condition:
+                        self.enqueued[message[1]] = message[2]
+                        self.active.update(message[2])
+                        self.condition.notify_all()
+                elif message[0] == SHARED_EXECUTOR_ENQUEUE_FAILED:
+                    with self.condition:
+                        self.enqueued[message[1]] = (
+                            pb_utils.TritonModelException(
+                                f"The shared executor failed to enqueue the "
+                                f"requests: {message[2]}"))
+                        self.condition.notify_all()
+        except (EOFError, OSError):
+            pass
+        with self.condition:
+            self.connected = False
+            active = self.active
+            self.active = set()
+            self.condition.notify_all()
+        self.responses.put([
+            trtllm.Response(request_id=req_id,
+                            error_msg="Lost the connection to the shared "
+                            "executor") for req_id in active
+        ])
+
+
+def check_private_directory(directory):
+    """
+    Creates `directory` if needed and raises if it is not a directory owned
+    by the user that only they can access.
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid()
+            or stat.S_IMODE(info.st_mode) != 0o700):
+        raise pb_utils.TritonModelException(
+            f"The shared executor directory {directory} must be a directory "
+            f"owned by the user with mode 0700")
+
+
+def load_shared_executor_authkey(path):
+    """
+    Returns the random key the instances sharing an executor authenticate
+    with, created at `path` by the first instance that gets there.
+    """
+    if not os.path.exists(path):
+        temp_path = f"{path}.{os.getpid()}"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(os.urandom(32))
+        try:
+            # Fails if another instance created it first
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temp_path)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def connect_shared_executor(address, create_executor):
+    """
+    Returns a `SharedExecutorServer` around the executor `create_executor`
+    returns if no other instance listens on `address` yet, a
+    `SharedExecutorClient` connected to it otherwise. `address` is a Unix
+    socket path, in a directory owned by the user with mode 0700; the random
+    key the instances authenticate with is kept next to it.
+    """
+    check_private_directory(os.path.dirname(address))
+    authkey = load_shared_executor_authkey(f"{address}.key")
+    while True:
+        try:
+            listener = Listener(address, family="AF_UNIX", authkey=authkey)
+        except OSError:
+            pass
+        else:
+            try:
+                executor = create_executor()
+            except Exception:
+                # Closing the listener also unlinks its socket, so the next
+                # instance tries to own the executor instead of connecting
+                listener.close()
+                raise
+            return SharedExecutorServer(executor, listener)
+        try:
+            return SharedExecutorClient(
+                Client(address, family="AF_UNIX", authkey=authkey))
+        except ConnectionRefusedError:
+            # Left behind by an instance that did not shut down cleanly
+            try:
+                os.unlink(address)
+            except FileNotFoundError:
+                pass
+        except FileNotFoundError:
+            # The owning instance shut down in the meantime
+            pass
+        except (AuthenticationError, EOFError, OSError) as e:
+            raise pb_utils.TritonModelException(
+                f"Failed the handshake with the shared executor at {address}, "
+                f"the instances must share the key in {address}.key: {e}"
+            ) from e
+
+
+@dataclass
+class TenantLimits:
+    max_active_requests: Optional[int] = None
+    max_tokens_per_second: Optional[float] = None
+    priority: Optional[float] = None
+
+
+@dataclass
+class PendingRequest:
+    """A Triton request converted to executor requests, not enqueued yet."""
+    triton_req_id: int
+    triton_user_id: str
+    triton_request: Any
+    executor_requests: list
+    arrival_time: float
+    tenant: Optional[str] = None
+    num_tokens: int = 0
+    # `return_kv_cache_reuse_stats` of each executor request
+    return_kv_cache_reuse_stats: tuple = ()
+
+
+class AdmissionController:
+    """
+    Queues the requests of each tenant until its limits let them into the
+    executor: at most `max_active_requests` executor requests in flight and
+    `max_tokens_per_second` prompt and output tokens, with a burst of one
+    second. Tenants take turns, one request each, so a tenant with a long
+    queue does not hold back the others.
+
+    Has its own lock, requests are admitted from `execute`, when executor
+    requests finish and periodically as the token budgets refill.
+    """
+
+    def __init__(self, limits):
+        self.lock = Lock()
+        self.limits = limits
+        self.queues = OrderedDict()
+        self.active = {}
+        self.tokens = {}
+        self.refill_times = {}
+
+    def limits_of(self, tenant):
+        return (self.limits.get(tenant) or self.limits.get(DEFAULT_TENANT)
+                or TenantLimits())
+
+    def submit(self, pending_requests):
+        with self.lock:
+            for pending in pending_requests:
+                self.active.setdefault(pending.tenant, 0)
+                self.queues.setdefault(pending.tenant,
+                                       deque()).append(pending)
+
+    def release(self, tenant, n=1):
+        """Records that `n` executor requests of `tenant` finished."""
+        with self.lock:
+            self.active[tenant] -= n
+
+    def pop_admissible(self):
+        """Returns the queued requests that can be enqueued now."""
+        now = time.monotonic()
+        admitted = []
+        with self.lock:
+            progress = True
+            while progress:
+                progress = False
+                for tenant, queue in list(self.queues.items()):
+                    pending = queue[0]
+                    if not self._admit(tenant, pending, now):
+                        continue
+                    admitted.append(queue.popleft())
+                    progress = True
+                    if queue:
+                        self.queues.move_to_end(tenant)
+                    else:
+                        del self.queues[tenant]
+        return admitted
+
+    def remove(self, predicate):
+        """Removes and returns the queued requests matching `predicate`."""
+        removed = []
+        with self.lock:
+            for tenant, queue in list(self.queues.items()):
+                kept = deque()
+                for pending in queue:
+                    (removed if predicate(pending) else kept).append(pending)
+                if kept:
+                    self.queues[tenant] = kept
+                else:
+                    del self.queues[tenant]
+        return removed
+
+    def request_counts(self):
+        """Returns the queued Triton and active executor requests by tenant."""
+        with self.lock:
+            return {
+                tenant:
+                (len(self.queues.get(tenant, ())), self.active[tenant])
+                for tenant in self.active
+            }
+
+    def _admit(self, tenant, pending, now):
+        limits = self.limits_of(tenant)
+        size = len(pending.executor_requests)
+        active = self.active[tenant]
+        # A request larger than the limits is let in once the tenant is idle
+        if (limits.max_active_requests is not None and active > 0
+                and active + size > limits.max_active_requests):
+            return False
+        if limits.max_tokens_per_second is not None:
+            rate = limits.max_tokens_per_second
+            tokens = min(
+                rate,
+                self.tokens.get(tenant, rate) +
+                (now - self.refill_times.get(tenant, now)) * rate)
+            self.tokens[tenant] = tokens
+            self.refill_times[tenant] = now
+            if tokens < min(pending.num_tokens, rate):
+                return False
+            self.tokens[tenant] = tokens - pending.num_tokens
+        self.active[tenant] = active + size
+        return True
+
+
+def parse_tenant_limits(tenant_limits):
+    """
+    Parses the `tenant_limits` parameter, a JSON object of the limits of each
+    tenant, e.g. {"my-agent": {"max_active_requests": 8,
+    "max_tokens_per_second": 20000, "priority": 0.2}}.
+    """
+    if tenant_limits is None:
+        return None
+    try:
+        limits = json.loads(tenant_limits)
+        assert isinstance(limits, dict)
+        return {
+            str(tenant): TenantLimits(**values)
+            for tenant, values in limits.items()
+        }
+    except Exception:
+        raise pb_utils.TritonModelException(
+            "Invalid format for tenant_limits")
+
+
+def get_request_tenant(request):
+    """Returns the `tenant` parameter of a request, the default if unset."""
+    parameters = request.parameters()
+    tenant = json.loads(parameters).get("tenant") if parameters else None
+    return str(tenant) if tenant else DEFAULT_TENANT
+
+
+# Inputs of the fused model, which follow the `llama-3.1-8b-instruct` ensemble,
+# mapped to the tensorrt_llm inputs `convert_request` reads them as.
+FUSED_INPUT_NAMES = {
+    "max_tokens": "request_output_len",
+    "top_k": "runtime_top_k",
+    "top_p": "runtime_top_p",
+    "length_penalty": "len_penalty",
+    "stream": "streaming",
+}
+
+# Inputs of the fused model replaced by the tensors its tokenization produces
+FUSED_TOKENIZED_INPUTS = {
+    "text_input", "decoder_text_input", "bad_words", "stop_words",
+    "embedding_bias_words", "embedding_bias_weights", "prompt_table_extra_id"
+}
+
+# tensorrt_llm outputs the fused model replaces with `text_output`
+FUSED_DROPPED_OUTPUTS = {
+    "output_ids", "sequence_length", "is_final", "stream_id"
+}
+
+
+class FusedRequest:
+    """
+    Presents a request of the fused model to `convert_request` as if it came
+    from preprocessing: renames the ensemble inputs and replaces the text
+    inputs with their tokenized tensors.
+    """
+
+    def __init__(self, request, tensors):
+        self.request = request
+        self.tensors = tensors
+
+    def inputs(self):
+        return self.tensors
+
+    def request_id(self):
+        return self.request.request_id()
+
+
+def load_fused_module(name):
+    """
+    Imports `<name>.py` next to this file: the model.py of the preprocessing
+    or postprocessing model, whose tokenization and detokenization the fused
+    model reuses.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        f"{name}.py")
+    spec = importlib.util.spec_from_file_location(f"{__name__}_{name}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
 
 def mpi_comm():
@@ -72,20 +781,7 @@ def mpi_rank():
     return mpi_comm().Get_rank()
 
 
-def get_input_tensor_by_name(request,
-                             name,
-                             expected_batch_size=None,
-                             batch_index=None,
-                             force_on_torch=False):
-    tensor = pb_utils.get_input_tensor_by_name(request, name)
-    if tensor is None:
-        return None
-
-    if tensor.is_cpu() and not force_on_torch:
-        tensor = tensor.as_numpy()
-    else:
-        tensor = from_dlpack(tensor.to_dlpack())
-
+def select_batch_index(tensor, name, expected_batch_size, batch_index):
     if expected_batch_size is not None and tensor.shape[
             0] != expected_batch_size:
         raise pb_utils.TritonModelException(
@@ -98,14 +794,28 @@ def get_input_tensor_by_name(request,
 
     if batch_index is not None:
         # Add leading 1 batch dimension
-        if isinstance(tensor, np.ndarray):
-            return np.expand_dims(tensor[batch_index], axis=0)
-        elif isinstance(tensor, torch.Tensor):
-            return torch.unsqueeze(tensor[batch_index], dim=0)
+        return tensor[batch_index:batch_index + 1]
     else:
         return tensor
 
 
+def get_input_tensor_by_name(request,
+                             name,
+                             expected_batch_size=None,
+                             batch_index=None,
+                             force_on_torch=False):
+    tensor = pb_utils.get_input_tensor_by_name(request, name)
+    if tensor is None:
+        return None
+
+    if tensor.is_cpu() and not force_on_torch:
+        tensor = tensor.as_numpy()
+    else:
+        tensor = from_dlpack(tensor.to_dlpack())
+
+    return select_batch_index(tensor, name, expected_batch_size, batch_index)
+
+
 def get_input_scalar_by_name(request,
                              name,
                              expected_batch_size=1,
@@ -122,6 +832,58 @@ def get_input_scalar_by_name(request,
     return tensor.item(batch_index)
 
 
+class RequestInputs:
+    """
+    The inputs of one Triton request for `convert_request`, each fetched from
+    the request once and reused for every batch index. `tensor` and `scalar`
+    check and return the same as `get_input_tensor_by_name` and
+    `get_input_scalar_by_name`, as views of the fetched arrays.
+    """
+
+    def __init__(self, request):
+        self.triton_tensors = {
+            tensor.name(): tensor
+            for tensor in request.inputs()
+        }
+        self.tensors = {}
+        self.scalars = {}
+
+    def tensor(self,
+               name,
+               expected_batch_size=None,
+               batch_index=None,
+               force_on_torch=False):
+        key = (name, force_on_torch)
+        if key not in self.tensors:
+            tensor = self.triton_tensors.get(name)
+            if tensor is not None:
+                if tensor.is_cpu() and not force_on_torch:
+                    tensor = tensor.as_numpy()
+                else:
+                    tensor = from_dlpack(tensor.to_dlpack())
+            self.tensors[key] = tensor
+        tensor = self.tensors[key]
+        if tensor is None:
+            return None
+        return select_batch_index(tensor, name, expected_batch_size,
+                                  batch_index)
+
+    def scalar(self, name, expected_batch_size=1, batch_index=0):
+        if name not in self.scalars:
+            tensor = self.triton_tensors.get(name)
+            self.scalars[name] = None if tensor is None else tensor.as_numpy(
+            ).reshape(-1).tolist()
+        values = self.scalars[name]
+        if values is None:
+            return None
+
+        if len(values) != expected_batch_size:
+            raise pb_utils.TritonModelException(
+                f"Expected a scalar tensor for tensor {name}")
+
+        return values[batch_index]
+
+
 def read_parameter_as_type(value, name, pytype=str):
     if value == "":
         return None
@@ -188,92 +950,106 @@ def parse_eagle_choices(eagle_choices):
     return parse_medusa_choices(eagle_choices)
 
 
-def get_sampling_config_from_request(request, batch_size=1, batch_index=0):
+def parse_buckets(buckets, name):
+    """Parses comma separated histogram buckets, returns them sorted."""
+    if buckets is None:
+        return None
+    try:
+        result = sorted(float(x) for x in buckets.split(",") if x.strip())
+        assert len(result) > 0
+    except Exception:
+        raise pb_utils.TritonModelException(f"Invalid format for {name}")
+    return result
+
+
+def get_sampling_config_from_request(request_inputs,
+                                     batch_size=1,
+                                     batch_index=0):
     kwargs = {}
-    kwargs['beam_width'] = get_input_scalar_by_name(
-        request, 'beam_width', batch_size, batch_index) or 1
-    kwargs['top_k'] = get_input_scalar_by_name(request, 'runtime_top_k',
-                                               batch_size, batch_index)
-    kwargs['top_p'] = get_input_scalar_by_name(request, 'runtime_top_p',
-                                               batch_size, batch_index)
+    kwargs['beam_width'] = request_inputs.scalar(
+        'beam_width', batch_size, batch_index) or 1
+    kwargs['top_k'] = request_inputs.scalar('runtime_top_k', batch_size,
+                                            batch_index)
+    kwargs['top_p'] = request_inputs.scalar('runtime_top_p', batch_size,
+                                            batch_index)
     kwargs['top_p'] = None if kwargs['top_p'] is None or kwargs[
         'top_p'] <= 0 else kwargs['top_p']
-    kwargs['random_seed'] = get_input_scalar_by_name(request, 'random_seed',
-                                                     batch_size, batch_index)
-    kwargs['temperature'] = get_input_scalar_by_name(request, 'temperature',
-                                                     batch_size, batch_index)
-    kwargs['min_length'] = get_input_scalar_by_name(request, 'min_length',
-                                                    batch_size, batch_index)
-    kwargs['repetition_penalty'] = get_input_scalar_by_name(
-        request, 'repetition_penalty', batch_size, batch_index)
-    kwargs['presence_penalty'] = get_input_scalar_by_name(
-        request, 'presence_penalty', batch_size, batch_index)
-    kwargs['frequency_penalty'] = get_input_scalar_by_name(
-        request, 'frequency_penalty', batch_size, batch_index)
-    kwargs['length_penalty'] = get_input_scalar_by_name(
-        request, 'len_penalty', batch_size, batch_index)
-    kwargs['top_p_min'] = get_input_scalar_by_name(request,
-                                                   'runtime_top_p_min',
-                                                   batch_size, batch_index)
-    kwargs['top_p_reset_ids'] = get_input_scalar_by_name(
-        request, 'runtime_top_p_reset_ids', batch_size, batch_index)
-    kwargs['top_p_decay'] = get_input_scalar_by_name(request,
-                                                     'runtime_top_p_decay',
+    kwargs['random_seed'] = request_inputs.scalar('random_seed', batch_size,
+                                                  batch_index)
+    kwargs['temperature'] = request_inputs.scalar('temperature', batch_size,
+                                                  batch_index)
+    kwargs['min_length'] = request_inputs.scalar('min_length', batch_size,
+                                                 batch_index)
+    kwargs['repetition_penalty'] = request_inputs.scalar(
+        'repetition_penalty', batch_size, batch_index)
+    kwargs['presence_penalty'] = request_inputs.scalar(
+        'presence_penalty', batch_size, batch_index)
+    kwargs['frequency_penalty'] = request_inputs.scalar(
+        'frequency_penalty', batch_size, batch_index)
+    kwargs['length_penalty'] = request_inputs.scalar('len_penalty',
                                                      batch_size, batch_index)
-    kwargs['beam_search_diversity_rate'] = get_input_scalar_by_name(
-        request, 'beam_search_diversity_rate', batch_size, batch_index)
-    kwargs['early_stopping'] = get_input_scalar_by_name(
-        request, 'early_stopping', batch_size, batch_index)
-    kwargs['num_return_sequences'] = get_input_scalar_by_name(
-        request, 'num_return_sequences', batch_size, batch_index) or 1
+    kwargs['top_p_min'] = request_inputs.scalar('runtime_top_p_min',
+                                                batch_size, batch_index)
+    kwargs['top_p_reset_ids'] = request_inputs.scalar(
+        'runtime_top_p_reset_ids', batch_size, batch_index)
+    kwargs['top_p_decay'] = request_inputs.scalar('runtime_top_p_decay',
+                                                  batch_size, batch_index)
+    kwargs['beam_search_diversity_rate'] = request_inputs.scalar(
+        'beam_search_diversity_rate', batch_size, batch_index)
+    kwargs['early_stopping'] = request_inputs.scalar(
+        'early_stopping', batch_size, batch_index)
+    kwargs['num_return_sequences'] = request_inputs.scalar(
+        'num_return_sequences', batch_size, batch_index) or 1
     kwargs = {k: v for k, v in kwargs.items() if v is not None}
     return trtllm.SamplingConfig(**kwargs)
 
 
-def get_output_config_from_request(request, batch_size=1, batch_index=0):
+def get_output_config_from_request(request_inputs,
+                                   batch_size=1,
+                                   batch_index=0):
     kwargs = {}
-    kwargs["return_log_probs"] = get_input_scalar_by_name(
-        request, 'return_log_probs', batch_size, batch_index)
-    kwargs["return_context_logits"] = get_input_scalar_by_name(
-        request, 'return_context_logits', batch_size, batch_index)
-    kwargs["return_generation_logits"] = get_input_scalar_by_name(
-        request, 'return_generation_logits', batch_size, batch_index)
-    kwargs["return_perf_metrics"] = get_input_scalar_by_name(
-        request, 'return_kv_cache_reuse_stats', batch_size, batch_index)
+    kwargs["return_log_probs"] = request_inputs.scalar(
+        'return_log_probs', batch_size, batch_index)
+    kwargs["return_context_logits"] = request_inputs.scalar(
+        'return_context_logits', batch_size, batch_index)
+    kwargs["return_generation_logits"] = request_inputs.scalar(
+        'return_generation_logits', batch_size, batch_index)
+    kwargs["return_perf_metrics"] = request_inputs.scalar(
+        'return_kv_cache_reuse_stats', batch_size, batch_index)
     kwargs = {k: v for k, v in kwargs.items() if v is not None}
     return trtllm.OutputConfig(**kwargs)
 
 
-def get_external_draft_tokens_config_from_request(request,
+def get_external_draft_tokens_config_from_request(request_inputs,
                                                   batch_size=1,
                                                   batch_index=0):
     kwargs = {}
-    draft_input_ids = get_input_tensor_by_name(request, 'draft_input_ids',
-                                               batch_size, batch_index)
+    draft_input_ids = request_inputs.tensor('draft_input_ids', batch_size,
+                                            batch_index)
     if draft_input_ids is not None:
         kwargs['tokens'] = draft_input_ids[0].tolist()
-    draft_logits = get_input_tensor_by_name(request, 'draft_logits',
-                                            batch_size, batch_index)
+    draft_logits = request_inputs.tensor('draft_logits', batch_size,
+                                         batch_index)
     if draft_logits is not None:
         kwargs['logits'] = from_numpy(draft_logits).squeeze(dim=0)
-    kwargs['acceptance_threshold'] = get_input_scalar_by_name(
-        request, 'draft_acceptance_threshold', batch_size, batch_index)
+    kwargs['acceptance_threshold'] = request_inputs.scalar(
+        'draft_acceptance_threshold', batch_size, batch_index)
     kwargs = {k: v for k, v in kwargs.items() if v is not None}
     if len(kwargs) > 0:
         return trtllm.ExternalDraftTokensConfig(**kwargs)
     return None
 
 
-def get_prompt_tuning_config_from_request(request,
+def get_prompt_tuning_config_from_request(request_inputs,
                                           batch_size=1,
                                           batch_index=0,
                                           input_length=0):
     # prompt_vocab_size is unused by executor.
     kwargs = {}
-    prompt_embedding_table = get_input_tensor_by_name(
-        request, 'prompt_embedding_table', batch_size, batch_index)
-    prompt_table_extra_ids = get_input_tensor_by_name(
-        request, 'prompt_table_extra_ids', batch_size, batch_index)
+    prompt_embedding_table = request_inputs.tensor(
+        'prompt_embedding_table', batch_size, batch_index)
+    prompt_table_extra_ids = request_inputs.tensor(
+        'prompt_table_extra_ids', batch_size, batch_index)
     if prompt_embedding_table is not None:
         if isinstance(prompt_embedding_table, np.ndarray):
             kwargs["embedding_table"] = from_numpy(
@@ -292,16 +1068,15 @@ def get_prompt_tuning_config_from_request(request,
     return None
 
 
-def get_lora_config_from_request(request, batch_size=1, batch_index=0):
+def get_lora_config_from_request(request_inputs, batch_size=1, batch_index=0):
     kwargs = {}
-    kwargs["task_id"] = get_input_scalar_by_name(request, 'lora_task_id',
-                                                 batch_size, batch_index)
-    lora_weights = get_input_tensor_by_name(request, 'lora_weights',
-                                            batch_size, batch_index)
+    kwargs["task_id"] = request_inputs.scalar('lora_task_id', batch_size,
+                                              batch_index)
+    lora_weights = request_inputs.tensor('lora_weights', batch_size,
+                                         batch_index)
     if lora_weights is not None:
         kwargs["weights"] = from_numpy(lora_weights).squeeze(dim=0)
-    lora_config = get_input_tensor_by_name(request, 'lora_config', batch_size,
-                                           batch_index)
+    lora_config = request_inputs.tensor('lora_config', batch_size, batch_index)
     if lora_config is not None:
         kwargs["config"] = from_numpy(lora_config).squeeze(dim=0)
     kwargs = {k: v for k, v in kwargs.items() if v is not None}
@@ -310,12 +1085,12 @@ def get_lora_config_from_request(request, batch_size=1, batch_index=0):
     return None
 
 
-def get_guided_decoding_params_from_request(request,
+def get_guided_decoding_params_from_request(request_inputs,
                                             batch_size=1,
                                             batch_index=0):
     kwargs = {}
-    guided_decoding_guide_type = get_input_tensor_by_name(
-        request, 'guided_decoding_guide_type', batch_size, batch_index)
+    guided_decoding_guide_type = request_inputs.tensor(
+        'guided_decoding_guide_type', batch_size, batch_index)
     if guided_decoding_guide_type is not None:
         guided_decoding_guide_type = guided_decoding_guide_type.squeeze(
             axis=0)[0].decode()
@@ -329,9 +1104,8 @@ def get_guided_decoding_params_from_request(request,
             guided_decoding_guide_type)
     kwargs['guide_type'] = guided_decoding_guide_type
 
-    guided_decoding_guide = get_input_tensor_by_name(request,
-                                                     'guided_decoding_guide',
-                                                     batch_size, batch_index)
+    guided_decoding_guide = request_inputs.tensor('guided_decoding_guide',
+                                                  batch_size, batch_index)
     if guided_decoding_guide is not None:
         kwargs['guide'] = guided_decoding_guide.squeeze(axis=0)[0].decode()
     kwargs = {k: v for k, v in kwargs.items() if v is not None}
@@ -340,13 +1114,12 @@ def get_guided_decoding_params_from_request(request,
     return None
 
 
-def get_kv_cache_retention_config_from_request(request,
+def get_kv_cache_retention_config_from_request(request_inputs,
                                                batch_size=1,
                                                batch_index=0):
 
     def get_tensor_and_check_length(name: str, expected_length: int):
-        tensor = get_input_tensor_by_name(request, name, batch_size,
-                                          batch_index)
+        tensor = request_inputs.tensor(name, batch_size, batch_index)
 
         if tensor is None:
             raise RuntimeError(f"{name} must be provided.")
@@ -360,8 +1133,8 @@ def get_kv_cache_retention_config_from_request(request,
 
         return tensor
 
-    token_range_starts = get_input_tensor_by_name(
-        request, "retention_token_range_starts", batch_size, batch_index)
+    token_range_starts = request_inputs.tensor(
+        "retention_token_range_starts", batch_size, batch_index)
 
     if token_range_starts is not None:
         token_range_starts = np.squeeze(token_range_starts, axis=0)
@@ -375,9 +1148,8 @@ def get_kv_cache_retention_config_from_request(request,
         token_range_priorities = get_tensor_and_check_length(
             "retention_token_range_priorities", len(token_range_starts))
 
-        token_range_durations_ms = get_input_tensor_by_name(
-            request, "retention_token_range_durations_ms", batch_size,
-            batch_index)
+        token_range_durations_ms = request_inputs.tensor(
+            "retention_token_range_durations_ms", batch_size, batch_index)
 
         if token_range_durations_ms is None:
             token_range_durations_ms = [None] * len(token_range_starts)
@@ -410,13 +1182,13 @@ def get_kv_cache_retention_config_from_request(request,
 
         decode_args = {}
 
-        decode_priority = get_input_scalar_by_name(
-            request, "retention_decode_priority", batch_size, batch_index)
+        decode_priority = request_inputs.scalar(
+            "retention_decode_priority", batch_size, batch_index)
         if decode_priority is not None:
             decode_args['decode_retention_priority'] = decode_priority
 
-        decode_duration_ms = get_input_scalar_by_name(
-            request, "retention_decode_duration_ms", batch_size, batch_index)
+        decode_duration_ms = request_inputs.scalar(
+            "retention_decode_duration_ms", batch_size, batch_index)
         if decode_duration_ms is not None:
             decode_args[
                 'decode_duration_ms'] = decode_duration_ms if decode_duration_ms != -1 else None
@@ -427,6 +1199,36 @@ def get_kv_cache_retention_config_from_request(request,
     return None
 
 
+def get_engine_vocab_size(engine_dir):
+    """Reads the vocabulary size from the engine config, None if unavailable."""
+    if not engine_dir:
+        return None
+    config_path = os.path.join(engine_dir, "config.json")
+    if not os.path.exists(config_path):
+        return None
+    with open(config_path) as f:
+        return json.load(f)["pretrained_config"]["vocab_size"]
+
+
+def densify_embedding_bias(embedding_bias_ids, embedding_bias_values,
+                           vocab_size):
+    """
+    Builds the dense [vocab_size] embedding bias from the sparse ids and values
+    emitted by preprocessing. Ids are padded with -1 and may repeat, in which
+    case their values are summed.
+    """
+    if vocab_size is None:
+        raise pb_utils.TritonModelException(
+            "A sparse embedding bias requires the vocabulary size from the engine config"
+        )
+    valid = embedding_bias_ids >= 0
+    embedding_bias = torch.zeros(vocab_size, dtype=torch.float32)
+    embedding_bias.index_add_(
+        0, from_numpy(embedding_bias_ids[valid].astype(np.int64)),
+        from_numpy(embedding_bias_values[valid].astype(np.float32)))
+    return embedding_bias
+
+
 def build_1_2_5_buckets(max_value: int) -> List[int]:
     """
     Builds a list of buckets with increasing powers of 10 multiplied by
@@ -450,66 +1252,78 @@ def build_1_2_5_buckets(max_value: int) -> List[int]:
         exponent += 1
 
 
-def convert_request(request, exclude_input_from_output, decoupled):
+def convert_request(request,
+                    exclude_input_from_output,
+                    decoupled,
+                    vocab_size=None):
+    request_inputs = RequestInputs(request)
     inputs = {}
-    input_token_ids = get_input_tensor_by_name(request, 'input_ids')
-    if input_token_ids is None:
+    batch_input_token_ids = request_inputs.tensor('input_ids')
+    if batch_input_token_ids is None:
         raise pb_utils.TritonModelException(
             "A value is required for input_ids")
-    if len(input_token_ids.shape) != 2:
+    if len(batch_input_token_ids.shape) != 2:
         raise pb_utils.TritonModelException(f"Invalid format for input_ids")
-    batch_size = input_token_ids.shape[0]
+    batch_size = batch_input_token_ids.shape[0]
     requests = []
     for batch_index in range(0, batch_size):
-        input_token_ids = get_input_tensor_by_name(request, 'input_ids',
-                                                   batch_size, batch_index)[0]
-        if input_token_ids is None:
-            raise pb_utils.TritonModelException(
-                "A value is required for input_ids")
-        input_token_ids = input_token_ids.tolist()
+        input_token_ids = batch_input_token_ids[batch_index]
         if len(input_token_ids) == 0:
             raise pb_utils.TritonModelException(
                 f"Invalid format for input_ids")
 
-        input_length = get_input_scalar_by_name(request, 'input_lengths',
-                                                batch_size, batch_index)
+        input_length = request_inputs.scalar('input_lengths', batch_size,
+                                             batch_index)
         if input_length is None:
             input_length = len(input_token_ids)
-        # Trim input token ids with input_lengths
-        inputs['input_token_ids'] = input_token_ids[0:input_length]
-        inputs['max_new_tokens'] = get_input_scalar_by_name(
-            request, 'request_output_len', batch_size, batch_index)
+        # Trim input token ids with input_lengths. The bindings copy them
+        # into a std::vector one element at a time, so they are handed over
+        # as Python ints rather than as NumPy scalars of a view
+        inputs['input_token_ids'] = input_token_ids[0:input_length].tolist()
+        inputs['max_new_tokens'] = request_inputs.scalar(
+            'request_output_len', batch_size, batch_index)
         if inputs['max_new_tokens'] is None:
             raise pb_utils.TritonModelException(
                 "A value is required for request_output_len")
-        inputs['streaming'] = get_input_scalar_by_name(request, 'streaming',
-                                                       batch_size, batch_index)
+        inputs['streaming'] = request_inputs.scalar('streaming', batch_size,
+                                                    batch_index)
         if inputs['streaming'] and not decoupled:
             raise pb_utils.TritonModelException(
                 "Streaming is only supported in decoupled mode.")
 
-        inputs['end_id'] = get_input_scalar_by_name(request, 'end_id',
-                                                    batch_size, batch_index)
-        inputs['pad_id'] = get_input_scalar_by_name(request, 'pad_id',
-                                                    batch_size, batch_index)
+        inputs['end_id'] = request_inputs.scalar('end_id', batch_size,
+                                                 batch_index)
+        inputs['pad_id'] = request_inputs.scalar('pad_id', batch_size,
+                                                 batch_index)
         inputs['stop_words'] = convert_word_list(
-            get_input_tensor_by_name(request, 'stop_words_list', batch_size,
-                                     batch_index))
+            request_inputs.tensor('stop_words_list', batch_size, batch_index))
         inputs['bad_words'] = convert_word_list(
-            get_input_tensor_by_name(request, 'bad_words_list', batch_size,
-                                     batch_index))
-        embedding_bias = get_input_tensor_by_name(request, 'embedding_bias',
-                                                  batch_size, batch_index)
+            request_inputs.tensor('bad_words_list', batch_size, batch_index))
+        embedding_bias = request_inputs.tensor('embedding_bias', batch_size,
+                                               batch_index)
         if embedding_bias is not None and embedding_bias.size != 0:
             inputs['embedding_bias'] = from_numpy(embedding_bias).squeeze(
                 dim=0)
+        else:
+            embedding_bias_ids = request_inputs.tensor(
+                'embedding_bias_ids', batch_size, batch_index)
+            if embedding_bias_ids is not None and embedding_bias_ids.size != 0:
+                embedding_bias_values = request_inputs.tensor(
+                    'embedding_bias_values', batch_size, batch_index)
+                if embedding_bias_values is None or embedding_bias_values.shape != embedding_bias_ids.shape:
+                    raise pb_utils.TritonModelException(
+                        "embedding_bias_values must have the same shape as embedding_bias_ids"
+                    )
+                inputs['embedding_bias'] = densify_embedding_bias(
+                    embedding_bias_ids[0], embedding_bias_values[0],
+                    vocab_size)
 
         sampling_config = get_sampling_config_from_request(
-            request, batch_size, batch_index)
-        output_config = get_output_config_from_request(request, batch_size,
-                                                       batch_index)
-        req_exclude_input_from_output = get_input_scalar_by_name(
-            request, 'exclude_input_in_output', batch_size, batch_index)
+            request_inputs, batch_size, batch_index)
+        output_config = get_output_config_from_request(
+            request_inputs, batch_size, batch_index)
+        req_exclude_input_from_output = request_inputs.scalar(
+            'exclude_input_in_output', batch_size, batch_index)
         if req_exclude_input_from_output is None:
             # if request doesn't specify exclude_input_from_output, try to use the parameter
             output_config.exclude_input_from_output = (
@@ -519,17 +1333,17 @@ def convert_request(request, exclude_input_from_output, decoupled):
             output_config.exclude_input_from_output = req_exclude_input_from_output
 
         external_draft_tokens_config = get_external_draft_tokens_config_from_request(
-            request, batch_size, batch_index)
+            request_inputs, batch_size, batch_index)
         prompt_tuning_config = get_prompt_tuning_config_from_request(
-            request, batch_size, batch_index, input_length)
-        lora_config = get_lora_config_from_request(request, batch_size,
-                                                   batch_index)
+            request_inputs, batch_size, batch_index, input_length)
+        lora_config = get_lora_config_from_request(request_inputs,
+                                                   batch_size, batch_index)
         kv_cache_retention_config = get_kv_cache_retention_config_from_request(
-            request, batch_size, batch_index)
+            request_inputs, batch_size, batch_index)
 
         # Inputs for mllama support
-        encoder_input_features = get_input_tensor_by_name(
-            request, 'encoder_input_features', batch_size, batch_index)
+        encoder_input_features = request_inputs.tensor(
+            'encoder_input_features', batch_size, batch_index)
         if encoder_input_features is not None:
             if isinstance(encoder_input_features, np.ndarray):
                 encoder_input_features = from_numpy(
@@ -541,22 +1355,21 @@ def convert_request(request, exclude_input_from_output, decoupled):
                 f"inputs to llm: encoder_input_features ({encoder_input_features.shape}"
             )
 
-            encoder_output_length = get_input_tensor_by_name(
-                request, 'encoder_output_lengths', batch_size, batch_index)
+            encoder_output_length = request_inputs.tensor(
+                'encoder_output_lengths', batch_size, batch_index)
             if encoder_output_length is not None:
                 inputs['encoder_output_length'] = np.squeeze(
                     encoder_output_length, axis=0)
 
-            cross_attention_mask = get_input_tensor_by_name(
-                request, 'cross_attention_mask', batch_size, batch_index)
+            cross_attention_mask = request_inputs.tensor(
+                'cross_attention_mask', batch_size, batch_index)
             if cross_attention_mask is not None:
                 inputs['cross_attention_mask'] = cross_attention_mask[0]
                 logger.debug(
                     f"inputs to llm: cross_attention_mask ({ cross_attention_mask.shape})"
                 )
 
-            skip_cross_attn_blocks = get_input_tensor_by_name(
-                request,
+            skip_cross_attn_blocks = request_inputs.tensor(
                 'skip_cross_attn_blocks',
                 batch_size,
                 batch_index,
@@ -568,7 +1381,11 @@ def convert_request(request, exclude_input_from_output, decoupled):
                 )
 
         guided_decoding_params = get_guided_decoding_params_from_request(
-            request, batch_size, batch_index)
+            request_inputs, batch_size, batch_index)
+
+        priority = request_inputs.scalar('priority', batch_size, batch_index)
+        if priority is not None:
+            inputs['priority'] = priority
 
         requests.append(
             trtllm.Request(
@@ -583,24 +1400,49 @@ def convert_request(request, exclude_input_from_output, decoupled):
     return requests
 
 
+# [1, 1] outputs shared by all responses, they are only read when sent
+IS_FINAL_TRUE = np.array([[True]], np.bool_)
+IS_FINAL_FALSE = np.array([[False]], np.bool_)
+
+
+def is_sequence_final(result):
+    """
+    Whether `result` is the last of its sequence. With several return
+    sequences, `is_final` is only set on the last response of the request.
+    """
+    return result.is_final or result.is_sequence_final
+
+
+@lru_cache(maxsize=1024)
+def int32_scalar(value):
+    """Returns the shared [1, 1] int32 array of `value`."""
+    return np.array([[value]], np.int32)
+
+
 def convert_response(response,
                      batch_index,
                      batch_size,
                      num_return_sequences,
-                     expected_logits_dtype=torch.float32):
+                     expected_logits_dtype=torch.float32,
+                     stream_id=None,
+                     return_kv_cache_reuse_stats=False):
 
     if response.has_error():
         return pb_utils.InferenceResponse(output_tensors=[],
                                           error=pb_utils.TritonError(
                                               response.error_msg)), True, 0
     result = response.result
-    beam_lengths = np.expand_dims(
-        np.array([len(beam) for beam in result.output_token_ids], np.int32), 0)
-    max_beam_length = max([len(beam) for beam in result.output_token_ids])
-    output_ids = np.full((1, len(result.output_token_ids), max_beam_length),
-                         -1, np.int32)
-    for idx, beam in enumerate(result.output_token_ids):
-        output_ids[0, idx, :len(beam)] = beam
+    if len(result.output_token_ids) == 1:
+        # Single beam, e.g. every streamed token: no padding needed
+        beam = result.output_token_ids[0]
+        output_ids = np.fromiter(beam, np.int32, len(beam)).reshape(1, 1, -1)
+        beam_lengths = int32_scalar(len(beam))
+    else:
+        lengths = [len(beam) for beam in result.output_token_ids]
+        beam_lengths = np.array([lengths], np.int32)
+        output_ids = np.full((1, len(lengths), max(lengths)), -1, np.int32)
+        for idx, beam in enumerate(result.output_token_ids):
+            output_ids[0, idx, :lengths[idx]] = beam
 
     output_lengths = output_ids.size
     output_tensors = [
@@ -620,59 +1462,55 @@ def convert_response(response,
                 "output_log_probs",
                 np.expand_dims(np.array(result.log_probs, np.float32), 0)))
 
+    # Logits are handed over through DLPack, in the dtype of the output
     if result.context_logits is not None:
         assert (result.context_logits.dtype is expected_logits_dtype)
         output_tensors.append(
-            pb_utils.Tensor(
+            pb_utils.Tensor.from_dlpack(
                 "context_logits",
-                np.expand_dims(
-                    np.array(
-                        result.context_logits, torch_to_numpy_dtype_dict[
-                            result.context_logits.dtype]), 0)))
+                result.context_logits.unsqueeze(0).contiguous()))
 
     if result.generation_logits is not None:
         assert (result.generation_logits.dtype is expected_logits_dtype)
         output_tensors.append(
-            pb_utils.Tensor(
+            pb_utils.Tensor.from_dlpack(
                 "generation_logits",
-                np.expand_dims(
-                    np.array(
-                        result.generation_logits, torch_to_numpy_dtype_dict[
-                            result.generation_logits.dtype]), 0)))
+                result.generation_logits.unsqueeze(0).contiguous()))
 
     if batch_size > 1:
         output_tensors.append(
-            pb_utils.Tensor(
-                "batch_index",
-                np.expand_dims(np.array([batch_index], np.int32), 0)))
+            pb_utils.Tensor("batch_index", int32_scalar(batch_index)))
 
     if num_return_sequences > 1:
         output_tensors.append(
-            pb_utils.Tensor(
-                "sequence_index",
-                np.expand_dims(np.array([result.sequence_index], np.int32),
-                               0)))
+            pb_utils.Tensor("sequence_index",
+                            int32_scalar(result.sequence_index)))
+
+    # Lets postprocessing decode the sequence incrementally, keyed by the
+    # server-unique `stream_id`, and release its detokenizer state once it
+    # is final
+    output_tensors.append(
+        pb_utils.Tensor(
+            "is_final",
+            IS_FINAL_TRUE if is_sequence_final(result) else IS_FINAL_FALSE))
+    if stream_id is not None:
+        output_tensors.append(
+            pb_utils.Tensor("stream_id", np.array([[stream_id]], np.uint64)))
 
-    if result.request_perf_metrics is not None:
+    if (return_kv_cache_reuse_stats
+            and result.request_perf_metrics is not None):
         kv_cache_metrics = result.request_perf_metrics.kv_cache_metrics
         output_tensors.append(
             pb_utils.Tensor(
                 "kv_cache_alloc_new_blocks",
-                np.expand_dims(
-                    np.array([kv_cache_metrics.num_new_allocated_blocks],
-                             np.int32), 0)))
+                int32_scalar(kv_cache_metrics.num_new_allocated_blocks)))
         output_tensors.append(
-            pb_utils.Tensor(
-                "kv_cache_reused_blocks",
-                np.expand_dims(
-                    np.array([kv_cache_metrics.num_reused_blocks], np.int32),
-                    0)))
+            pb_utils.Tensor("kv_cache_reused_blocks",
+                            int32_scalar(kv_cache_metrics.num_reused_blocks)))
         output_tensors.append(
             pb_utils.Tensor(
                 "kv_cache_alloc_total_blocks",
-                np.expand_dims(
-                    np.array([kv_cache_metrics.num_total_allocated_blocks],
-                             np.int32), 0)))
+                int32_scalar(kv_cache_metrics.num_total_allocated_blocks)))
 
     return pb_utils.InferenceResponse(
         output_tensors), result.is_final, output_lengths
@@ -727,9 +1565,15 @@ def convert_decoding_mode(decoding_mode: str):
 
 
 def convert_timestamp_to_seconds(timestamp: str):
+    # The fraction of a second is dropped before parsing, it is truncated
+    # anyway, so the stats of the same second share a cached parse
+    return _convert_whole_seconds(timestamp.partition(".")[0])
+
+
+@lru_cache(maxsize=1)
+def _convert_whole_seconds(timestamp: str):
     return int(
-        datetime.datetime.strptime(timestamp,
-                                   "%m-%d-%Y %H:%M:%S.%f").timestamp())
+        datetime.datetime.strptime(timestamp, "%m-%d-%Y %H:%M:%S").timestamp())
 
 
 def triton_string_to_torch(dtype):
@@ -873,7 +1717,7 @@ class TritonPythonModel:
 
         tokenizer_dir = get_parameter(model_config, "tokenizer_dir", str)
         if guided_decoding_backend not in ['xgrammar']:
-            if tokenizer_dir:
+            if tokenizer_dir and not self.fused_processing:
                 pb_utils.Logger.log_warn(
                     f"Guided decoding backend has not been set but tokenizer_dir is given. Tokenizer_dir will be ignored."
                 )
@@ -932,7 +1776,11 @@ class TritonPythonModel:
         kwargs = {k: v for k, v in kwargs.items() if v is not None}
         return trtllm.ExecutorConfig(**kwargs)
 
-    def create_metrics(self, model: str, version: str, is_v1_model: bool):
+    def create_metrics(self,
+                       model: str,
+                       version: str,
+                       is_v1_model: bool,
+                       latency_buckets: Optional[dict] = None):
         self.request_metric_family = pb_utils.MetricFamily(
             name="nv_trt_llm_request_metrics",
             description="TRT LLM request metrics",
@@ -970,7 +1818,82 @@ class TritonPythonModel:
             description="TRT LLM response metrics",
             kind=pb_utils.MetricFamily.HISTOGRAM,
         )
+        self.kv_cache_reuse_blocks_metric_family = pb_utils.MetricFamily(
+            name="nv_llm_kv_cache_reuse_blocks",
+            description="KV cache blocks of the finished requests",
+            kind=pb_utils.MetricFamily.COUNTER,
+        )
+        self.kv_cache_reuse_ratio_metric_family = pb_utils.MetricFamily(
+            name="nv_llm_kv_cache_reuse_ratio",
+            description="Share of the KV cache blocks of the finished requests "
+            "reused from earlier requests",
+            kind=pb_utils.MetricFamily.GAUGE,
+        )
+        self.tenant_metric_family = pb_utils.MetricFamily(
+            name="nv_llm_tenant_requests",
+            description="Queued Triton requests and active executor requests "
+            "by tenant",
+            kind=pb_utils.MetricFamily.GAUGE,
+        )
+        self.tenant_metrics = {}
         common_labels = {"model": model, "version": version}
+        deadline_drops_metric_family = pb_utils.MetricFamily(
+            name="nv_llm_deadline_drops",
+            description="Requests dropped for exceeding their deadline or "
+            "the maximum queue time",
+            kind=pb_utils.MetricFamily.COUNTER,
+        )
+        self.deadline_drop_metrics = {
+            reason:
+            deadline_drops_metric_family.Metric(labels={
+                "reason": reason,
+                **common_labels
+            })
+            for reason in DEADLINE_ERRORS
+        }
+        self.common_labels = common_labels
+        latency_buckets = {
+            **DEFAULT_LATENCY_BUCKETS_MS,
+            **(latency_buckets or {})
+        }
+        latency_descriptions = {
+            "time_to_first_token":
+            "Time from the arrival of a request to its first response",
+            "inter_token_latency":
+            "Time between two responses of a request, per output token",
+            "e2e_latency":
+            "Time from the arrival of a request to its final response",
+            "queue_time":
+            "Time a request waited in the executor, from its arrival to its "
+            "first scheduling",
+            "enqueue_time":
+            "Time from the arrival of a request to its enqueueing in the "
+            "executor, including its wait for tenant admission",
+        }
+        self.latency_metrics = {}
+        for name, description in latency_descriptions.items():
+            self.latency_metrics[name] = pb_utils.MetricFamily(
+                name=f"nv_llm_{name}_ms",
+                description=description,
+                kind=pb_utils.MetricFamily.HISTOGRAM,
+            ).Metric(labels=common_labels, buckets=latency_buckets[name])
+        self.kv_cache_reuse_metrics = {
+            "reused":
+            self.kv_cache_reuse_blocks_metric_family.Metric(labels={
+                "kv_cache_block_type": "reused",
+                **common_labels
+            }),
+            "new":
+            self.kv_cache_reuse_blocks_metric_family.Metric(labels={
+                "kv_cache_block_type": "new",
+                **common_labels
+            }),
+            "ratio":
+            self.kv_cache_reuse_ratio_metric_family.Metric(
+                labels=common_labels),
+        }
+        self.kv_cache_reused_blocks = 0
+        self.kv_cache_new_blocks = 0
         self.all_metrics = {
             # Request metrics
             "num_active_requests":
@@ -1129,16 +2052,47 @@ class TritonPythonModel:
                 f"enable_trt_overlap=true is not supported.")
         self.exclude_input_from_output = get_parameter(
             model_config, "exclude_input_in_output", bool)
+        self.vocab_size = get_engine_vocab_size(gpt_model_path)
+        self.fused_processing = get_parameter(
+            model_config, "enable_fused_processing", bool) or False
+        if self.fused_processing:
+            self.initialize_fused_processing(model_config)
         executor_config = self.get_executor_config(model_config)
-        self.executor = trtllm.Executor(gpt_model_path,
-                                        trtllm.ModelType.DECODER_ONLY,
-                                        executor_config)
+
+        def create_executor():
+            return trtllm.Executor(gpt_model_path,
+                                   trtllm.ModelType.DECODER_ONLY,
+                                   executor_config)
+
+        if get_parameter(model_config, "shared_executor", bool):
+            self.executor = connect_shared_executor(
+                get_parameter(model_config, "shared_executor_address")
+                or os.path.join(tempfile.gettempdir(),
+                                f"tensorrt_llm-{os.getuid()}",
+                                f"{args['model_name']}.sock"),
+                create_executor)
+        else:
+            self.executor = create_executor()
         self.decoupled = pb_utils.using_decoupled_model_transaction_policy(
             model_config)
         self.cancellation_check_period_ms = get_parameter(
             model_config, "cancellation_check_period_ms", int) or 100
         self.stats_check_period_ms = get_parameter(
             model_config, "stats_check_period_ms", int) or 100
+        self.collect_kv_cache_reuse_stats = get_parameter(
+            model_config, "collect_kv_cache_reuse_stats", bool) or False
+        self.collect_queue_time_stats = get_parameter(
+            model_config, "collect_queue_time_stats", bool) or False
+        self.default_deadline_ms = get_parameter(model_config,
+                                                 "default_deadline_ms",
+                                                 int) or 0
+        self.max_queue_time_ms = get_parameter(model_config,
+                                               "max_queue_time_ms", int) or 0
+        self.deadline_tracker = DeadlineTracker()
+        tenant_limits = parse_tenant_limits(
+            get_parameter(model_config, "tenant_limits"))
+        self.admission = (AdmissionController(tenant_limits)
+                          if tenant_limits else None)
 
         self.logits_dtype = None
         for output in model_config['output']:
@@ -1146,14 +2100,37 @@ class TritonPythonModel:
                     'name'] == 'generation_logits':
                 self.logits_dtype = triton_string_to_torch(output['data_type'])
 
+        latency_buckets = {}
+        for name in DEFAULT_LATENCY_BUCKETS_MS:
+            buckets = parse_buckets(
+                get_parameter(model_config, f"{name}_buckets_ms"),
+                f"{name}_buckets_ms")
+            if buckets is not None:
+                latency_buckets[name] = buckets
         self.create_metrics(args["model_name"],
                             args["model_version"],
                             is_v1_model=executor_config.batching_type ==
-                            trtllm.BatchingType.STATIC)
-        self.triton_user_id_to_req_ids = {}
-        self.triton_req_id_to_req_ids = {}
+                            trtllm.BatchingType.STATIC,
+                            latency_buckets=latency_buckets)
+        self.triton_req_id_allocator = count(1)
+        # `stream_id` output: executor request ids restart from 1 in every
+        # instance, so a random per-instance prefix keeps the ids apart for
+        # postprocessing, which receives the responses of all instances
+        self.stream_id_base = int.from_bytes(os.urandom(4), "little") << 32
+        self.triton_requests = {}
+        self.triton_user_id_to_triton_req_ids = {}
         self.req_id_to_request_data = {}
+        self.cancellation_tracker = CancellationTracker()
         self.lock = Lock()
+        # Held while responses are handled, so that the responses of requests
+        # that came back while they were being enqueued outside of `lock`
+        # are handled before their later ones. Reentrant, handling responses
+        # may enqueue the requests it admits
+        self.response_lock = RLock()
+        # Requests being enqueued, and the responses of request ids not
+        # registered yet while any are
+        self.enqueues_in_flight = 0
+        self.early_responses = defaultdict(list)
         self.running = False
         self.awaiter_thread = Thread(target=self.awaiter_loop)
         self.cancellation_thread = Thread(target=self.cancellation_loop)
@@ -1167,6 +2144,223 @@ class TritonPythonModel:
             # In leader mode, worker ranks will wait here until leader is done.
             self.executor.shutdown()
 
+    def initialize_fused_processing(self, model_config):
+        """
+        Loads the tokenizer of the fused mode, in which the model takes the
+        inputs of the ensemble and returns `text_output` itself instead of
+        going through the preprocessing and postprocessing models. Their
+        prompt, word list and incremental detokenization code is loaded from
+        the `preprocessing.py` and `postprocessing.py` next to this file.
+        """
+        from transformers import AutoTokenizer
+        preprocessing = load_fused_module("preprocessing")
+        postprocessing = load_fused_module("postprocessing")
+        tokenizer_dir = get_parameter(model_config, "tokenizer_dir")
+        if not tokenizer_dir:
+            raise pb_utils.TritonModelException(
+                "enable_fused_processing requires the 'tokenizer_dir' parameter"
+            )
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir,
+                                                       legacy=False,
+                                                       padding_side='left',
+                                                       trust_remote_code=True)
+        if not self.tokenizer.pad_token:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.tokenizer_end_id = self.tokenizer.encode(
+            self.tokenizer.eos_token, add_special_tokens=False)[0]
+        self.tokenizer_pad_id = self.tokenizer.encode(
+            self.tokenizer.pad_token, add_special_tokens=False)[0]
+        if self.vocab_size is None:
+            self.vocab_size = len(self.tokenizer.vocab)
+
+        add_special_tokens = get_parameter(model_config, "add_special_tokens",
+                                           bool)
+        self.add_special_tokens = True if add_special_tokens is None else add_special_tokens
+        skip_special_tokens = get_parameter(model_config,
+                                            "skip_special_tokens", bool)
+        self.skip_special_tokens = True if skip_special_tokens is None else skip_special_tokens
+
+        word_list_cache_size = get_parameter(model_config,
+                                             "word_list_cache_size", int)
+        self.word_list_encoder = preprocessing.WordListEncoder(
+            self.tokenizer,
+            128 if word_list_cache_size is None else word_list_cache_size)
+        self.prompt_encoder = preprocessing.PromptEncoder(
+            self.tokenizer, self.add_special_tokens,
+            get_parameter(model_config, "prompt_cache_size", int) or 0,
+            get_parameter(model_config, "prompt_cache_delimiter")
+            or "<|eot_id|>")
+        self.detokenizer = postprocessing.IncrementalDetokenizer(
+            partial(self.tokenizer.batch_decode,
+                    skip_special_tokens=self.skip_special_tokens),
+            get_parameter(model_config, "incremental_detokenizer_max_states",
+                          int) or 4096)
+        self.text_output_dtype = pb_utils.triton_string_to_numpy(
+            pb_utils.get_output_config_by_name(model_config,
+                                               "text_output")['data_type'])
+
+    def tokenize_fused(self, requests):
+        """
+        Tokenizes the `text_input` of all requests with a single call to the
+        prompt encoder. Returns the input ids of each batch item of each
+        request, or the exception the request failed with, so that a request
+        with e.g. text that is not UTF-8 only fails on its own.
+        """
+        results = [None] * len(requests)
+        queries = []
+        for idx, request in enumerate(requests):
+            try:
+                text_input = pb_utils.get_input_tensor_by_name(
+                    request, 'text_input')
+                if text_input is None:
+                    raise pb_utils.TritonModelException(
+                        "A value is required for text_input")
+                queries.append((idx, [
+                    text.decode() if isinstance(text, bytes) else text
+                    for text in text_input.as_numpy().reshape(-1)
+                ]))
+            except Exception as e:
+                results[idx] = e
+        if not queries:
+            return results
+        try:
+            input_ids = iter(
+                self.prompt_encoder.encode(
+                    [text for _, texts in queries for text in texts]))
+        except Exception:
+            # Tokenize the requests one by one to fail only the faulty ones
+            for idx, texts in queries:
+                try:
+                    results[idx] = list(self.prompt_encoder.encode(texts))
+                except Exception as e:
+                    results[idx] = e
+        else:
+            for idx, texts in queries:
+                results[idx] = [next(input_ids) for _ in texts]
+        return results
+
+    def preprocess_fused(self, request, input_ids):
+        """
+        Builds the tensorrt_llm view of a fused model request from the input
+        ids `tokenize_fused` returned for it, tokenizing its stop words, bad
+        words and embedding bias words with the cached encoder of
+        preprocessing.
+        """
+        if isinstance(input_ids, Exception):
+            raise input_ids
+        batch_size = len(input_ids)
+
+        tensors = []
+        for tensor in request.inputs():
+            name = tensor.name()
+            if name in FUSED_TOKENIZED_INPUTS:
+                continue
+            if name in FUSED_INPUT_NAMES:
+                tensor = pb_utils.Tensor(FUSED_INPUT_NAMES[name],
+                                         tensor.as_numpy())
+            tensors.append(tensor)
+
+        input_lengths = np.array([[len(ids)] for ids in input_ids], np.int32)
+        packed_input_ids = np.full([batch_size, input_lengths.max()],
+                                   self.tokenizer_pad_id, np.int32)
+        for row, ids in zip(packed_input_ids, input_ids):
+            row[:len(ids)] = ids
+        tensors.append(pb_utils.Tensor("input_ids", packed_input_ids))
+        tensors.append(pb_utils.Tensor("input_lengths", input_lengths))
+
+        if pb_utils.get_input_tensor_by_name(request, 'end_id') is None:
+            tensors.append(
+                pb_utils.Tensor(
+                    "end_id",
+                    np.full([batch_size, 1], self.tokenizer_end_id,
+                            np.int32)))
+        if pb_utils.get_input_tensor_by_name(request, 'pad_id') is None:
+            tensors.append(
+                pb_utils.Tensor(
+                    "pad_id",
+                    np.full([batch_size, 1], self.tokenizer_pad_id,
+                            np.int32)))
+
+        for name, list_name in (("stop_words", "stop_words_list"),
+                                ("bad_words", "bad_words_list")):
+            word_lists = pb_utils.get_input_tensor_by_name(request, name)
+            if word_lists is not None:
+                tensors.append(
+                    pb_utils.Tensor(
+                        list_name,
+                        self.word_list_encoder.to_word_list_format(
+                            word_lists.as_numpy(), batch_size)))
+
+        embedding_bias_words = pb_utils.get_input_tensor_by_name(
+            request, 'embedding_bias_words')
+        embedding_bias_weights = pb_utils.get_input_tensor_by_name(
+            request, 'embedding_bias_weights')
+        if embedding_bias_words is not None and embedding_bias_weights is not None:
+            # Densified by `convert_request` like the sparse bias of
+            # preprocessing
+            embedding_bias_ids, embedding_bias_values = self.word_list_encoder.sparse_embedding_bias(
+                embedding_bias_words.as_numpy(),
+                embedding_bias_weights.as_numpy(), batch_size, np.float32)
+            tensors.append(
+                pb_utils.Tensor("embedding_bias_ids", embedding_bias_ids))
+            tensors.append(
+                pb_utils.Tensor("embedding_bias_values",
+                                embedding_bias_values))
+
+        # Extra id is used in kv cache reuse for p-tuning
+        prompt_table_extra_id = pb_utils.get_input_tensor_by_name(
+            request, 'prompt_table_extra_id')
+        if prompt_table_extra_id is not None:
+            tensors.append(
+                pb_utils.Tensor(
+                    "prompt_table_extra_ids",
+                    np.where(packed_input_ids >= self.vocab_size,
+                             prompt_table_extra_id.as_numpy(),
+                             0).astype(np.uint64)))
+
+        return FusedRequest(request, tensors)
+
+    def postprocess_fused(self, converted):
+        """
+        Replaces the output ids of converted responses with their text, for a
+        list of `(req_id, result, triton_response)`. Single beams are
+        detokenized incrementally with one call for the whole list, keyed by
+        the executor request id and the sequence index; the whole beams of
+        beam search are decoded every time.
+        """
+        incremental_texts = iter(
+            self.detokenizer.decode_batch([
+                ((req_id, result.sequence_index), result.output_token_ids[0],
+                 is_sequence_final(result)) for req_id, result, _ in converted
+                if len(result.output_token_ids) == 1
+            ]))
+
+        responses = []
+        for req_id, result, triton_response in converted:
+            if len(result.output_token_ids) == 1:
+                texts = [next(incremental_texts)]
+            else:
+                texts = []
+                for beam, text in zip(
+                        result.output_token_ids,
+                        self.tokenizer.batch_decode(
+                            result.output_token_ids,
+                            skip_special_tokens=self.skip_special_tokens)):
+                    # Same fallback as postprocessing for incomplete characters
+                    texts.append(f"t'{beam[0]}'" if '\ufffd' in text else text)
+
+            output_tensors = [
+                pb_utils.Tensor(
+                    "text_output",
+                    np.array([text.encode('utf8') for text in texts
+                              ]).astype(self.text_output_dtype))
+            ]
+            output_tensors.extend(
+                tensor for tensor in triton_response.output_tensors()
+                if tensor.name() not in FUSED_DROPPED_OUTPUTS)
+            responses.append(pb_utils.InferenceResponse(output_tensors))
+        return responses
+
     def handle_stop_request(self, triton_user_id, response_sender):
         if triton_user_id is None or triton_user_id == "":
             response_sender.send(
@@ -1175,11 +2369,19 @@ class TritonPythonModel:
                 flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL)
             return
 
+        if self.admission is not None:
+            self.reject_pending(
+                self.admission.remove(
+                    lambda pending: pending.triton_user_id == triton_user_id),
+                "Request was stopped before it was enqueued")
         with self.lock:
-            if triton_user_id in self.triton_user_id_to_req_ids:
-                req_ids = self.triton_user_id_to_req_ids[triton_user_id]
-                for req_id in req_ids:
-                    self.executor.cancel_request(req_id)
+            req_ids = [
+                req_id for triton_req_id in
+                self.triton_user_id_to_triton_req_ids.get(triton_user_id, ())
+                for req_id in self.active_req_ids(triton_req_id)
+            ]
+        for req_id in req_ids:
+            self.executor.cancel_request(req_id)
 
         response_sender.send(
             pb_utils.InferenceResponse(),
@@ -1204,16 +2406,16 @@ class TritonPythonModel:
         """
         if not self.executor.can_enqueue_requests():
             return
+        arrival_time = time.perf_counter()
 
         # Convert to executor requests.
 
-        triton_requests = []
-        executor_requests = []
-        batch_indices = []
-        triton_user_ids = []
-        triton_req_ids = []
+        pending_requests = []
+
+        if self.fused_processing:
+            fused_input_ids = self.tokenize_fused(requests)
 
-        for request in requests:
+        for request_idx, request in enumerate(requests):
 
             triton_user_id = request.request_id()
 
@@ -1224,15 +2426,15 @@ class TritonPythonModel:
                 self.handle_stop_request(triton_user_id, response_sender)
             else:
                 #Unique request id used to identify each triton request
-                triton_req_id = str(randint(0, sys.maxsize))
-                self.triton_req_id_to_req_ids[triton_req_id] = set()
-                if triton_user_id is not None and triton_user_id != "":
-                    self.triton_user_id_to_req_ids[triton_user_id] = set()
+                triton_req_id = next(self.triton_req_id_allocator)
 
                 try:
                     converted_reqs = convert_request(
-                        request, self.exclude_input_from_output,
-                        self.decoupled)
+                        self.preprocess_fused(
+                            request, fused_input_ids[request_idx])
+                        if self.fused_processing else request,
+                        self.exclude_input_from_output, self.decoupled,
+                        self.vocab_size)
                 except Exception as e:
                     response_sender.send(
                         pb_utils.InferenceResponse(error=pb_utils.TritonError(
@@ -1240,26 +2442,196 @@ class TritonPythonModel:
                         )),
                         flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL)
                 else:
-                    for batch_index, converted_req in enumerate(
-                            converted_reqs):
-                        triton_requests.append(request)
-                        executor_requests.append(converted_req)
-                        triton_user_ids.append(triton_user_id)
-                        triton_req_ids.append(triton_req_id)
-                        batch_indices.append(batch_index)
+                    # What the request asked for, before the server asks for
+                    # the perf metrics it collects itself
+                    return_kv_cache_reuse_stats = tuple(
+                        bool(converted_req.output_config.return_perf_metrics)
+                        for converted_req in converted_reqs)
+                    if (self.collect_kv_cache_reuse_stats
+                            or self.collect_queue_time_stats):
+                        for converted_req in converted_reqs:
+                            converted_req.output_config.return_perf_metrics = True
+                    pending_requests.append(
+                        PendingRequest(
+                            triton_req_id,
+                            triton_user_id,
+                            request,
+                            converted_reqs,
+                            arrival_time,
+                            return_kv_cache_reuse_stats=
+                            return_kv_cache_reuse_stats))
+                    self.add_deadlines(request, triton_req_id, arrival_time)
+
+        if self.admission is None:
+            self.enqueue_pending(pending_requests)
+            return None
+
+        for pending in pending_requests:
+            self.prepare_admission(pending)
+            self.cancellation_tracker.add(
+                pending.triton_req_id,
+                pending.triton_request.get_response_sender())
+        self.admission.submit(pending_requests)
+        self.admit_requests()
+        return None
 
+    def add_deadlines(self, request, triton_req_id, arrival_time):
+        """
+        Tracks the deadline of a request, its `deadline_ms` input or else the
+        `default_deadline_ms` parameter, and the `max_queue_time_ms` before
+        its first response.
+        """
+        deadline_ms = pb_utils.get_input_tensor_by_name(request, 'deadline_ms')
+        deadline_ms = (int(deadline_ms.as_numpy().min()) if deadline_ms
+                       is not None else self.default_deadline_ms)
+        if deadline_ms > 0:
+            self.deadline_tracker.add(triton_req_id, "deadline",
+                                      arrival_time + deadline_ms / 1000.0)
+        if self.max_queue_time_ms > 0:
+            self.deadline_tracker.add(
+                triton_req_id, "queue_time",
+                arrival_time + self.max_queue_time_ms / 1000.0)
+
+    def expire_requests(self, expired):
+        """
+        Drops the requests whose deadline or maximum queue time passed: the
+        queued ones are answered right away, the others cancelled in the
+        executor and answered when it returns their final response.
+        """
+        reasons = dict(expired)
+        if self.admission is not None:
+            for pending in self.admission.remove(
+                    lambda pending: pending.triton_req_id in reasons):
+                reason = reasons.pop(pending.triton_req_id)
+                self.deadline_drop_metrics[reason].increment(1)
+                self.reject_pending([pending], DEADLINE_ERRORS[reason])
+
+        req_ids = []
+        with self.lock:
+            for triton_req_id, reason in reasons.items():
+                active_req_ids = self.active_req_ids(triton_req_id)
+                request_data = [
+                    self.req_id_to_request_data[req_id]
+                    for req_id in active_req_ids
+                ]
+                if reason == "queue_time" and any(
+                        data.first_response_time is not None
+                        for data in request_data):
+                    continue
+                if not request_data or request_data[0].expired_error:
+                    continue
+                for data in request_data:
+                    data.expired_error = DEADLINE_ERRORS[reason]
+                req_ids.extend(active_req_ids)
+                self.deadline_drop_metrics[reason].increment(1)
+        for req_id in req_ids:
+            self.executor.cancel_request(req_id)
+
+    def prepare_admission(self, pending):
+        """
+        Sets the tenant and token cost of a request, and the priority of its
+        executor requests to the tenant's unless it has a `priority` input.
+        """
+        request = pending.triton_request
+        pending.tenant = get_request_tenant(request)
+        pending.num_tokens = sum(
+            len(executor_request.input_token_ids) +
+            executor_request.max_new_tokens
+            for executor_request in pending.executor_requests)
+        priority = self.admission.limits_of(pending.tenant).priority
+        if priority is not None and pb_utils.get_input_tensor_by_name(
+                request, 'priority') is None:
+            for executor_request in pending.executor_requests:
+                executor_request.priority = priority
+
+    def admit_requests(self):
+        """Enqueues the queued requests the admission controller lets in."""
+        admitted = self.admission.pop_admissible()
+        if admitted:
+            self.enqueue_pending(admitted)
+
+    def enqueue_pending(self, pending_requests):
+        """
+        Enqueues the executor requests of converted Triton requests and
+        registers them for their responses and cancellation.
+        """
+        executor_requests = [
+            executor_request for pending in pending_requests
+            for executor_request in pending.executor_requests
+        ]
+        if not executor_requests:
+            return
+        # Enqueued outside of the lock, a shared executor client makes a
+        # round trip to the instance that owns the executor
         with self.lock:
+            self.enqueues_in_flight += 1
+        try:
             request_ids = self.executor.enqueue_requests(executor_requests)
-            for req_id, triton_req_id, triton_user_id, executor_request, triton_request, batch_index in zip(
-                    request_ids, triton_req_ids, triton_user_ids,
-                    executor_requests, triton_requests, batch_indices):
+        except Exception as e:
+            enqueue_error = e
+        else:
+            enqueue_error = None
+        enqueue_time = time.perf_counter()
+        early_responses = []
+        with self.response_lock:
+            with self.lock:
+                self.enqueues_in_flight -= 1
+                if enqueue_error is None:
+                    self.register_requests(pending_requests, request_ids)
+                    for req_id in request_ids:
+                        early_responses.extend(
+                            self.early_responses.pop(req_id, ()))
+                if not self.enqueues_in_flight:
+                    # The rest belong to requests that are gone
+                    self.early_responses.clear()
+            if early_responses:
+                self.handle_responses(early_responses)
+        if enqueue_error is not None:
+            # Also called from the awaiter and cancellation threads, so a
+            # failure ends the requests instead of propagating
+            if self.admission is not None:
+                for pending in pending_requests:
+                    self.admission.release(pending.tenant,
+                                           len(pending.executor_requests))
+            self.reject_pending(
+                pending_requests,
+                f"Failed to enqueue the request: {enqueue_error}")
+            return
+        for pending in pending_requests:
+            enqueue_time_ms = (enqueue_time - pending.arrival_time) * 1000
+            for _ in pending.executor_requests:
+                self.latency_metrics["enqueue_time"].observe(enqueue_time_ms)
 
+    def register_requests(self, pending_requests, request_ids):
+        """
+        Registers enqueued requests for their responses and cancellation.
+        Must be called with `self.lock` held.
+        """
+        req_ids = iter(request_ids)
+        for pending in pending_requests:
+            triton_req_id = pending.triton_req_id
+            triton_user_id = pending.triton_user_id
+            response_sender = pending.triton_request.get_response_sender()
+            triton_request_req_ids = tuple(
+                next(req_ids) for _ in pending.executor_requests)
+            self.triton_requests[triton_req_id] = TritonRequestData(
+                triton_user_id, triton_request_req_ids,
+                len(triton_request_req_ids))
+            if triton_user_id is not None and triton_user_id != "":
+                self.triton_user_id_to_triton_req_ids.setdefault(
+                    triton_user_id, set()).add(triton_req_id)
+            self.cancellation_tracker.add(triton_req_id, response_sender)
+            for batch_index, (req_id, executor_request) in enumerate(
+                    zip(triton_request_req_ids,
+                        pending.executor_requests)):
                 self.req_id_to_request_data[req_id] = RequestData(
                     triton_req_id, triton_user_id, batch_index,
-                    len(batch_indices),
-                    executor_request.sampling_config.num_return_sequences, 0,
-                    0, triton_request.get_response_sender())
-                self.triton_req_id_to_req_ids[triton_req_id].add(req_id)
+                    len(request_ids),
+                    executor_request.sampling_config.num_return_sequences,
+                    0, 0, response_sender, pending.arrival_time,
+                    tenant=pending.tenant,
+                    return_kv_cache_reuse_stats=pending.
+                    return_kv_cache_reuse_stats[batch_index])
                 input_len = len(
                     executor_request.input_token_ids
                 ) if executor_request.input_token_ids is not None else 0
@@ -1270,64 +2642,221 @@ class TritonPythonModel:
                     self.req_id_to_request_data[
                         req_id].num_output_tokens -= self.req_id_to_request_data[
                             req_id].num_input_tokens * executor_request.sampling_config.beam_width
-                if triton_user_id is not None and triton_user_id != "":
-                    self.triton_user_id_to_req_ids[triton_user_id].add(req_id)
 
-        return None
+    def reject_pending(self, pending_requests, message):
+        """Ends queued requests that will not be enqueued with an error."""
+        for pending in pending_requests:
+            self.cancellation_tracker.remove(pending.triton_req_id)
+            self.deadline_tracker.remove(pending.triton_req_id)
+            pending.triton_request.get_response_sender().send(
+                pb_utils.InferenceResponse(
+                    error=pb_utils.TritonError(message)),
+                flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL)
 
     def awaiter_loop(self):
-        """Gets responses from executor and returns the results."""
+        """Gets responses from executor and returns the results.
+
+        `await_responses` returns as soon as responses are ready, its timeout
+        only bounds how long the loop stays asleep while the executor is
+        idle: it doubles after every empty wait up to
+        `AWAITER_MAX_TIMEOUT_MS` and drops back once responses arrive.
+        """
+        timeout_ms = AWAITER_MIN_TIMEOUT_MS
         while self.running:
-            for response in self.executor.await_responses(
-                    timeout=datetime.timedelta(milliseconds=1)):
-                req_id = response.request_id
-                request_data = None
-                with self.lock:
-                    if req_id not in self.req_id_to_request_data:
-                        continue
-                    request_data = self.req_id_to_request_data[req_id]
+            responses = self.executor.await_responses(
+                timeout=datetime.timedelta(milliseconds=timeout_ms))
+            if responses:
+                timeout_ms = AWAITER_MIN_TIMEOUT_MS
+                with self.response_lock:
+                    self.handle_responses(responses)
+            else:
+                timeout_ms = min(2 * timeout_ms, AWAITER_MAX_TIMEOUT_MS)
 
-                triton_response, is_final, output_length = convert_response(
-                    response, request_data.batch_index,
-                    request_data.batch_size, request_data.num_return_sequences,
-                    self.logits_dtype)
-                with self.lock:
-                    self.req_id_to_request_data[
-                        req_id].num_output_tokens += output_length
+    def handle_responses(self, responses):
+        """
+        Converts and sends a list of executor responses. The lock is taken
+        once to look up the request data of the whole list and once to update
+        its bookkeeping; converting and sending happen outside of it.
+        Must be called with `self.response_lock` held.
+        """
+        with self.lock:
+            request_data_list = []
+            for response in responses:
+                request_data = self.req_id_to_request_data.get(
+                    response.request_id)
+                if request_data is None and self.enqueues_in_flight:
+                    # May belong to a request not registered yet
+                    self.early_responses[response.request_id].append(response)
+                request_data_list.append(request_data)
+
+        converted = []
+        for response, request_data in zip(responses, request_data_list):
+            if request_data is None:
+                continue
+            triton_response, is_final, output_length = convert_response(
+                response, request_data.batch_index, request_data.batch_size,
+                request_data.num_return_sequences, self.logits_dtype,
+                self.stream_id_base | (response.request_id & 0xFFFFFFFF),
+                request_data.return_kv_cache_reuse_stats)
+            converted.append([
+                response, request_data, triton_response, is_final,
+                output_length
+            ])
+
+        if self.collect_kv_cache_reuse_stats:
+            self.update_kv_cache_reuse_metrics(
+                [response for response, *_ in converted])
+        if self.collect_queue_time_stats:
+            self.update_queue_time_metrics(
+                [response for response, *_ in converted])
+
+        if self.fused_processing:
+            fused = [item for item in converted if not item[0].has_error()]
+            for item, triton_response in zip(
+                    fused,
+                    self.postprocess_fused([
+                        (response.request_id, response.result,
+                         triton_response)
+                        for response, _, triton_response, _, _ in fused
+                    ])):
+                item[2] = triton_response
+
+        sends = []
+        latencies = []
+        released = []
+        now = time.perf_counter()
+        with self.lock:
+            for response, request_data, triton_response, is_final, output_length in converted:
+                req_id = response.request_id
+                request_data.num_output_tokens += output_length
+                if not response.has_error():
+                    latencies.append(
+                        self.record_response_time(request_data, now,
+                                                  output_length, is_final))
                 triton_request_final = False
                 if is_final:
-                    with self.lock:
-                        # Check if all executor requests part of that triton request are finished
-                        self.triton_req_id_to_req_ids[
-                            request_data.triton_req_id].remove(req_id)
-                        if len(self.triton_req_id_to_req_ids[
-                                request_data.triton_req_id]) == 0:
-                            pb_utils.Logger.log_info(
-                                f"DELETING Req id {req_id}, triton_req_id {request_data.triton_req_id} "
-                            )
-                            triton_request_final = True
-                            del self.triton_req_id_to_req_ids[
-                                request_data.triton_req_id]
-                            if request_data.triton_user_id is not None and request_data.triton_user_id != "":
-                                del self.triton_user_id_to_req_ids[
-                                    request_data.triton_user_id]
-                        self.update_metrics_per_request(req_id)
-                        del self.req_id_to_request_data[req_id]
-
-                request_data.response_sender.send(
-                    triton_response,
-                    flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL
-                    if triton_request_final else 0)
+                    # Check if all executor requests part of that triton request are finished
+                    triton_req_id = request_data.triton_req_id
+                    triton_request = self.triton_requests[triton_req_id]
+                    triton_request.num_active -= 1
+                    if triton_request.num_active == 0:
+                        pb_utils.Logger.log_info(
+                            f"DELETING Req id {req_id}, triton_req_id {triton_req_id} "
+                        )
+                        triton_request_final = True
+                        del self.triton_requests[triton_req_id]
+                        self.cancellation_tracker.remove(triton_req_id)
+                        self.deadline_tracker.remove(triton_req_id)
+                        triton_user_id = request_data.triton_user_id
+                        if triton_user_id is not None and triton_user_id != "":
+                            # The same user id may be reused by requests in flight
+                            triton_req_ids = self.triton_user_id_to_triton_req_ids[
+                                triton_user_id]
+                            triton_req_ids.discard(triton_req_id)
+                            if not triton_req_ids:
+                                del self.triton_user_id_to_triton_req_ids[
+                                    triton_user_id]
+                    self.update_metrics_per_request(req_id)
+                    del self.req_id_to_request_data[req_id]
+                    if request_data.tenant is not None:
+                        released.append(request_data.tenant)
+                if request_data.expired_error is not None:
+                    # Only the error ends a request dropped for its deadline
+                    if not triton_request_final:
+                        continue
+                    triton_response = pb_utils.InferenceResponse(
+                        error=pb_utils.TritonError(request_data.expired_error))
+                sends.append(
+                    (request_data.response_sender, triton_response,
+                     pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL
+                     if triton_request_final else 0))
+
+        for response_sender, triton_response, flags in sends:
+            response_sender.send(triton_response, flags=flags)
+        self.update_latency_metrics(latencies)
+        if released:
+            for tenant in released:
+                self.admission.release(tenant)
+            self.admit_requests()
+
+    def record_response_time(self, request_data, now, output_length,
+                             is_final):
+        """
+        Records that a response of `output_length` tokens of the request of
+        `request_data` was received at `now`. Returns its time to first
+        token, inter-token and end-to-end latencies in milliseconds, None for
+        those it does not have.
+        """
+        ttft = itl = e2e = None
+        if request_data.first_response_time is None:
+            request_data.first_response_time = now
+            request_data.last_response_time = now
+            ttft = (now - request_data.arrival_time) * 1000
+        elif output_length > 0:
+            itl = ((now - request_data.last_response_time) * 1000 /
+                   output_length)
+            request_data.last_response_time = now
+        if is_final:
+            e2e = (now - request_data.arrival_time) * 1000
+        return ttft, itl, e2e
+
+    def update_latency_metrics(self, latencies):
+        """Observes the latencies `record_response_time` returned."""
+        metrics = (self.latency_metrics["time_to_first_token"],
+                   self.latency_metrics["inter_token_latency"],
+                   self.latency_metrics["e2e_latency"])
+        for values in latencies:
+            for metric, value in zip(metrics, values):
+                if value is not None:
+                    metric.observe(value)
 
     def cancellation_loop(self):
-        """Checks if any pending requests have been cancelled."""
+        """Checks if any pending requests have been cancelled.
+
+        The response senders are checked by the cancellation tracker, the
+        model lock is only held to look up the executor requests of the
+        cancelled Triton requests, which are cancelled after releasing it.
+        Cancelled requests still waiting for admission are dropped, and the
+        others admitted if the token budgets of their tenants now allow.
+        Requests past their deadline or maximum queue time are dropped first.
+        """
         while self.running:
             time.sleep(self.cancellation_check_period_ms / 1000.0)
+            expired = self.deadline_tracker.pop_expired(time.perf_counter())
+            if expired:
+                self.expire_requests(expired)
+            cancelled = self.cancellation_tracker.pop_cancelled()
+            if self.admission is not None:
+                if cancelled:
+                    cancelled_ids = set(cancelled)
+                    self.reject_pending(
+                        self.admission.remove(
+                            lambda pending: pending.triton_req_id in
+                            cancelled_ids),
+                        "Request was cancelled before it was enqueued")
+                self.admit_requests()
+            if not cancelled:
+                continue
             with self.lock:
-                for req_id, request_data in self.req_id_to_request_data.items(
-                ):
-                    if request_data.response_sender.is_cancelled():
-                        self.executor.cancel_request(req_id)
+                req_ids = [
+                    req_id for triton_req_id in cancelled
+                    for req_id in self.active_req_ids(triton_req_id)
+                ]
+            for req_id in req_ids:
+                self.executor.cancel_request(req_id)
+
+    def active_req_ids(self, triton_req_id):
+        """
+        Returns the unfinished executor requests of a Triton request. Must be
+        called with the lock held.
+        """
+        triton_request = self.triton_requests.get(triton_req_id)
+        if triton_request is None:
+            return []
+        return [
+            req_id for req_id in triton_request.req_ids
+            if req_id in self.req_id_to_request_data
+        ]
 
     def update_metrics_per_request(self, req_id):
         """Updates triton metrics after completing one request"""
@@ -1337,50 +2866,156 @@ class TritonPythonModel:
         self.all_metrics[METRIC_TOTAL_OUTPUT_TOKENS].observe(output_tokens)
         self.all_metrics[METRIC_TOTAL_INPUT_TOKENS].observe(input_tokens)
 
+    def update_queue_time_metrics(self, responses):
+        """
+        Observes the time the requests of the final responses of `responses`
+        waited in the executor before being scheduled, from their timing
+        metrics.
+        """
+        for response in responses:
+            if response.has_error() or not response.result.is_final:
+                continue
+            perf_metrics = response.result.request_perf_metrics
+            if perf_metrics is None or perf_metrics.timing_metrics is None:
+                continue
+            timing_metrics = perf_metrics.timing_metrics
+            # Unset time points are zero
+            if not (timing_metrics.arrival_time
+                    and timing_metrics.first_scheduled_time):
+                continue
+            self.latency_metrics["queue_time"].observe(
+                (timing_metrics.first_scheduled_time -
+                 timing_metrics.arrival_time).total_seconds() * 1000)
+
+    def update_kv_cache_reuse_metrics(self, responses):
+        """
+        Adds the KV cache blocks the final responses of `responses` reused
+        and newly allocated to the reuse metrics.
+        """
+        reused = new = 0
+        for response in responses:
+            if response.has_error() or not response.result.is_final:
+                continue
+            perf_metrics = response.result.request_perf_metrics
+            if perf_metrics is None or perf_metrics.kv_cache_metrics is None:
+                continue
+            reused += perf_metrics.kv_cache_metrics.num_reused_blocks
+            new += perf_metrics.kv_cache_metrics.num_new_allocated_blocks
+        if reused == 0 and new == 0:
+            return
+        self.kv_cache_reused_blocks += reused
+        self.kv_cache_new_blocks += new
+        self.kv_cache_reuse_metrics["reused"].increment(reused)
+        self.kv_cache_reuse_metrics["new"].increment(new)
+        self.kv_cache_reuse_metrics["ratio"].set(
+            self.kv_cache_reused_blocks /
+            (self.kv_cache_reused_blocks + self.kv_cache_new_blocks))
+
+    def update_tenant_metrics(self):
+        """Sets the queued and active requests of each tenant."""
+        for tenant, counts in self.admission.request_counts().items():
+            for state, value in zip(("queued", "active"), counts):
+                metric = self.tenant_metrics.get((tenant, state))
+                if metric is None:
+                    metric = self.tenant_metric_family.Metric(
+                        labels={
+                            "tenant": tenant,
+                            "request_state": state,
+                            **self.common_labels
+                        })
+                    self.tenant_metrics[(tenant, state)] = metric
+                metric.set(value)
+
+    def resolve_stat_accessors(self, stat, keys, accessors):
+        """
+        Maps the gauges of `all_metrics` named by `keys` to getters of their
+        values in the iteration stats, looking each key up in `stat` and then
+        in its KV cache, static batching and inflight batching stats. Adds
+        the `(metric, getter)` pairs to `accessors` by the attribute of their
+        stats, None for `stat` itself, and returns the keys found in none of
+        them, e.g. because their stats are missing from `stat`.
+        """
+        unresolved = []
+        for key in keys:
+            metric = self.all_metrics[key]
+            for group in STAT_GROUPS:
+                owner = stat if group is None else getattr(stat, group, None)
+                if owner is not None and hasattr(owner, key):
+                    if key == "timestamp":
+                        accessor = lambda owner: convert_timestamp_to_seconds(
+                            owner.timestamp)
+                    else:
+                        accessor = attrgetter(key)
+                    accessors.setdefault(group, []).append((metric, accessor))
+                    break
+            else:
+                unresolved.append(key)
+        return unresolved
+
+    def update_stat_metrics(self, stat, accessors):
+        """
+        Sets the gauges of `accessors` from `stat`. The stats of a group
+        missing from `stat` are skipped, and an error only loses the gauges
+        of its group.
+        """
+        for group, group_accessors in accessors.items():
+            owner = stat if group is None else getattr(stat, group, None)
+            if owner is None:
+                continue
+            try:
+                for metric, accessor in group_accessors:
+                    value = accessor(owner)
+                    if value is not None:
+                        metric.set(value)
+            except Exception as e:
+                pb_utils.Logger.log_warn(
+                    f"Error while processing metrics: {e}")
+
     def metrics_loop(self):
-        """Updates triton metrics using stats from the executor."""
+        """
+        Updates triton metrics using stats from the executor. Only the latest
+        iteration stats of each period are used, the gauges would be
+        overwritten by the later ones anyway. The gauges are mapped to their
+        stats once found, those not found yet are looked up again in the
+        next stats and logged the first time only.
+        """
+        accessors = {}
+        unresolved = [
+            key for key in self.all_metrics
+            if key not in (METRIC_TOTAL_OUTPUT_TOKENS,
+                           METRIC_TOTAL_INPUT_TOKENS)
+        ]
+        logged = False
         while self.running:
             time.sleep(self.stats_check_period_ms / 1000.0)
-            for stat in self.executor.get_latest_iteration_stats():
-                try:
-                    for key, metric in self.all_metrics.items():
-                        # Skip processing for both histogram metrics
-                        if isinstance(key, str) and key in [
-                                METRIC_TOTAL_OUTPUT_TOKENS,
-                                METRIC_TOTAL_INPUT_TOKENS
-                        ]:
-                            continue
-                        value = None
-                        if hasattr(stat, key):
-                            value = getattr(stat, key)
-                        elif stat.kv_cache_stats is not None and hasattr(
-                                stat.kv_cache_stats, key):
-                            value = getattr(stat.kv_cache_stats, key)
-                        elif stat.static_batching_stats is not None and hasattr(
-                                stat.static_batching_stats, key):
-                            value = getattr(stat.static_batching_stats, key)
-                        elif stat.inflight_batching_stats is not None and hasattr(
-                                stat.inflight_batching_stats, key):
-                            value = getattr(stat.inflight_batching_stats, key)
-                        if value is not None:
-                            if key == "timestamp":
-                                value = convert_timestamp_to_seconds(value)
-                            metric.set(value)
-                        else:
-                            pb_utils.Logger.log_warn(
-                                f"Metric \"{key}\" not found.")
-                except Exception as e:
-                    pb_utils.Logger.log_warn(
-                        f"Error while processing metrics: {e}")
+            if self.admission is not None:
+                self.update_tenant_metrics()
+            stats = self.executor.get_latest_iteration_stats()
+            if not stats:
+                continue
+            stat = stats[-1]
+            if unresolved:
+                unresolved = self.resolve_stat_accessors(
+                    stat, unresolved, accessors)
+                if not logged:
+                    logged = True
+                    for key in unresolved:
+                        pb_utils.Logger.log_warn(
+                            f"Metric \"{key}\" not found.")
+            self.update_stat_metrics(stat, accessors)
 
     def finalize(self):
         """`finalize` is called only once when the model is being unloaded.
         Implementing `finalize` function is optional. This function allows
         the model to perform any necessary clean ups before exit.
         """
-        if self.executor.can_enqueue_requests():
+        if self.running:
             self.running = False
             self.awaiter_thread.join()
             self.cancellation_thread.join()
             self.metrics_thread.join()
             self.executor.shutdown()
+            if self.admission is not None:
+                self.reject_pending(
+                    self.admission.remove(lambda pending: True),
+                    "Model was unloaded before the request was enqueued")
@@ -25,12 +25,106 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import json
+from collections import OrderedDict
 
 import numpy as np
 import triton_python_backend_utils as pb_utils
 from transformers import AutoTokenizer
 
 
+class DetokenizerState:
+    """Decoding progress of one streamed sequence.
+
+    `token_ids[prefix_offset:read_offset]` are the tokens whose text was
+    already emitted and that are decoded again as context for the next
+    tokens, `token_ids[read_offset:]` are the tokens not emitted yet.
+    """
+    __slots__ = ("token_ids", "prefix_offset", "read_offset")
+
+    def __init__(self):
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+
+class IncrementalDetokenizer:
+    """Turns the token ids streamed for each sequence into newly finished text.
+
+    Follows the prefix/read offset scheme of vLLM: the pending tokens are
+    decoded together with the previously emitted ones and only the text past
+    that prefix is returned. Text ending in an incomplete UTF-8 character is
+    held back until the character is complete or the sequence is final.
+    States are keyed by the caller, freed when the final tokens of a sequence
+    are decoded and evicted oldest first above `max_states`.
+    """
+
+    def __init__(self, batch_decode, max_states):
+        self.batch_decode = batch_decode
+        self.max_states = max_states
+        self.states = OrderedDict()
+
+    def __len__(self):
+        return len(self.states)
+
+    def decode(self, key, token_ids, is_final):
+        """Adds `token_ids` to the sequence `key` and returns its new text."""
+        return self.decode_batch([(key, token_ids, is_final)])[0]
+
+    def decode_batch(self, sequences):
+        """Same as `decode` for a list of `(key, token_ids, is_final)`.
+
+        All sequences are decoded with one `batch_decode` call, except when a
+        key repeats in the list: its later tokens are decoded in another call
+        once the earlier ones have been added to the state.
+        """
+        outputs = []
+        start = 0
+        keys = set()
+        for idx, (key, _, _) in enumerate(sequences):
+            if key in keys:
+                outputs.extend(self._decode_batch(sequences[start:idx]))
+                start = idx
+                keys.clear()
+            keys.add(key)
+        outputs.extend(self._decode_batch(sequences[start:]))
+        return outputs
+
+    def _decode_batch(self, sequences):
+        states = []
+        slices = []
+        for key, token_ids, _ in sequences:
+            state = self.states.pop(key, None)
+            if state is None:
+                state = DetokenizerState()
+            state.token_ids.extend(token_ids)
+            states.append(state)
+            slices.append(state.token_ids[state.prefix_offset:state.read_offset])
+            slices.append(state.token_ids[state.prefix_offset:])
+        texts = self.batch_decode(slices)
+
+        outputs = []
+        for idx, (key, _, is_final) in enumerate(sequences):
+            state = states[idx]
+            prefix_text = texts[2 * idx]
+            new_text = texts[2 * idx + 1]
+
+            output = ""
+            if len(new_text) > len(prefix_text) and (
+                    is_final or not new_text.endswith("\ufffd")):
+                output = new_text[len(prefix_text):]
+                # Only the tokens from the new prefix on are needed from now on
+                del state.token_ids[:state.read_offset]
+                state.prefix_offset = 0
+                state.read_offset = len(state.token_ids)
+            outputs.append(output)
+
+            if not is_final:
+                self.states[key] = state
+                while len(self.states) > self.max_states:
+                    self.states.popitem(last=False)
+        return outputs
+
+
 class TritonPythonModel:
     """Your Python model must use the same class name. Every Python model
     that is created must have "TritonPythonModel" as the class name.
@@ -85,6 +179,38 @@ class TritonPythonModel:
         if not self.tokenizer.pad_token:
             self.tokenizer.pad_token = self.tokenizer.eos_token
 
+        enable_incremental_detokenization = model_config['parameters'].get(
+            'enable_incremental_detokenization')
+        self.incremental_detokenization = False
+        if enable_incremental_detokenization is not None:
+            enable_incremental_detokenization_str = enable_incremental_detokenization[
+                'string_value'].lower()
+            if enable_incremental_detokenization_str in [
+                    'true', 'false', '1', '0', 't', 'f', 'y', 'n', 'yes', 'no'
+            ]:
+                self.incremental_detokenization = enable_incremental_detokenization_str in [
+                    'true', '1', 't', 'y', 'yes'
+                ]
+            elif enable_incremental_detokenization_str != "${enable_incremental_detokenization}":
+                print(
+                    f"[TensorRT-LLM][WARNING] Don't setup 'enable_incremental_detokenization' correctly (set value is {enable_incremental_detokenization['string_value']}). Set it as False by default."
+                )
+
+        max_detokenizer_states = 4096
+        incremental_detokenizer_max_states = model_config['parameters'].get(
+            'incremental_detokenizer_max_states')
+        if incremental_detokenizer_max_states is not None:
+            max_states_str = incremental_detokenizer_max_states['string_value']
+            if max_states_str.isdigit():
+                max_detokenizer_states = int(max_states_str)
+            elif max_states_str != "${incremental_detokenizer_max_states}":
+                print(
+                    f"[TensorRT-LLM][WARNING] 'incremental_detokenizer_max_states' parameter is not set correctly (value is {max_states_str}). Will be set to {max_detokenizer_states}"
+                )
+        self.decode_cleanup = self._detect_decode_cleanup()
+        self.detokenizer = IncrementalDetokenizer(self._batch_decode,
+                                                  max_detokenizer_states)
+
         # Parse model output configs
         output_config = pb_utils.get_output_config_by_name(
             model_config, "OUTPUT")
@@ -115,55 +241,93 @@ class TritonPythonModel:
 
         tokens_batch = []
         sequence_lengths = []
+        sequence_keys = []
+        is_finals = []
         for idx, request in enumerate(requests):
+            batch_indices = None
+            sequence_index = 0
+            is_final = None
+            stream_id = None
             for input_tensor in request.inputs():
                 if input_tensor.name() == "TOKENS_BATCH":
                     tokens_batch.append(input_tensor.as_numpy())
                 elif input_tensor.name() == "SEQUENCE_LENGTH":
                     sequence_lengths.append(input_tensor.as_numpy())
+                elif input_tensor.name() == "BATCH_INDEX":
+                    batch_indices = input_tensor.as_numpy()
+                elif input_tensor.name() == "SEQUENCE_INDEX":
+                    sequence_index = input_tensor.as_numpy().item(0)
+                elif input_tensor.name() == "IS_FINAL":
+                    is_final = bool(input_tensor.as_numpy().item(0))
+                elif input_tensor.name() == "STREAM_ID":
+                    stream_id = input_tensor.as_numpy().item(0)
                 else:
                     raise ValueError(f"unknown input {input_tensor.name}")
 
+            # Streamed responses of one request are decoded incrementally,
+            # keyed by the STREAM_ID tensorrt_llm assigns them and the
+            # position of the sequence in it. Not by the request id, which
+            # clients may share. Only when IS_FINAL comes with them, else the
+            # state of a sequence would never be freed.
+            if (self.incremental_detokenization and stream_id is not None
+                    and is_final is not None):
+                sequence_keys.append([
+                    (stream_id, batch_indices.item(batch_idx)
+                     if batch_indices is not None else batch_idx,
+                     sequence_index)
+                    for batch_idx in range(tokens_batch[idx].shape[0])
+                ])
+            else:
+                sequence_keys.append(None)
+            is_finals.append(is_final)
+
         # batch decode
         list_of_tokens = []
+        list_of_slots = []
+        incremental_sequences = []
+        incremental_slots = []
         req_idx_offset = 0
         req_idx_offsets = [req_idx_offset]
         for idx, token_batch in enumerate(tokens_batch):
             for batch_idx, beam_tokens in enumerate(token_batch):
                 for beam_idx, tokens in enumerate(beam_tokens):
                     seq_len = sequence_lengths[idx][batch_idx][beam_idx]
-                    list_of_tokens.append(tokens[:seq_len])
+                    # Beam search streams the whole beams, which can change
+                    # between responses, so only single beams are incremental.
+                    if sequence_keys[idx] is not None and len(beam_tokens) == 1:
+                        incremental_sequences.append(
+                            (sequence_keys[idx][batch_idx],
+                             tokens[:seq_len].tolist(), is_finals[idx]))
+                        incremental_slots.append(req_idx_offset)
+                    else:
+                        list_of_tokens.append(tokens[:seq_len])
+                        list_of_slots.append(req_idx_offset)
                     req_idx_offset += 1
 
             req_idx_offsets.append(req_idx_offset)
 
-        # all_outputs = self.tokenizer.batch_decode(
-        #     list_of_tokens,
-        #     skip_special_tokens=self.skip_special_tokens,
-        # )
-        all_outputs = []
-        for token in list_of_tokens:
-            output = self.tokenizer.decode(
-                token,
-                skip_special_tokens=self.skip_special_tokens
-            )
+        all_outputs = [None] * req_idx_offset
+        for slot, token, output in zip(list_of_slots, list_of_tokens,
+                                       self._batch_decode(list_of_tokens)):
             # Check if output contains the Unicode replacement character (�)
-            if '\ufffd' in output or b'\xef\xbf\xbd' in output.encode('utf8'):
+            if '\ufffd' in output:
                 # Convert the token to its bytes representation instead of using a template
-                token_bytes_repr = f"t'{token[0]}'"
-                all_outputs.append(token_bytes_repr)
+                all_outputs[slot] = f"t'{token[0]}'"
             else:
-                all_outputs.append(output)
-        
+                all_outputs[slot] = output
+        if incremental_sequences:
+            for slot, output in zip(
+                    incremental_slots,
+                    self.detokenizer.decode_batch(incremental_sequences)):
+                all_outputs[slot] = output
+
         # construct responses
         responses = []
         for idx, request in enumerate(requests):
-            req_outputs = []
-            for x in all_outputs[req_idx_offsets[idx]:req_idx_offsets[idx + 1]]:
-                req_outputs = [
-                    x.encode('utf8')
-                    for x in all_outputs[req_idx_offsets[idx]:req_idx_offsets[idx + 1]]
-                ]
+            req_outputs = [
+                x.encode('utf8')
+                for x in all_outputs[req_idx_offsets[idx]:req_idx_offsets[idx + 1]]
+            ]
 
             output_tensor = pb_utils.Tensor(
                 'OUTPUT',
@@ -185,6 +349,46 @@ class TritonPythonModel:
         # of this list must match the length of `requests` list.
         return responses
 
+    def _detect_decode_cleanup(self):
+        """Returns how `_batch_decode` reproduces `tokenizer.decode`.
+
+        Fast tokenizers decode with the Rust tokenizer and then optionally
+        clean up the spaces before punctuation; whether the clean up runs
+        depends on the tokenizer and the transformers version, so it is
+        checked once on a probe text. Returns True or False for the clean up
+        of the Rust path, or None to fall back to `tokenizer.batch_decode`.
+        """
+        if not self.tokenizer.is_fast:
+            return None
+        token_ids = self.tokenizer.encode("Hello , world . Is it ? Yes !",
+                                          add_special_tokens=False)
+        expected = self.tokenizer.decode(
+            token_ids, skip_special_tokens=self.skip_special_tokens)
+        text = self.tokenizer.backend_tokenizer.decode(
+            token_ids, skip_special_tokens=self.skip_special_tokens)
+        if expected == text:
+            return False
+        if expected == self.tokenizer.clean_up_tokenization(text):
+            return True
+        return None
+
+    def _batch_decode(self, list_of_tokens):
+        """Decodes all sequences with a single tokenizer call."""
+        if not list_of_tokens:
+            return []
+        if self.decode_cleanup is None:
+            return self.tokenizer.batch_decode(
+                list_of_tokens, skip_special_tokens=self.skip_special_tokens)
+        texts = self.tokenizer.backend_tokenizer.decode_batch(
+            [
+                tokens.tolist() if isinstance(tokens, np.ndarray) else tokens
+                for tokens in list_of_tokens
+            ],
+            skip_special_tokens=self.skip_special_tokens)
+        if self.decode_cleanup:
+            texts = [self.tokenizer.clean_up_tokenization(t) for t in texts]
+        return texts
+
     def finalize(self):
         """`finalize` is called only once when the model is being unloaded.
         Implementing `finalize` function is optional. This function allows
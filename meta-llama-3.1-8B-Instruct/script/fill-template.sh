@@ -5,11 +5,31 @@ export MODEL_DIR=${PWD}/model
 export ENGINE_DIR=${PWD}/engine/FP8
 export MAX_BATCH_SIZE=16
 export GPU_MEM_FRACTION=0.9
+# The fused model runs its own executor on the engine, so it cannot share
+# the GPU with the tensorrt_llm model of the ensemble. FUSED=true deploys it
+# in place of the ensemble.
+export FUSED=${FUSED:-false}
+# Backend of the tensorrt_llm model: tensorrtllm (C++) by default, or python
+# to run raw-repository/tensorrt_llm/1/model.py and the features only it
+# implements.
+export TRITON_BACKEND=${TRITON_BACKEND:-tensorrtllm}
 
 rm -rf ./repository
 cp -a ./raw-repository ./repository
-python3 ./src/fill_template.py -i ./repository/preprocessing/config.pbtxt tokenizer_dir:${MODEL_DIR},triton_max_batch_size:${MAX_BATCH_SIZE},preprocessing_instance_count:1 
-python3 ./src/fill_template.py -i ./repository/postprocessing/config.pbtxt tokenizer_dir:${MODEL_DIR},triton_max_batch_size:${MAX_BATCH_SIZE},postprocessing_instance_count:1 
-python3 ./src/fill_template.py -i ./repository/tensorrt_llm/config.pbtxt triton_backend:tensorrtllm,triton_max_batch_size:${MAX_BATCH_SIZE},decoupled_mode:True,max_beam_width:1,engine_dir:${ENGINE_DIR},max_tokens_in_paged_kv_cache:2560,max_attention_window_size:2560,kv_cache_free_gpu_mem_fraction:${GPU_MEM_FRACTION},exclude_input_in_output:True,enable_kv_cache_reuse:False,batching_strategy:inflight_fused_batching,max_queue_delay_microseconds:100,encoder_input_features_data_type:TYPE_FP16,logits_datatype:TYPE_FP32 
+python3 ./src/fill_template.py -i ./repository/preprocessing/config.pbtxt tokenizer_dir:${MODEL_DIR},triton_max_batch_size:${MAX_BATCH_SIZE},preprocessing_instance_count:1,enable_batch_tokenization:True,word_list_cache_size:128,sparse_embedding_bias:False,prompt_cache_size:64
+python3 ./src/fill_template.py -i ./repository/postprocessing/config.pbtxt tokenizer_dir:${MODEL_DIR},triton_max_batch_size:${MAX_BATCH_SIZE},postprocessing_instance_count:1,enable_incremental_detokenization:True,incremental_detokenizer_max_states:4096 
+python3 ./src/fill_template.py -i ./repository/tensorrt_llm/config.pbtxt triton_backend:${TRITON_BACKEND},triton_max_batch_size:${MAX_BATCH_SIZE},decoupled_mode:True,max_beam_width:1,engine_dir:${ENGINE_DIR},max_tokens_in_paged_kv_cache:2560,max_attention_window_size:2560,kv_cache_free_gpu_mem_fraction:${GPU_MEM_FRACTION},exclude_input_in_output:True,enable_kv_cache_reuse:True,collect_kv_cache_reuse_stats:False,collect_queue_time_stats:False,tensorrt_llm_instance_count:1,shared_executor:False,batching_strategy:inflight_fused_batching,max_queue_delay_microseconds:100,encoder_input_features_data_type:TYPE_FP16,logits_datatype:TYPE_FP32 
 python3 ./src/fill_template.py -i ./repository/llama-3.1-8b-instruct/config.pbtxt triton_max_batch_size:${MAX_BATCH_SIZE},logits_datatype:TYPE_FP32 
-python3 ./src/fill_template.py -i ./repository/usage_counter/config.pbtxt triton_max_batch_size:${MAX_BATCH_SIZE},tokenizer_dir:${MODEL_DIR},usageprocessing_instance_count:1 
\ No newline at end of file
+python3 ./src/fill_template.py -i ./repository/usage_counter/config.pbtxt triton_max_batch_size:${MAX_BATCH_SIZE},tokenizer_dir:${MODEL_DIR},usageprocessing_instance_count:1 
+
+if [ "${FUSED}" = true ]; then
+    python3 ./src/fill_template.py -i ./repository/llama-3.1-8b-instruct-fused/config.pbtxt triton_max_batch_size:${MAX_BATCH_SIZE},decoupled_mode:True,max_beam_width:1,engine_dir:${ENGINE_DIR},tokenizer_dir:${MODEL_DIR},max_tokens_in_paged_kv_cache:2560,max_attention_window_size:2560,kv_cache_free_gpu_mem_fraction:${GPU_MEM_FRACTION},exclude_input_in_output:True,enable_kv_cache_reuse:True,collect_kv_cache_reuse_stats:False,collect_queue_time_stats:False,tensorrt_llm_instance_count:1,shared_executor:False,batching_strategy:inflight_fused_batching,max_queue_delay_microseconds:100,logits_datatype:TYPE_FP32,incremental_detokenizer_max_states:4096,word_list_cache_size:128,prompt_cache_size:64
+    # Keep the model files the fused model links to once the models of the
+    # ensemble are removed
+    cp --remove-destination ./repository/tensorrt_llm/1/model.py ./repository/llama-3.1-8b-instruct-fused/1/model.py
+    cp --remove-destination ./repository/preprocessing/1/model.py ./repository/llama-3.1-8b-instruct-fused/1/preprocessing.py
+    cp --remove-destination ./repository/postprocessing/1/model.py ./repository/llama-3.1-8b-instruct-fused/1/postprocessing.py
+    rm -rf ./repository/llama-3.1-8b-instruct ./repository/preprocessing ./repository/postprocessing ./repository/tensorrt_llm
+else
+    rm -rf ./repository/llama-3.1-8b-instruct-fused
+fi
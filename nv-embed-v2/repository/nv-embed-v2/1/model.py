@@ -1,13 +1,186 @@
-import sys
 import os
 import json
+import hashlib
 import numpy as np
-import glob
+from collections import OrderedDict
 import triton_python_backend_utils as pb_utils
 import torch
 import torch.nn.functional as F
 from transformers import AutoModel, AutoTokenizer
 
+# Formats of the `output_format` input, and the outputs they are sent in
+OUTPUT_FORMATS = {
+    "float32": ("embeddings", ),
+    "float16": ("embeddings_fp16", ),
+    "int8": ("embeddings_int8", "embeddings_scale"),
+    "binary": ("embeddings_binary", ),
+}
+
+
+def get_parameter(model_config, name, pytype=str):
+    """Returns the parameter `name` of the model config, None if unset."""
+    if name not in model_config.get("parameters", {}):
+        return None
+    value = model_config["parameters"][name]["string_value"]
+    if not value or value.startswith("${"):
+        return None
+    return pytype(value)
+
+
+class DiskEmbeddingStore:
+    """
+    Embeddings memory-mapped from `embeddings.npy` under `directory`, with
+    the key, token count and write sequence of each slot in `slots.npy`.
+    Slots are written in a ring, so once all `capacity` are taken the oldest
+    entry is overwritten. The index from keys to slots is rebuilt from
+    `slots.npy` on start-up, which lets the entries survive restarts.
+    """
+
+    slot_dtype = np.dtype([("key", np.uint8, (16, )), ("tokens", np.int32),
+                           ("sequence", np.uint64)])
+
+    def __init__(self, directory, capacity):
+        os.makedirs(directory, exist_ok=True)
+        self.capacity = capacity
+        self.slots_path = os.path.join(directory, "slots.npy")
+        self.embeddings_path = os.path.join(directory, "embeddings.npy")
+        self.slots = None
+        self.embeddings = None
+        self.index = {}
+        self.sequence = 0
+        self.next_slot = 0
+        if os.path.exists(self.slots_path) and os.path.exists(
+                self.embeddings_path):
+            self._open()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _open(self):
+        try:
+            slots = np.load(self.slots_path, mmap_mode="r+")
+            embeddings = np.load(self.embeddings_path, mmap_mode="r+")
+        except (OSError, ValueError):
+            return
+        if (slots.dtype != self.slot_dtype
+                or slots.shape != (self.capacity, )
+                or embeddings.ndim != 2
+                or embeddings.shape[0] != self.capacity):
+            # Written with another capacity, start over
+            return
+        self.slots = slots
+        self.embeddings = embeddings
+        for slot in np.flatnonzero(slots["sequence"]):
+            self.index[slots["key"][slot].tobytes()] = int(slot)
+        if self.index:
+            last = int(np.argmax(slots["sequence"]))
+            self.sequence = int(slots["sequence"][last])
+            self.next_slot = (last + 1) % self.capacity
+
+    def _create(self, dim):
+        self.slots = np.lib.format.open_memmap(self.slots_path,
+                                               mode="w+",
+                                               dtype=self.slot_dtype,
+                                               shape=(self.capacity, ))
+        self.embeddings = np.lib.format.open_memmap(self.embeddings_path,
+                                                    mode="w+",
+                                                    dtype=np.float32,
+                                                    shape=(self.capacity,
+                                                           dim))
+        self.index.clear()
+        self.sequence = 0
+        self.next_slot = 0
+
+    def get(self, key):
+        slot = self.index.get(key)
+        if slot is None:
+            return None
+        return (np.array(self.embeddings[slot]),
+                int(self.slots["tokens"][slot]))
+
+    def put(self, key, embedding, tokens):
+        if key in self.index:
+            return
+        if self.embeddings is None or self.embeddings.shape[1] != len(
+                embedding):
+            self._create(len(embedding))
+        slot = self.next_slot
+        if self.slots["sequence"][slot]:
+            self.index.pop(self.slots["key"][slot].tobytes(), None)
+        # The embedding is written before the slot that makes it visible
+        self.embeddings[slot] = embedding
+        self.sequence += 1
+        self.slots[slot] = (np.frombuffer(key, dtype=np.uint8), tokens,
+                            self.sequence)
+        self.index[key] = slot
+        self.next_slot = (slot + 1) % self.capacity
+
+    def flush(self):
+        if self.embeddings is not None:
+            self.embeddings.flush()
+            self.slots.flush()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of normalized embeddings and the token counts
+    of their texts. A least recently used tier in memory holds up to
+    `max_bytes` of embeddings, in front of an optional `DiskEmbeddingStore`.
+    """
+
+    def __init__(self, max_bytes, disk_dir=None, disk_entries=0):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.disk = (DiskEmbeddingStore(disk_dir, disk_entries)
+                     if disk_dir and disk_entries else None)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(input_type, instruction, text):
+        return hashlib.blake2b("\0".join(
+            (input_type, instruction, text)).encode("utf8"),
+                               digest_size=16).digest()
+
+    def get(self, key):
+        """Returns the (embedding, tokens) cached for `key`, or None."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.memory_hits += 1
+            return entry
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.disk_hits += 1
+                self._put_memory(key, entry)
+                return entry
+        self.misses += 1
+        return None
+
+    def put(self, key, embedding, tokens):
+        self._put_memory(key, (embedding.copy(), int(tokens)))
+        if self.disk is not None:
+            self.disk.put(key, embedding, tokens)
+
+    def _put_memory(self, key, entry):
+        if entry[0].nbytes > self.max_bytes:
+            return
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.nbytes -= previous[0].nbytes
+        self.entries[key] = entry
+        self.nbytes += entry[0].nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted[0].nbytes
+
+    def flush(self):
+        if self.disk is not None:
+            self.disk.flush()
+
 
 class TritonPythonModel:
 
@@ -34,14 +207,162 @@ class TritonPythonModel:
         self.model = AutoModel.from_pretrained(model_path,
                                                trust_remote_code=True)
         self.tokenizer = AutoTokenizer.from_pretrained(model_path)
-        self.max_length = 32768
+        self.max_length = get_parameter(model_config, "max_length",
+                                        int) or 32768
         self.task_name_to_instruct = {
             "default": "Given a question, retrieve passages that answer the question",
         }
+        self.instructions = {
+            "query": "Instruct: "
+            + self.task_name_to_instruct["default"]
+            + "\nQuery: ",
+            "passage": "",
+        }
+        # The texts are tokenized once, with their instruction prefix and
+        # the EOS token the way `self.model.encode` does, and the token ids
+        # are fed to the forward pass of the model directly. The leading
+        # instruction tokens are left out of the mean pooling.
+        self.instruction_lengths = {
+            prefix: len(self.tokenizer.tokenize(prefix)) if prefix else 0
+            for prefix in self.instructions.values()
+        }
+        self.mask_instruction = (self.model.padding_side == "right"
+                                 and self.model.is_mask_instruction)
+        self.device = self.model.device
+
+        # Texts of all the requests of an execute call are encoded together,
+        # in micro-batches of at most `micro_batch_size` texts and
+        # `micro_batch_tokens` tokens once padded
+        self.micro_batch_size = get_parameter(model_config,
+                                              "micro_batch_size", int) or 32
+        self.micro_batch_tokens = get_parameter(
+            model_config, "micro_batch_tokens", int) or self.max_length
+
+        # Texts longer than `chunk_threshold_tokens` are split into windows of
+        # `chunk_tokens` overlapping by `chunk_overlap_tokens`, encoded
+        # separately and pooled, instead of being truncated to `max_length`
+        self.chunk_threshold_tokens = get_parameter(model_config,
+                                                    "chunk_threshold_tokens",
+                                                    int)
+        self.chunk_tokens = get_parameter(model_config, "chunk_tokens",
+                                          int) or 4096
+        self.chunk_overlap_tokens = get_parameter(
+            model_config, "chunk_overlap_tokens", int) or 0
+        # Tokens of the BOS and instruction prefix tokenized alone
+        self.prefix_ids = {
+            prefix: self.tokenizer(prefix)["input_ids"]
+            for prefix in self.instructions.values()
+        }
+        if self.chunk_threshold_tokens is not None:
+            if not 0 < self.chunk_threshold_tokens <= self.max_length:
+                raise ValueError(
+                    "chunk_threshold_tokens must be between 1 and max_length")
+            if not 0 <= self.chunk_overlap_tokens < self.chunk_tokens:
+                raise ValueError(
+                    "chunk_overlap_tokens must be smaller than chunk_tokens")
+            # A window is the prefix tokens, `chunk_tokens` and the EOS token
+            max_window_tokens = (self.chunk_tokens + 1 + max(
+                len(ids) for ids in self.prefix_ids.values()))
+            if max_window_tokens > self.max_length:
+                raise ValueError(
+                    f"chunk_tokens must leave room for the instruction "
+                    f"prefix and EOS tokens in max_length, windows would "
+                    f"have up to {max_window_tokens} tokens")
+
+        # Embeddings of texts seen before are served from a cache, in memory
+        # and optionally on disk, in a directory per model instance and
+        # fingerprint of the settings the embeddings depend on
+        cache_memory_mb = get_parameter(model_config,
+                                        "embedding_cache_memory_mb", int) or 0
+        cache_dir = get_parameter(model_config, "embedding_cache_dir")
+        cache_disk_entries = get_parameter(
+            model_config, "embedding_cache_disk_entries", int) or 0
+        self.embedding_cache = None
+        if cache_memory_mb > 0 or (cache_dir and cache_disk_entries > 0):
+            if cache_dir:
+                settings = json.dumps(
+                    {
+                        "model_path": model_path,
+                        "max_length": self.max_length,
+                        "chunk_threshold_tokens": self.chunk_threshold_tokens,
+                        "chunk_tokens": self.chunk_tokens,
+                        "chunk_overlap_tokens": self.chunk_overlap_tokens,
+                    },
+                    sort_keys=True)
+                fingerprint = hashlib.blake2b(settings.encode("utf8"),
+                                              digest_size=8).hexdigest()
+                cache_dir = os.path.join(
+                    cache_dir, args.get("model_instance_name", "default"),
+                    fingerprint)
+            self.embedding_cache = EmbeddingCache(
+                cache_memory_mb * 1024 * 1024, cache_dir, cache_disk_entries)
+        self._create_metrics(args.get("model_name", ""),
+                             args.get("model_version", ""))
+
+    def _create_metrics(self, model, version):
+        common_labels = {"model": model, "version": version}
+        self.embedding_cache_metric_family = pb_utils.MetricFamily(
+            name="nv_embedding_cache_lookups",
+            description="Embedding cache lookups in nv-embed-v2",
+            kind=pb_utils.MetricFamily.COUNTER,
+        )
+        self.embedding_cache_size_metric_family = pb_utils.MetricFamily(
+            name="nv_embedding_cache_entries",
+            description="Embeddings held by the nv-embed-v2 cache",
+            kind=pb_utils.MetricFamily.GAUGE,
+        )
+        self.embedding_cache_metrics = {
+            "memory_hits":
+            self.embedding_cache_metric_family.Metric(labels={
+                "cache_result": "memory_hit",
+                **common_labels
+            }),
+            "disk_hits":
+            self.embedding_cache_metric_family.Metric(labels={
+                "cache_result": "disk_hit",
+                **common_labels
+            }),
+            "misses":
+            self.embedding_cache_metric_family.Metric(labels={
+                "cache_result": "miss",
+                **common_labels
+            }),
+            "memory_entries":
+            self.embedding_cache_size_metric_family.Metric(labels={
+                "cache_tier": "memory",
+                **common_labels
+            }),
+            "disk_entries":
+            self.embedding_cache_size_metric_family.Metric(labels={
+                "cache_tier": "disk",
+                **common_labels
+            }),
+        }
+        self._embedding_cache_stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0
+        }
+
+    def _update_embedding_cache_metrics(self):
+        cache = self.embedding_cache
+        for name, previous in self._embedding_cache_stats.items():
+            value = getattr(cache, name)
+            self.embedding_cache_metrics[name].increment(value - previous)
+            self._embedding_cache_stats[name] = value
+        self.embedding_cache_metrics["memory_entries"].set(len(cache.entries))
+        self.embedding_cache_metrics["disk_entries"].set(
+            len(cache.disk) if cache.disk is not None else 0)
 
     def execute(self, requests):
         """
-        This function is called when an inference is requested for this model. 
+        This function is called when an inference is requested for this model.
+
+        The texts of all the requests are merged and looked up in the
+        embedding cache. The others are split by input type since the
+        instruction prefix differs, sorted by length so that little padding
+        is encoded and encoded in micro-batches. The embeddings are then
+        scattered back to their requests.
 
         Parameters
         ----------
@@ -55,77 +376,331 @@ class TritonPythonModel:
           be the same as `requests`
         """
 
-        responses = []
-
-        # Every Python backend must iterate over everyone of the requests
-        # and create a pb_utils.InferenceResponse for each of them.
+        errors = {}
+        texts = []
+        input_types = []
+        owners = []
+        spans = {}
+        output_options = {}
         for idx, request in enumerate(requests):
             try:
-                # Get inputs
-                input_text = pb_utils.get_input_tensor_by_name(
-                    request, "input_text")
-                input_text = [p.decode("utf8") for p in input_text.as_numpy()[0]]
-
-                input_type = pb_utils.get_input_tensor_by_name(
-                    request, "input_type")
-                if input_type is not None:
-                    input_type = np.squeeze(input_type.as_numpy(), axis=0)
-                    input_type = str(input_type[0].decode("utf8"))
-                else:
-                    # Default to appropriate input type based on input size
-                    if len(input_text) == 1:
-                        input_type = "query"
-                    else:
-                        input_type = "passage"
-
-                # Switch input_type for different prefix
-                if input_type == "query":
-                    prefix = "Instruct: " \
-                        + self.task_name_to_instruct["default"] \
-                        + "\nQuery: "
-                elif input_type == "passage":
-                    prefix = ""
+                request_texts, request_types = self.parse_request(request)
+                output_options[idx] = self.parse_output_options(request)
+            except Exception as error:
+                print(f"Failed to parse request {idx}: {error}")
+                errors[idx] = error
+                continue
+            spans[idx] = (len(texts), request_texts.shape)
+            for row, input_type in zip(request_texts, request_types):
+                texts.extend(row)
+                input_types.extend([input_type] * len(row))
+            owners.extend([idx] * request_texts.size)
+        prefixes = [self.instructions[input_type] for input_type in input_types]
+
+        lengths = np.zeros(len(texts), dtype=np.int32)
+        embeddings = np.empty((len(texts), 0), dtype=np.float32)
+
+        def store(indices, rows):
+            nonlocal embeddings
+            if embeddings.shape[1] != rows.shape[1]:
+                embeddings = np.empty((len(texts), rows.shape[1]),
+                                      dtype=np.float32)
+            embeddings[indices] = rows
+
+        # look the texts up in the embedding cache, only the others are
+        # tokenized and encoded
+        keys = []
+        uncached = list(range(len(texts)))
+        if self.embedding_cache is not None:
+            keys = [
+                EmbeddingCache.key(*item)
+                for item in zip(input_types, prefixes, texts)
+            ]
+            cached = {}
+            for i, key in enumerate(keys):
+                entry = self.embedding_cache.get(key)
+                if entry is not None:
+                    cached[i] = entry
+            if cached:
+                store(list(cached),
+                      np.stack([embedding for embedding, _ in cached.values()]))
+                lengths[list(cached)] = [tokens for _, tokens in cached.values()]
+                uncached = [i for i in uncached if i not in cached]
+
+        # tokenize every uncached text once, the token ids feed both the
+        # model and the count of prompt tokens. Texts over the chunking
+        # threshold are split into windows.
+        windows = []
+        window_texts = []
+        if uncached:
+            eos_token = self.tokenizer.eos_token
+            tokens = self.tokenizer(
+                [prefixes[i] + texts[i] + eos_token for i in uncached],
+                max_length=self.max_length,
+                truncation=self.chunk_threshold_tokens is None,
+                return_token_type_ids=False,
+                return_attention_mask=False)["input_ids"]
+            lengths[uncached] = [len(ids) for ids in tokens]
+            for i, ids in zip(uncached, tokens):
+                if (self.chunk_threshold_tokens is not None
+                        and len(ids) > self.chunk_threshold_tokens):
+                    text_windows = self.split_tokens(ids, prefixes[i])
                 else:
-                    raise ValueError("Invalid input type!!")
-
-                # count the number of tokens
-                tokens = self.tokenizer(
-                    input_text,
-                    padding=True,
-                    truncation=True,
-                    max_length=self.max_length,
-                    return_tensors="pt"
-                )
-                prompt_tokens = torch.sum(tokens["attention_mask"])
-
-                # get the embeddings
-                embeddings = self.model.encode(input_text,
-                                               instruction=prefix,
-                                               max_length=self.max_length)
-                
-                # normalize embeddings
-                embeddings = F.normalize(embeddings, p=2, dim=1)
-                embeddings = embeddings.detach().numpy()
-            
-                # Prepare results
-                context_output = pb_utils.Tensor("embeddings", np.array([embeddings], dtype=np.float32))
-                prompt_tokens_output = pb_utils.Tensor("prompt_tokens", np.array([prompt_tokens], dtype=np.int32))
-                inference_response = pb_utils.InferenceResponse(
-                    output_tensors=[context_output, prompt_tokens_output]
-                )
-                responses.append(inference_response)
+                    text_windows = [ids]
+                windows.extend(text_windows)
+                window_texts.extend([i] * len(text_windows))
+        window_prefixes = [prefixes[i] for i in window_texts]
+        window_lengths = [len(ids) for ids in windows]
 
+        # get the embeddings
+        window_embeddings = [None] * len(windows)
+        for batch in self.make_micro_batches(range(len(windows)),
+                                             window_prefixes, window_lengths):
+            try:
+                with torch.inference_mode():
+                    batch_embeddings = self.encode_tokens(
+                        [windows[w] for w in batch], window_prefixes[batch[0]])
+                    # normalize embeddings
+                    batch_embeddings = F.normalize(batch_embeddings,
+                                                   p=2,
+                                                   dim=1)
+                for w, embedding in zip(
+                        batch,
+                        batch_embeddings.float().cpu().numpy()):
+                    window_embeddings[w] = embedding
             except Exception as error:
-                print(sys.exc_info()[2])
-                responses.append(pb_utils.InferenceResponse(output_tensors=[],
-                                                            error=pb_utils.TritonError(error)))
+                print(f"Failed to encode a batch of {len(batch)} windows: "
+                      f"{error}")
+                for w in batch:
+                    errors.setdefault(owners[window_texts[w]], error)
+
+        # pool the windows of every text
+        encoded = []
+        pooled = []
+        start = 0
+        while start < len(windows):
+            i = window_texts[start]
+            end = start + 1
+            while end < len(windows) and window_texts[end] == i:
+                end += 1
+            text_embeddings = window_embeddings[start:end]
+            if all(embedding is not None for embedding in text_embeddings):
+                encoded.append(i)
+                pooled.append(
+                    self.pool_windows(text_embeddings,
+                                      window_lengths[start:end]))
+            start = end
+        if encoded:
+            store(encoded, np.stack(pooled))
+        if self.embedding_cache is not None:
+            for i in encoded:
+                self.embedding_cache.put(keys[i], embeddings[i], lengths[i])
+            self._update_embedding_cache_metrics()
+
+        # Every Python backend must iterate over everyone of the requests
+        # and create a pb_utils.InferenceResponse for each of them.
+        responses = []
+        for idx in range(len(requests)):
+            if idx in errors:
+                responses.append(pb_utils.InferenceResponse(
+                    output_tensors=[],
+                    error=pb_utils.TritonError(errors[idx])))
+                continue
+            offset, shape = spans[idx]
+            end = offset + shape[0] * shape[1]
+            try:
+                embedding_outputs = self.format_embeddings(
+                    embeddings[offset:end].reshape(*shape,
+                                                   embeddings.shape[1]),
+                    *output_options[idx])
+            except Exception as error:
+                print(f"Failed to format the embeddings of request {idx}: "
+                      f"{error}")
+                responses.append(pb_utils.InferenceResponse(
+                    output_tensors=[], error=pb_utils.TritonError(error)))
+                continue
+            prompt_tokens_output = pb_utils.Tensor(
+                "prompt_tokens", lengths[offset:end].reshape(shape))
+            responses.append(pb_utils.InferenceResponse(
+                output_tensors=[*embedding_outputs, prompt_tokens_output]))
 
         # You should return a list of pb_utils.InferenceResponse. Length
         # of this list must match the length of `requests` list.
         return responses
 
+    def parse_request(self, request):
+        """
+        Returns the decoded `input_text` of a request, one row per batch
+        item, and the input type of each row.
+        """
+        encoded = pb_utils.get_input_tensor_by_name(request,
+                                                    "input_text").as_numpy()
+        input_text = np.empty(encoded.shape, dtype=object)
+        input_text.flat[:] = [p.decode("utf8") for p in encoded.flat]
+
+        input_type = pb_utils.get_input_tensor_by_name(request, "input_type")
+        if input_type is not None:
+            input_type = input_type.as_numpy()
+        input_types = []
+        for row_idx, row in enumerate(input_text):
+            if input_type is not None:
+                row_type = input_type[row_idx if len(input_type) > 1 else 0]
+                row_type = str(row_type[0].decode("utf8"))
+            else:
+                # Default to appropriate input type based on input size
+                row_type = "query" if len(row) == 1 else "passage"
+            # Switch input_type for different prefix
+            if row_type not in self.instructions:
+                raise ValueError("Invalid input type!!")
+            input_types.append(row_type)
+        return input_text, input_types
+
+    def parse_output_options(self, request):
+        """
+        Returns the `output_format` and the `dimensions` the embeddings of a
+        request are truncated to, None to keep them all.
+        """
+        output_format = pb_utils.get_input_tensor_by_name(
+            request, "output_format")
+        if output_format is None:
+            output_format = "float32"
+        else:
+            output_format = output_format.as_numpy().flat[0].decode("utf8")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"Invalid output format {output_format!r}, expected one of "
+                f"{', '.join(OUTPUT_FORMATS)}")
+
+        dimensions = pb_utils.get_input_tensor_by_name(request, "dimensions")
+        if dimensions is not None:
+            dimensions = int(dimensions.as_numpy().flat[0])
+            if dimensions <= 0:
+                raise ValueError("dimensions must be positive")
+        return output_format, dimensions
+
+    @staticmethod
+    def format_embeddings(embeddings, output_format, dimensions):
+        """
+        Returns the output tensors of normalized `embeddings` in
+        `output_format`. With `dimensions`, the embeddings are first
+        truncated to their leading dimensions Matryoshka-style and
+        normalized again.
+        """
+        if dimensions is not None:
+            if dimensions > embeddings.shape[-1]:
+                raise ValueError(
+                    f"dimensions must be at most {embeddings.shape[-1]}")
+            if dimensions < embeddings.shape[-1]:
+                embeddings = embeddings[..., :dimensions]
+                norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+                embeddings = embeddings / np.maximum(norms, 1e-12)
+
+        names = OUTPUT_FORMATS[output_format]
+        if output_format == "float16":
+            return [pb_utils.Tensor(names[0], embeddings.astype(np.float16))]
+        if output_format == "int8":
+            # Symmetric scalar quantization with a scale per vector
+            scale = np.abs(embeddings).max(axis=-1) / 127
+            quantized = np.rint(
+                embeddings /
+                np.maximum(scale, np.finfo(np.float32).tiny)[..., None])
+            return [
+                pb_utils.Tensor(names[0], quantized.astype(np.int8)),
+                pb_utils.Tensor(names[1], scale.astype(np.float32)),
+            ]
+        if output_format == "binary":
+            # One bit per dimension, set when positive, packed big-endian
+            return [pb_utils.Tensor(names[0], np.packbits(embeddings > 0,
+                                                          axis=-1))]
+        return [
+            pb_utils.Tensor(names[0],
+                            np.ascontiguousarray(embeddings, dtype=np.float32))
+        ]
+
+    def encode_tokens(self, input_ids, prefix):
+        """
+        Returns the embeddings of tokenized texts sharing the instruction
+        `prefix`, running the forward pass `self.model.encode` runs after
+        tokenizing.
+        """
+        batch = self.tokenizer.pad({"input_ids": input_ids},
+                                   padding=True,
+                                   return_tensors="pt")
+        attention_mask = batch["attention_mask"].to(self.device)
+        pool_mask = attention_mask.clone()
+        instruction_length = self.instruction_lengths[prefix]
+        if self.mask_instruction and instruction_length > 0:
+            # Mask out the instruction tokens for mean-pooling
+            pool_mask[:, :instruction_length] = 0
+        outputs = self.model(input_ids=batch["input_ids"].to(self.device),
+                             attention_mask=attention_mask,
+                             pool_mask=pool_mask,
+                             return_dict=True)
+        return outputs["sentence_embeddings"].squeeze(1)
+
+    def split_tokens(self, input_ids, prefix):
+        """
+        Splits the token ids of a long text into windows of `chunk_tokens`
+        overlapping by `chunk_overlap_tokens`, each starting with the BOS and
+        instruction tokens and ending with the EOS token of the text.
+        """
+        # The head is the tokens of the text that match the prefix tokenized
+        # alone: its last token can merge with the first of the text, e.g.
+        # the space ending "Query: ", and then belongs to the text
+        prefix_ids = self.prefix_ids[prefix]
+        head_length = 0
+        for token_id, prefix_id in zip(input_ids[:-1], prefix_ids):
+            if token_id != prefix_id:
+                break
+            head_length += 1
+        head = input_ids[:head_length]
+        body = input_ids[len(head):-1]
+        tail = input_ids[-1:]
+        stride = self.chunk_tokens - self.chunk_overlap_tokens
+        windows = []
+        start = 0
+        while True:
+            windows.append(head + body[start:start + self.chunk_tokens] +
+                           tail)
+            if start + self.chunk_tokens >= len(body):
+                return windows
+            start += stride
+
+    @staticmethod
+    def pool_windows(embeddings, lengths):
+        """
+        Returns the normalized mean of the embeddings of the windows of a
+        text, weighted by their number of tokens.
+        """
+        if len(embeddings) == 1:
+            return embeddings[0]
+        pooled = np.average(np.stack(embeddings), axis=0, weights=lengths)
+        return pooled / np.linalg.norm(pooled)
+
+    def make_micro_batches(self, indices, prefixes, lengths):
+        """
+        Groups the `indices` of texts into micro-batches sharing the same
+        instruction prefix, in increasing order of length.
+        """
+        order = sorted(indices, key=lambda i: (prefixes[i], lengths[i]))
+        batches = []
+        batch = []
+        for i in order:
+            if batch and (prefixes[i] != prefixes[batch[0]]
+                          or len(batch) >= self.micro_batch_size
+                          or (len(batch) + 1) * lengths[i] >
+                          self.micro_batch_tokens):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
     def finalize(self):
         """
         This function allows the model to perform any necessary clean ups before exit.
         """
+        if self.embedding_cache is not None:
+            self.embedding_cache.flush()
         print("Cleaning up...")